@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""Microbenchmark of JSON encode/decode time for the payloads the bridge handles
+Compares the stdlib json module, as requests uses it, with the codec in worker.utils.json_codec
+
+Usage: python benchmarks/bench_json.py [--tokens 131072] [--iterations 20]
+"""
+import argparse
+import json
+import os
+import random
+import string
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from worker.utils import json_codec  # noqa: E402
+
+
+def make_prompt(tokens):
+    """Roughly 4 characters per token, with some unicode and characters that need escaping"""
+    words = ["".join(random.choices(string.ascii_letters, k=random.randint(2, 8))) for _ in range(500)]
+    words += ['"quoted"', "line\nbreak", "tab\there", "café", "日本語", "emoji 🚀"]
+    text = []
+    length = 0
+    while length < tokens * 4:
+        word = random.choice(words)
+        text.append(word)
+        length += len(word) + 1
+    return " ".join(text)
+
+
+def make_payloads(tokens):
+    prompt = make_prompt(tokens)
+    pop = {
+        "id": "00000000-0000-0000-0000-000000000000",
+        "payload": {
+            "prompt": prompt,
+            "max_length": 512,
+            "max_context_length": tokens,
+            "temperature": 0.7,
+            "top_p": 0.9,
+            "stop_sequence": ["\nUser:"],
+        },
+        "model": "grid/llama-3.1-8b-instant",
+        "skipped": {},
+    }
+    chat_request = {
+        "model": "llama-3.1-8b-instant",
+        "messages": [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": prompt},
+        ],
+        "max_tokens": 512,
+        "temperature": 0.7,
+        "top_p": 0.9,
+    }
+    return {"pop response": pop, "chat request": chat_request}
+
+
+def stdlib_encode(obj):
+    # This is what requests does with json=
+    return json.dumps(obj, allow_nan=False).encode("utf-8")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=131072, help="Approximate prompt size in tokens")
+    parser.add_argument("--iterations", type=int, default=20, help="Iterations per measurement")
+    args = parser.parse_args()
+
+    print(f"Codec backend: {json_codec.BACKEND}")
+    for name, payload in make_payloads(args.tokens).items():
+        encoded = stdlib_encode(payload)
+        print(f"\n{name}: {len(encoded) / 1024:.0f} KiB")
+        results = {
+            "stdlib encode": timeit.timeit(lambda: stdlib_encode(payload), number=args.iterations),
+            "codec encode": timeit.timeit(lambda: json_codec.dumps(payload), number=args.iterations),
+            "stdlib decode": timeit.timeit(lambda: json.loads(encoded), number=args.iterations),
+            "codec decode": timeit.timeit(lambda: json_codec.loads(encoded), number=args.iterations),
+        }
+        for label, total in results.items():
+            print(f"  {label:<14} {total / args.iterations * 1000:8.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
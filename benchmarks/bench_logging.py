@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""Benchmark of the logging cost a single job pays on its worker thread
+
+"before" replays the previous setup: five stream handlers, each with its own filter,
+and debug payloads formatted eagerly with f-strings.
+"after" uses the configuration in worker.logger with the deferred calls the job code now makes.
+
+Usage: python benchmarks/bench_logging.py [--tokens 32768] [--jobs 200]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from worker import logger as worker_logger  # noqa: E402
+from worker.logger import logger  # noqa: E402
+
+
+def legacy_config():
+    """The handlers worker/logger.py used to configure"""
+    return {
+        "handlers": [
+            {
+                "sink": sys.stderr,
+                "format": worker_logger.logfmt,
+                "colorize": True,
+                "filter": worker_logger.is_stderr_log,
+                "level": "WARNING",
+            },
+            {
+                "sink": sys.stdout,
+                "format": worker_logger.genfmt,
+                "level": "PROMPT",
+                "colorize": True,
+                "filter": worker_logger.is_stdout_log,
+            },
+            {
+                "sink": sys.stdout,
+                "format": worker_logger.initfmt,
+                "level": "INIT",
+                "colorize": True,
+                "filter": worker_logger.is_init_log,
+            },
+            {
+                "sink": sys.stdout,
+                "format": worker_logger.msgfmt,
+                "level": "MESSAGE",
+                "colorize": True,
+                "filter": worker_logger.is_msg_log,
+            },
+            {
+                "sink": sys.stdout,
+                "format": worker_logger.logfmt,
+                "level": "INFO",
+                "colorize": True,
+                "filter": lambda record: record["level"].name == "INFO",
+            },
+        ],
+    }
+
+
+def make_job_data(tokens):
+    prompt = "lorem ipsum dolor sit amet " * (tokens * 4 // 27)
+    payload = {
+        "model": "llama-3.1-8b-instant",
+        "messages": [{"role": "system", "content": "You are a helpful assistant."}, {"role": "user", "content": prompt}],
+        "max_tokens": 512,
+    }
+    response = {
+        "choices": [{"message": {"role": "assistant", "content": "generated text " * 400}}],
+        "usage": {"prompt_tokens": tokens, "completion_tokens": 512},
+    }
+    headers = {f"x-header-{i}": "value" for i in range(20)}
+    return payload, response, headers
+
+
+def job_before(payload, response, headers):
+    """The log calls a job used to make"""
+    logger.info(f"{'✅ Received 12345678':<20}| {'🧠 model':<16}| {'📊512 tokens':<16}| 🆕 Job")
+    logger.debug(f"Prompt length is {len(payload['messages'][1]['content'])} characters")
+    logger.debug(f"Using model: {payload['model']}")
+    logger.debug(f"OpenAI request payload: {payload}")
+    logger.debug(f"Request headers: {headers}")
+    logger.debug(f"Response status: {200}")
+    logger.debug(f"Response headers: {headers}")
+    logger.debug(f"OpenAI API response: {response}")
+    logger.debug(f"Response choices: {response['choices']}")
+    logger.debug(f"Message content: '{response['choices'][0]['message']['content']}'")
+    logger.info(f"o1-mini response structure: {json.dumps(response, indent=2)}")
+    logger.info(f"{'✅ Complete 12345678':<20}| {'🧠 model':<16}| {'🐇Fast':<16}| ⚡  {123.4:<7.1f}TPS")
+
+
+def job_after(payload, response, headers):
+    """The log calls a job makes now"""
+    logger.info(f"{'✅ Received 12345678':<20}| {'🧠 model':<16}| {'📊512 tokens':<16}| 🆕 Job")
+    logger.debug("Prompt length is {} characters", len(payload["messages"][1]["content"]))
+    logger.debug("Using model: {}", payload["model"])
+    logger.debug("OpenAI request payload: {}", payload)
+    logger.debug("Response status: {}", 200)
+    logger.debug("Response headers: {}", headers)
+    logger.debug("OpenAI API response: {}", response)
+    logger.debug("Response choices: {}", response["choices"])
+    logger.debug("Message content: '{}'", response["choices"][0]["message"]["content"])
+    logger.opt(lazy=True).debug("o1-mini response structure: {}", lambda: json.dumps(response, indent=2))
+    logger.info(f"{'✅ Complete 12345678':<20}| {'🧠 model':<16}| {'🐇Fast':<16}| ⚡  {123.4:<7.1f}TPS")
+
+
+def measure(job, jobs, data):
+    start = time.perf_counter()
+    for _ in range(jobs):
+        job(*data)
+    return (time.perf_counter() - start) / jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=32768, help="Approximate prompt size in tokens")
+    parser.add_argument("--jobs", type=int, default=200, help="Jobs to simulate per measurement")
+    args = parser.parse_args()
+
+    data = make_job_data(args.tokens)
+    real_stdout = sys.stdout
+    with open(os.devnull, "w", encoding="utf-8") as devnull:
+        sys.stdout = sys.stderr = devnull
+        try:
+            logger.configure(**legacy_config())
+            before = measure(job_before, args.jobs, data)
+            logger.configure(**worker_logger.config)
+            after = measure(job_after, args.jobs, data)
+            worker_logger.background_sink.flush()
+        finally:
+            sys.stdout = real_stdout
+            sys.stderr = sys.__stderr__
+
+    print(f"Per-job logging cost with a ~{args.tokens} token prompt:")
+    print(f"  before: {before * 1000:8.3f} ms")
+    print(f"  after:  {after * 1000:8.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Benchmark of turning horde payloads into OpenAI chat requests on large prompts
+Compares the previous per-job transformation with the compiled worker.jobs.payloads.PayloadPipeline
+
+Usage: python benchmarks/bench_payloads.py [--tokens 131072] [--iterations 50]
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from worker.jobs.payloads import AIPG_CONTEXT, AIPG_SYSTEM_PROMPT, DEFAULT_SYSTEM_PROMPT, PayloadPipeline  # noqa: E402
+
+WORDS = (
+    "The quick brown fox said that the rain in Spain stays mainly in the plain. "
+    "Certainly, paid maintenance again contains details about the main chain."
+).split()
+
+
+def legacy_transform(payload, model):
+    """The transformation ScribeHordeJob used to run for every job"""
+    prompt = payload.get("prompt", "")
+    max_tokens = int(payload.get("max_length", 80))
+    aipg_terms = ["aipg", "ai power grid", "aipowergrid"]
+    has_aipg_mention = any(term in prompt.lower() for term in aipg_terms)
+    if has_aipg_mention:
+        prompt = f"{AIPG_CONTEXT}\n\nUser Query: {prompt}"
+        system_prompt = AIPG_SYSTEM_PROMPT
+    else:
+        system_prompt = DEFAULT_SYSTEM_PROMPT
+    if model == "o1-mini":
+        return {
+            "model": model,
+            "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": prompt}],
+            "max_completion_tokens": max_tokens,
+        }
+    openai_payload = {
+        "model": model,
+        "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": prompt}],
+        "max_tokens": max_tokens,
+        "temperature": float(payload.get("temperature", 0.8)),
+        "top_p": float(payload.get("top_p", 0.9)),
+    }
+    if "stop_sequence" in payload:
+        openai_payload["stop"] = payload["stop_sequence"]
+    if "frequency_penalty" in payload:
+        openai_payload["frequency_penalty"] = float(payload["frequency_penalty"])
+    if "presence_penalty" in payload:
+        openai_payload["presence_penalty"] = float(payload["presence_penalty"])
+    return openai_payload
+
+
+def make_payload(tokens, mention):
+    words = [random.choice(WORDS) for _ in range(tokens * 4 // 6)]
+    if mention:
+        words.append("AI Power Grid")
+    return {"prompt": " ".join(words), "max_length": 512, "temperature": 0.7, "stop_sequence": ["\nUser:"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=131072, help="Approximate prompt size in tokens")
+    parser.add_argument("--iterations", type=int, default=50, help="Iterations per measurement")
+    args = parser.parse_args()
+
+    for model in ("llama-3.1-8b-instant", "o1-mini"):
+        pipeline = PayloadPipeline(model)
+        for mention in (False, True):
+            payload = make_payload(args.tokens, mention)
+            assert pipeline.transform(payload) == legacy_transform(payload, model)
+            before = timeit.timeit(lambda: legacy_transform(payload, model), number=args.iterations)
+            after = timeit.timeit(lambda: pipeline.transform(payload), number=args.iterations)
+            label = f"{model}, {'with' if mention else 'without'} AIPG mention"
+            print(f"{label:<45} before: {before / args.iterations * 1000:7.3f} ms  after: {after / args.iterations * 1000:7.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
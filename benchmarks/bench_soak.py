@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""Soak test of a whole worker against local stub horde and backend servers, failing if its memory keeps growing
+
+The worker pops, generates and submits jobs as fast as the stubs answer, so it runs through far more jobs
+than it would in production. After a warmup, the RSS and the allocations traced by tracemalloc are measured
+against a baseline. Exits with 1 if either grew more than its budget, after listing the top allocators.
+
+Usage: python benchmarks/bench_soak.py [--duration 600] [--warmup 30] [--threads 8] [--prompt-kb 16]
+                                       [--rss-budget-mb 20] [--traced-budget-mb 5]
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+MODEL = "soak-model"
+WORDS = "the quick brown fox jumps over the lazy dog while it rains in spain ".split()
+
+
+class StubServer(ThreadingHTTPServer):
+    """Answers as the horde under /api/v2 and as an OpenAI compatible backend under /v1"""
+
+    daemon_threads = True
+
+    def __init__(self, prompt_kb):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.prompt = " ".join(WORDS[i % len(WORDS)] for i in range(prompt_kb * 1024 // 4))[: prompt_kb * 1024]
+        self.submitted = 0
+        self.mutex = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _reply(self, body, status=200):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        if self.path.endswith("/find_user"):
+            self._reply({"username": "soak"})
+        elif self.path.endswith("/models"):
+            self._reply({"data": [{"id": MODEL}]})
+        else:
+            self._reply({"message": "Not found"}, 404)
+
+    def do_POST(self):
+        body = self._read_body()
+        if self.path.endswith("/generate/text/pop"):
+            self._reply(
+                {
+                    "id": str(uuid.uuid4()),
+                    "payload": {
+                        # A fresh prompt per job, like real traffic, so nothing can be shared between jobs
+                        "prompt": f"{uuid.uuid4()} {self.server.prompt}",
+                        "max_length": 80,
+                        "max_context_length": 1024 * 1024,
+                    },
+                    "skipped": {},
+                },
+            )
+        elif self.path.endswith("/generate/text/submit"):
+            with self.server.mutex:
+                self.server.submitted += 1
+            self._reply({"reward": 1.0})
+        elif self.path.endswith("/chat/completions"):
+            prompt = body["messages"][-1]["content"]
+            self._reply(
+                {
+                    "choices": [{"message": {"content": " ".join(WORDS * 8)}, "finish_reason": "length"}],
+                    "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": 80},
+                },
+            )
+        else:
+            self._reply({"message": "Not found"}, 404)
+
+    def log_message(self, format, *args):  # noqa: A002
+        pass
+
+
+def get_rss():
+    import psutil
+
+    return psutil.Process().memory_info().rss
+
+
+def count_jobs():
+    from worker.jobs.scribe import ScribeHordeJob
+
+    return sum(isinstance(obj, ScribeHordeJob) for obj in gc.get_objects())
+
+
+def measure():
+    gc.collect()
+    return get_rss(), tracemalloc.take_snapshot()
+
+
+def make_worker(server, threads):
+    from worker.bridge_data.scribe import KoboldAIBridgeData
+    from worker.workers.scribe import ScribeWorker
+
+    bridge_data = KoboldAIBridgeData()
+    # The same configuration start_worker.py gives an OpenAI endpoint
+    bridge_data.pin_config(
+        worker_name="soak-worker",
+        api_key="0000000000",
+        horde_url=server.url,
+        max_threads=threads,
+        api_type="openai",
+        openai_api_key="soak",
+        openai_url=f"{server.url}/v1",
+        openai_model=MODEL,
+        model_name=f"soak/{MODEL}",
+        max_context_length=1024 * 1024,
+    )
+    return ScribeWorker(bridge_data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=600, help="Seconds measured after the warmup")
+    parser.add_argument("--warmup", type=float, default=30, help="Seconds to fill caches and pools before the baseline")
+    parser.add_argument("--threads", type=int, default=8, help="Jobs the worker runs at once")
+    parser.add_argument("--prompt-kb", type=int, default=16, help="Size of each prompt")
+    parser.add_argument("--interval", type=float, default=30, help="Seconds between progress reports")
+    parser.add_argument("--rss-budget-mb", type=float, default=20, help="RSS growth allowed after the warmup")
+    parser.add_argument("--traced-budget-mb", type=float, default=5, help="Traced allocation growth allowed")
+    parser.add_argument("--top", type=int, default=15, help="Allocators to list")
+    args = parser.parse_args()
+    # The worker parses the command line on import
+    sys.argv = sys.argv[:1]
+
+    # Keep the state, outbox and latency files of the run away from the real ones, and the metrics port free
+    os.chdir(tempfile.mkdtemp(prefix="bridge-soak-"))
+    os.environ["HORDE_METRICS_PORT"] = "0"
+    os.environ.setdefault("HORDE_SUBMIT_MAX_BACKLOG", str(args.threads * 4))
+
+    from worker.logger import logger
+
+    logger.remove()
+    tracemalloc.start()
+    server = StubServer(args.prompt_kb)
+    threading.Thread(target=server.serve_forever, name="stub-server", daemon=True).start()
+    worker = make_worker(server, args.threads)
+    threading.Thread(target=worker.start, name="soak-worker", daemon=True).start()
+
+    print(f"Warming up for {args.warmup:.0f}s with {args.threads} threads and {args.prompt_kb} KB prompts")
+    time.sleep(args.warmup)
+    baseline_rss, baseline = measure()
+    baseline_jobs = server.submitted
+    started = time.monotonic()
+    print(f"Baseline after {baseline_jobs} jobs: RSS {baseline_rss / 2**20:.1f} MB, {count_jobs()} live jobs")
+
+    peak_rss = baseline_rss
+    while (elapsed := time.monotonic() - started) < args.duration:
+        time.sleep(min(args.interval, args.duration - elapsed))
+        rss = get_rss()
+        peak_rss = max(peak_rss, rss)
+        jobs = server.submitted - baseline_jobs
+        print(
+            f"{time.monotonic() - started:6.0f}s: {jobs} jobs ({jobs / (time.monotonic() - started):.0f}/s), "
+            f"RSS {rss / 2**20:.1f} MB ({(rss - baseline_rss) / 2**20:+.1f}), {count_jobs()} live jobs",
+        )
+
+    # Exits its own thread once stopped
+    worker.should_stop = True
+    final_rss, final = measure()
+    jobs = server.submitted - baseline_jobs
+    rss_growth = (final_rss - baseline_rss) / 2**20
+    stats = final.compare_to(baseline, "lineno")
+    traced_growth = sum(stat.size_diff for stat in stats) / 2**20
+
+    print(f"\nTop {args.top} allocators by growth since the baseline:")
+    for stat in stats[: args.top]:
+        print(f"  {stat}")
+    print(
+        f"\n{jobs} jobs in {args.duration:.0f}s. RSS grew {rss_growth:+.1f} MB "
+        f"(budget {args.rss_budget_mb} MB, peak {peak_rss / 2**20:.1f} MB), "
+        f"traced allocations grew {traced_growth:+.2f} MB (budget {args.traced_budget_mb} MB), "
+        f"{count_jobs()} live jobs",
+    )
+    server.shutdown()
+    if jobs == 0:
+        print("FAIL: no jobs were submitted")
+        return 1
+    if rss_growth > args.rss_budget_mb or traced_growth > args.traced_budget_mb:
+        print("FAIL: memory grew more than its budget")
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
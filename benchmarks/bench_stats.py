@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Benchmark of the per-event cost of the rolling pop and kudos statistics under heavy traffic
+
+"before" replays the previous deque based aggregation, which summed the whole hour of history on every event.
+"after" uses worker.stats.RollingWindow. Time is simulated, so an hour of history at thousands of events
+per second is built up in seconds.
+
+Usage: python benchmarks/bench_stats.py [--rate 2000] [--history 600] [--events 20000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from worker.stats import RollingWindow  # noqa: E402
+
+# Summing the whole history makes each legacy event slow, so we time fewer of them
+LEGACY_MAX_EVENTS = 200
+
+
+class LegacyPopStats:
+    """The aggregation StatsScope.update_pop_stats used to do"""
+
+    def __init__(self):
+        self.pop_record = deque()
+
+    def prefill(self, node, pop_time, now):
+        self.pop_record.append((node, pop_time, now))
+
+    def update(self, node, pop_time, now):
+        self.pop_record.append((node, pop_time, now))
+        too_old = now - 3600
+        while self.pop_record and self.pop_record[0][2] < too_old:
+            self.pop_record.popleft()
+        recent = now - (60 * 5)
+        average_1_hour = sum(poptime for _, poptime, _ in self.pop_record) / len(self.pop_record)
+        data_5_mins = [poptime for _, poptime, when in self.pop_record if when > recent]
+        average_5_mins = sum(data_5_mins) / len(data_5_mins) if data_5_mins else 0
+        return average_5_mins, average_1_hour
+
+
+class RollingPopStats:
+    """The aggregation StatsScope.update_pop_stats does now"""
+
+    def __init__(self):
+        self.pop_times_5_mins = RollingWindow(60 * 5, bucket_seconds=1)
+        self.pop_times_1_hour = RollingWindow(3600, bucket_seconds=60)
+
+    def prefill(self, node, pop_time, now):
+        self.update(node, pop_time, now)
+
+    def update(self, node, pop_time, now):
+        self.pop_times_5_mins.add(pop_time, now)
+        self.pop_times_1_hour.add(pop_time, now)
+        return self.pop_times_5_mins.get_average(now), self.pop_times_1_hour.get_average(now)
+
+
+def run(stats, rate, history, events):
+    """Fills `history` seconds of events at `rate` per second, then times `events` more"""
+    start = time.time() - history
+    tracemalloc.start()
+    for index in range(int(rate * history)):
+        stats.prefill("node", random.uniform(0.1, 2), start + index / rate)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    now = time.time()
+    began = time.perf_counter()
+    for index in range(events):
+        result = stats.update("node", random.uniform(0.1, 2), now + index / rate)
+    elapsed = time.perf_counter() - began
+    return elapsed / events, memory, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=int, default=2000, help="Events per second")
+    parser.add_argument("--history", type=int, default=600, help="Seconds of history to build up before measuring")
+    parser.add_argument("--events", type=int, default=20000, help="Events to time")
+    args = parser.parse_args()
+
+    print(f"{args.rate} events/s with {args.history}s of history:")
+    for label, stats, events in (
+        ("before", LegacyPopStats(), min(args.events, LEGACY_MAX_EVENTS)),
+        ("after", RollingPopStats(), args.events),
+    ):
+        per_event, memory, (average_5_mins, average_1_hour) = run(stats, args.rate, args.history, events)
+        print(
+            f"  {label:<7} {per_event * 1e6:10.1f} µs/event  {per_event and 1 / per_event:12.0f} events/s max  "
+            f"{memory / 1024:9.0f} KiB  (averages: {average_5_mins:.3f} 5 mins, {average_1_hour:.3f} 1 hour)",
+        )
+
+
+if __name__ == "__main__":
+    main()
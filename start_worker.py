@@ -18,6 +18,7 @@ set_worker_env_vars_from_config()  # Get necessary environment variables
 
 from worker.bridge_data.scribe import KoboldAIBridgeData  # noqa: E402
 from worker.logger import logger, quiesce_logger, set_logger_verbosity  # noqa: E402
+from worker.profiler import profiler  # noqa: E402
 from worker.workers.scribe import ScribeWorker  # noqa: E402
 # isort: on
 
@@ -129,32 +130,37 @@ def start_worker(endpoint_config, model_config, global_config):
     bridge_data = KoboldAIBridgeData()
     
     # Set common configuration from global settings
-    bridge_data.worker_name = worker_name
-    bridge_data.api_key = global_config.get('api_key', '')
-    bridge_data.horde_url = global_config.get('horde_url', bridge_data.horde_url)
+    # Pinned values are specific to this worker, so later changes to the top level of bridgeData.yaml leave them alone
+    bridge_data.pin_config(
+        worker_name=worker_name,
+        api_key=global_config.get('api_key', ''),
+        horde_url=global_config.get('horde_url', bridge_data.horde_url),
+    )
     
     # Set worker-specific configuration
-    bridge_data.max_threads = model_config.get('max_threads', 1)
+    bridge_data.pin_config(max_threads=model_config.get('max_threads', 1))
     
     # Set API type
-    bridge_data.api_type = endpoint_type
+    bridge_data.pin_config(api_type=endpoint_type)
     
     # Set length parameters from config
     if 'max_length' in model_config:
-        bridge_data.max_length = int(model_config.get('max_length'))
+        bridge_data.pin_config(max_length=int(model_config.get('max_length')))
     if 'max_context_length' in model_config:
-        bridge_data.max_context_length = int(model_config.get('max_context_length'))
+        bridge_data.pin_config(max_context_length=int(model_config.get('max_context_length')))
     
     # Handle API-specific configuration
     if endpoint_type == 'openai':
         # For OpenAI, configure the endpoints and authentication
-        bridge_data.openai_api_key = endpoint_config.get('api_key', '')
+        bridge_data.pin_config(openai_api_key=endpoint_config.get('api_key', ''))
         if not bridge_data.openai_api_key:
             print(f"ERROR: OpenAI API key is required for endpoint '{endpoint_name}' using OpenAI API type. Skipping workers for this endpoint.")
             return
         
-        bridge_data.openai_url = endpoint_config.get('url', 'https://api.openai.com/v1')
-        bridge_data.openai_model = model_config.get('model', 'gpt-3.5-turbo')
+        bridge_data.pin_config(
+            openai_url=endpoint_config.get('url', 'https://api.openai.com/v1'),
+            openai_model=model_config.get('model', 'gpt-3.5-turbo'),
+        )
         
         # Print a more concise connection message
         domain_prefix = parse_domain_from_url(bridge_data.openai_url)
@@ -169,11 +175,11 @@ def start_worker(endpoint_config, model_config, global_config):
             domain_prefix = "groq"
         
         # Set the model_name with domain prefix
-        bridge_data.model_name = f"{domain_prefix}/{bridge_data.openai_model}"
+        bridge_data.pin_config(model_name=f"{domain_prefix}/{bridge_data.openai_model}")
         
     else:
         # For KoboldAI, set the KAI URL
-        bridge_data.kai_url = endpoint_config.get('url', 'http://localhost:5000')
+        bridge_data.pin_config(kai_url=endpoint_config.get('url', 'http://localhost:5000'))
         
         # Check if the server is available
         if not is_server_available(bridge_data.kai_url):
@@ -285,6 +291,8 @@ def load_configuration(config_path='bridgeData.yaml'):
 def main():
     set_logger_verbosity(args.verbosity)
     quiesce_logger(args.quiet)
+    if os.environ.get("HORDE_PROFILER", "false") == "true":
+        profiler.install()
 
     global_config, endpoints_config = load_configuration()
 
@@ -4,11 +4,14 @@ import random
 import sys
 import threading
 
-import requests
-import yaml
-
+from worker.bridge_data.watcher import config_watcher, copy_value
 from worker.consts import BRIDGE_CONFIG_FILE, BRIDGE_VERSION
+from worker.http_pool import http_pool
 from worker.logger import logger
+from worker.validation_cache import validation_cache
+
+# A user's name doesn't change, so there's no point asking often
+FIND_USER_TTL = 3600
 
 
 class BridgeDataTemplate:
@@ -21,6 +24,9 @@ class BridgeDataTemplate:
         # I have to pass the args from the extended class, as the framework class doesn't
         # know what kind of polymorphism this worker is using
         self.args = args
+        # Values set on this worker specifically, which the configuration file mustn't override
+        self.pinned_config = set()
+        self.config_applied = False
 
         # If there is a YAML config file, load it
         self.load_config()
@@ -57,21 +63,35 @@ class BridgeDataTemplate:
         self.loglevel = os.environ.get("HORDE_LOGLEVEL", "INFO")
 
     def load_config(self):
-        # YAML config
-        if os.path.exists(BRIDGE_CONFIG_FILE):
-            with open(BRIDGE_CONFIG_FILE, "rt", encoding="utf-8", errors="ignore") as configfile:
-                config = yaml.safe_load(configfile)
-                # Map the config's values directly into this instance's properties
-                for key, value in config.items():
-                    setattr(self, key, value)
-            return True  # loaded
-        return None
+        """Applies the whole YAML config, and subscribes to its future changes"""
+        snapshot = config_watcher.subscribe(self)
+        if snapshot is None:
+            return None
+        self.apply_config_changes(snapshot.values)
+        return True  # loaded
+
+    def apply_config_changes(self, changes):
+        """Maps changed config values directly into this instance's properties"""
+        with self.mutex:
+            for key, value in changes.items():
+                if key in self.pinned_config:
+                    continue
+                setattr(self, key, copy_value(value))
+
+    def pin_config(self, **values):
+        """Sets values for this worker only, which changes to the YAML config won't override"""
+        for key, value in values.items():
+            setattr(self, key, value)
+            self.pinned_config.add(key)
 
     @logger.catch(reraise=True)
     def reload_data(self):
         """Reloads configuration data"""
         previous_api_key = self.api_key
-        self.load_config()
+        # Later changes to the file are pushed to us by the config watcher
+        if not self.config_applied:
+            self.load_config()
+            self.config_applied = True
         if self.args.api_key:
             self.api_key = self.args.api_key
         if self.args.worker_name:
@@ -91,18 +111,28 @@ class BridgeDataTemplate:
         self.max_power = max(self.max_power, 2)
         if not self.initialized or previous_api_key != self.api_key:
             try:
-                user_req = requests.get(
-                    f"{self.horde_url}/api/v2/find_user",
-                    headers={"apikey": self.api_key},
-                    timeout=10,
+                # Workers sharing an API key are the same user, so one lookup serves them all
+                user_req = validation_cache.get(
+                    validation_cache.make_key("find_user", self.horde_url, self.api_key),
+                    lambda: self.find_user(),
+                    ttl=FIND_USER_TTL,
                 )
-                user_req = user_req.json()
                 self.username = user_req["username"]
 
             except Exception:
                 logger.warning(f"Server {self.horde_url} error during find_user. Setting username 'N/A'")
                 self.username = "N/A"
 
+    def find_user(self):
+        user_req = http_pool.get(
+            f"{self.horde_url}/api/v2/find_user",
+            read_timeout=10,
+            headers={"apikey": self.api_key},
+        )
+        # Don't remember errors as if they were the user
+        user_req.raise_for_status()
+        return user_req.json()
+
     @logger.catch(reraise=True)
     def check_models(self, model_manager):
         """Check to see if we have the models needed"""
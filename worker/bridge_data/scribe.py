@@ -1,6 +1,7 @@
 """The configuration of the bridge"""
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 
 import requests
@@ -8,6 +9,20 @@ from loguru import logger
 
 from worker.argparser.scribe import args
 from worker.bridge_data.framework import BridgeDataTemplate
+from worker.http_pool import http_pool
+from worker.jobs.payloads import AIPG_TERMS, PayloadPipeline
+from worker.validation_cache import validation_cache
+
+# Backend health checks should never hang the worker
+VALIDATION_TIMEOUT = 10
+# What we ask a KoboldAI client during validation: its model, its soft prompts and the one in use
+KAI_PROBE_ENDPOINTS = (
+    "/api/latest/model",
+    "/api/latest/config/soft_prompts_list",
+)
+# Jobs switch the soft prompt as they need, so it's never cached
+KAI_SOFTPROMPT_ENDPOINT = "/api/latest/config/soft_prompt"
+_probe_executor = ThreadPoolExecutor(max_workers=6, thread_name_prefix="kai-probe")
 
 
 def parse_domain_from_url(url):
@@ -80,6 +95,8 @@ class KoboldAIBridgeData(BridgeDataTemplate):
         self.branded_model = os.environ.get("HORDE_BRANDED_MODEL", "false") == "true"
         self.nsfw = os.environ.get("HORDE_NSFW", "true") == "true"
         self.blacklist = list(filter(lambda a: a, os.environ.get("HORDE_BLACKLIST", "").split(",")))
+        # Prompts longer than the context window are cut from the left instead of being returned to the horde
+        self.truncate_prompts = os.environ.get("HORDE_TRUNCATE_PROMPTS", "true") == "true"
         
         # API type (koboldai or openai)
         self.api_type = "koboldai"
@@ -95,6 +112,10 @@ class KoboldAIBridgeData(BridgeDataTemplate):
         self.openai_url = "https://api.openai.com/v1"
         self.openai_api_key = ""
         self.openai_model = "gpt-3.5-turbo"
+        # Request transformation, which can be tuned from bridgeData.yaml
+        self.aipg_terms = list(AIPG_TERMS)
+        self.model_parameter_rules = {}
+        self.payload_pipeline = None
 
     @logger.catch(reraise=True)
     def reload_data(self):
@@ -149,6 +170,50 @@ class KoboldAIBridgeData(BridgeDataTemplate):
             else:
                 domain_prefix = parse_domain_from_url(self.kai_url)
                 self.model_name = f"{domain_prefix}/{self.model}"
+        self.get_payload_pipeline()
+
+    def get_payload_pipeline(self):
+        """Returns the request transformation for the current configuration, compiling it only when that changed"""
+        signature = PayloadPipeline.get_signature(self.openai_model, self.aipg_terms, self.model_parameter_rules)
+        if self.payload_pipeline is None or self.payload_pipeline.signature != signature:
+            self.payload_pipeline = PayloadPipeline(
+                self.openai_model,
+                aipg_terms=self.aipg_terms,
+                parameter_rules=self.model_parameter_rules,
+            )
+        return self.payload_pipeline
+
+    @property
+    def backend_url(self):
+        """The URL of the backend this worker generates with"""
+        if self.api_type == "openai":
+            return self.openai_url
+        return self.kai_url
+
+    def probe_backend(self):
+        """Cheap check that the backend answers, for the health monitor"""
+        if self.api_type == "openai":
+            url = f"{self.openai_url}/models"
+            headers = {"Authorization": f"Bearer {self.openai_api_key}"}
+        else:
+            url = self.kai_url + "/api/latest/model"
+            headers = {"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
+        return http_pool.get(url, read_timeout=VALIDATION_TIMEOUT, headers=headers).ok
+
+    @staticmethod
+    def _get_json(url, headers):
+        req = http_pool.get(url, read_timeout=VALIDATION_TIMEOUT, headers=headers)
+        logger.debug("Response from {}: [{}] {}", url, req.status_code, req.text)
+        req.raise_for_status()  # raises an error if the status isn't 200
+        return req.json()
+
+    def _probe_kai(self, headers):
+        """Queries the model and the soft prompts list of a KoboldAI client, all at once"""
+        probes = [
+            _probe_executor.submit(self._get_json, self.kai_url + endpoint, headers)
+            for endpoint in KAI_PROBE_ENDPOINTS
+        ]
+        return [probe.result() for probe in probes]
 
     @logger.catch(reraise=True)
     def validate_kai(self):
@@ -159,11 +224,13 @@ class KoboldAIBridgeData(BridgeDataTemplate):
         if self.api_key:
             headers["Authorization"] = f"Bearer {self.api_key}"
         try:
-            # Request the model with authentication headers.
-            req = requests.get(self.kai_url + "/api/latest/model", headers=headers)
-            logger.debug("Response from /api/latest/model: [{}] {}", req.status_code, req.text)
-            req.raise_for_status()  # raises an error if the status isn't 200
-            json_data = req.json()
+            current_softprompt = _probe_executor.submit(self._get_json, self.kai_url + KAI_SOFTPROMPT_ENDPOINT, headers)
+            # Workers sharing a KoboldAI client share the lookup too
+            json_data, sp_data = validation_cache.get(
+                validation_cache.make_key("kai", self.kai_url, self.api_key),
+                lambda: self._probe_kai(headers),
+            )
+            soft_prompt_data = current_softprompt.result()
             logger.debug("JSON decoded: {}", json_data)
             
             if "result" not in json_data:
@@ -181,22 +248,14 @@ class KoboldAIBridgeData(BridgeDataTemplate):
             self.model_name = f"{domain_prefix}/{self.model}"
             logger.debug(f"Set model_name to: {self.model_name}")
             
-            # Retrieve soft prompts list if needed.
+            # Remember the soft prompts list if needed.
             if self.model not in self.softprompts:
-                req = requests.get(self.kai_url + "/api/latest/config/soft_prompts_list", headers=headers)
-                logger.debug("Response from /api/latest/config/soft_prompts_list: [{}] {}", req.status_code, req.text)
-                req.raise_for_status()
-                sp_data = req.json()
                 if "values" in sp_data:
                     self.softprompts[self.model] = [sp["value"] for sp in sp_data["values"]]
                 else:
                     logger.error("Unexpected format for soft_prompts_list: {}", sp_data)
             
-            # Retrieve current soft prompt.
-            req = requests.get(self.kai_url + "/api/latest/config/soft_prompt", headers=headers)
-            logger.debug("Response from /api/latest/config/soft_prompt: [{}] {}", req.status_code, req.text)
-            req.raise_for_status()
-            soft_prompt_data = req.json()
+            # Current soft prompt.
             if "value" not in soft_prompt_data:
                 logger.error("Expected key 'value' not found in soft_prompt response: {}", soft_prompt_data)
                 self.kai_available = False
@@ -239,13 +298,15 @@ class KoboldAIBridgeData(BridgeDataTemplate):
             url = f"{self.openai_url}/models"
             logger.debug(f"Testing OpenAI connection with URL: {url}")
             
-            response = requests.get(url, headers=headers, timeout=10)
-            response.raise_for_status()
+            # Every worker using this endpoint and key gets the same list, so only one of them downloads it
+            models_data = validation_cache.get(
+                validation_cache.make_key("openai_models", url, self.openai_api_key),
+                lambda: self._get_json(url, headers),
+            )
             
             # Check if specified model is valid
             if self.openai_model:
                 model_found = False
-                models_data = response.json()
                 
                 # Log available models for debugging
                 logger.debug(f"OpenAI API returned {len(models_data.get('data', []))} models")
@@ -0,0 +1,146 @@
+"""Watches the configuration file and pushes what changed in it to the workers"""
+import copy
+import hashlib
+import os
+import threading
+import time
+import weakref
+from types import MappingProxyType
+
+import yaml
+
+from worker.consts import BRIDGE_CONFIG_FILE
+from worker.logger import logger
+
+
+def _to_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ("true", "yes", "1", "on")
+    return bool(value)
+
+
+# Keys which are commonly written as strings in the YAML, but which the code expects typed
+CONFIG_TYPES = {
+    "max_threads": int,
+    "queue_size": int,
+    "max_power": int,
+    "max_length": int,
+    "max_context_length": int,
+    "stats_output_frequency": int,
+    "nsfw": _to_bool,
+    "allow_unsafe_ip": _to_bool,
+    "require_upfront_kudos": _to_bool,
+    "disable_terminal_ui": _to_bool,
+}
+
+
+class ConfigSnapshot:
+    """The parsed configuration file at one point in time. Never modified after creation"""
+
+    def __init__(self, config, digest):
+        self.digest = digest
+        values = {}
+        for key, value in (config or {}).items():
+            if key in CONFIG_TYPES and value is not None:
+                try:
+                    value = CONFIG_TYPES[key](value)
+                except (TypeError, ValueError):
+                    logger.warning(f"Ignoring invalid value for '{key}' in {BRIDGE_CONFIG_FILE}: {value!r}")
+                    continue
+            values[key] = value
+        self.values = MappingProxyType(values)
+
+    def diff(self, previous):
+        """Returns the keys which were added or changed since the previous snapshot, with their new values"""
+        if previous is None:
+            return dict(self.values)
+        return {
+            key: value
+            for key, value in self.values.items()
+            if key not in previous.values or previous.values[key] != value
+        }
+
+
+class ConfigWatcher:
+    """One per process. Notices when the configuration file changes, parses it once and
+    tells every subscribed bridge data only about the values which changed
+
+    The file's mtime and size are checked every poll_interval. Only if those changed do we read
+    it, and only if its hash changed do we parse it, so an unchanged configuration costs one stat().
+    """
+
+    def __init__(self, filename, poll_interval=5):
+        self.filename = filename
+        self.poll_interval = poll_interval
+        self.snapshot = None
+        self._file_signature = None
+        self._subscribers = weakref.WeakSet()
+        self._thread = None
+        self._mutex = threading.Lock()
+
+    def subscribe(self, bridge_data):
+        """Registers a bridge data for changes and returns the current snapshot, or None if there is no file"""
+        with self._mutex:
+            if self.snapshot is None:
+                self._check()
+            self._subscribers.add(bridge_data)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._watch, name="config-watcher", daemon=True)
+                self._thread.start()
+            return self.snapshot
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_interval)
+            with self._mutex:
+                previous = self.snapshot
+                if not self._check():
+                    continue
+                changes = self.snapshot.diff(previous)
+                subscribers = list(self._subscribers)
+            if not changes:
+                continue
+            logger.info(f"⚙️ {self.filename} changed: {', '.join(sorted(changes))}")
+            for bridge_data in subscribers:
+                try:
+                    bridge_data.apply_config_changes(changes)
+                except Exception as err:
+                    logger.error("Could not apply configuration changes: {}", err)
+
+    def _check(self):
+        """Loads the file if it changed. Returns True if there's a new snapshot. Must be called with the mutex held"""
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            return False
+        file_signature = (stat.st_mtime_ns, stat.st_size)
+        if file_signature == self._file_signature:
+            return False
+        with open(self.filename, "rb") as configfile:
+            raw = configfile.read()
+        self._file_signature = file_signature
+        digest = hashlib.sha256(raw).hexdigest()
+        if self.snapshot is not None and digest == self.snapshot.digest:
+            # Touched, but not changed
+            return False
+        try:
+            config = yaml.safe_load(raw.decode("utf-8", errors="ignore"))
+        except yaml.YAMLError as err:
+            # Most likely a typo. We'll pick it up again once the file is saved
+            logger.warning(f"Could not parse {self.filename}, keeping the previous configuration: {err}")
+            return False
+        self.snapshot = ConfigSnapshot(config, digest)
+        return True
+
+
+def copy_value(value):
+    """Workers get their own copy of lists and dicts, so they can't modify the snapshot"""
+    if isinstance(value, (list, dict, set)):
+        return copy.deepcopy(value)
+    return value
+
+
+config_watcher = ConfigWatcher(
+    BRIDGE_CONFIG_FILE,
+    poll_interval=float(os.environ.get("HORDE_CONFIG_POLL_INTERVAL", "5")),
+)
@@ -0,0 +1,212 @@
+"""Throttles the bridge under memory and CPU pressure, before the container runs out of memory"""
+import math
+import os
+import threading
+import time
+
+import psutil
+
+from worker import metrics
+from worker.logger import logger
+
+# Past this, a cgroup has no memory limit, it's just the largest value the kernel can hold
+UNLIMITED_BYTES = 2**60
+
+
+def _read_cgroup_file(*paths):
+    for path in paths:
+        try:
+            with open(path, "rt", encoding="utf-8") as cgroup_file:
+                return cgroup_file.read().strip()
+        except OSError:
+            continue
+    return None
+
+
+def detect_memory_limit():
+    """The container's memory limit in bytes, or the host's memory outside of a container"""
+    limit = _read_cgroup_file("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes")
+    if limit and limit.isdigit() and int(limit) < UNLIMITED_BYTES:
+        return int(limit)
+    return psutil.virtual_memory().total
+
+
+def detect_cpu_limit():
+    """How many CPUs the container may use, or the host's CPU count outside of a container"""
+    quota = _read_cgroup_file("/sys/fs/cgroup/cpu.max")
+    if quota:
+        allowed, _, period = quota.partition(" ")
+        if allowed.isdigit() and period.isdigit() and int(period):
+            return int(allowed) / int(period)
+    allowed = _read_cgroup_file("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+    period = _read_cgroup_file("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    if allowed and allowed.isdigit() and period and period.isdigit() and int(period):
+        return int(allowed) / int(period)
+    return float(os.cpu_count() or 1)
+
+
+def _get_scale(usage, soft_limit, hard_limit):
+    """1 below the soft limit, 0 past the hard limit, and in between as usage approaches it"""
+    if usage <= soft_limit:
+        return 1.0
+    if usage >= hard_limit:
+        return 0.0
+    return (hard_limit - usage) / (hard_limit - soft_limit)
+
+
+class ResourceGovernor:
+    """Scales down how much work the bridge takes on as its RSS or CPU use approaches the container's limits
+
+    Every interval, memory and CPU use are each turned into a scale between 1 (no pressure) and 0
+    (at the hard limit), and the lowest one applies to every worker of the process. Prefetched jobs
+    and threads shrink with the scale, and at 0 only idle workers pop. While under memory pressure, we only
+    ask the horde for prompts which fit in the memory we have left, and hand back any job which doesn't.
+    Jobs already running are never touched, finishing them is what frees the memory. Capacity comes back
+    a step per interval once pressure drops, so a garbage collection pass doesn't swing the bridge from
+    idle to full load.
+    """
+
+    # The prompt and the generation are held a few times over at a job's peak:
+    # in the pop, in the backend request, and in their JSON encodings
+    JOB_COPIES = 4
+    BYTES_PER_TOKEN = 4
+
+    def __init__(
+        self,
+        memory_limit=None,
+        cpu_limit=None,
+        memory_soft_limit=0.7,
+        memory_hard_limit=0.9,
+        cpu_soft_limit=0.8,
+        cpu_hard_limit=0.95,
+        interval=2,
+        recovery_step=0.25,
+        min_context_length=1024,
+    ):
+        # No memory limit given detects the container's
+        self.memory_limit = memory_limit or detect_memory_limit()
+        self.cpu_limit = cpu_limit or detect_cpu_limit()
+        self.memory_soft_limit = memory_soft_limit
+        self.memory_hard_limit = memory_hard_limit
+        self.cpu_soft_limit = cpu_soft_limit
+        self.cpu_hard_limit = cpu_hard_limit
+        self.interval = interval
+        self.recovery_step = recovery_step
+        self.min_context_length = min_context_length
+        self.scale = 1.0
+        self.rss = 0
+        self.cpu_utilization = 0.0
+        self._process = psutil.Process()
+        self._thread = None
+        self._mutex = threading.Lock()
+
+    def start(self):
+        with self._mutex:
+            if self._thread is not None:
+                return
+            metrics.governor_memory_limit.set(self.memory_limit)
+            metrics.governor_scale.set(self.scale)
+            # The first reading of cpu_percent() is always 0, it only sets the start of the first measurement
+            self._process.cpu_percent(None)
+            self._thread = threading.Thread(target=self._run, name="resource-governor", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sample()
+            except psutil.Error as err:
+                logger.debug("Could not sample the resource usage: {}", err)
+
+    def sample(self):
+        """Measures the resource usage and adjusts the scale to it"""
+        self.rss = self._process.memory_info().rss
+        self.cpu_utilization = self._process.cpu_percent(None) / 100 / self.cpu_limit
+        metrics.governor_rss.set(self.rss)
+        metrics.governor_cpu_utilization.set(round(self.cpu_utilization, 3))
+        memory_scale = _get_scale(
+            self.rss,
+            self.memory_limit * self.memory_soft_limit,
+            self.memory_limit * self.memory_hard_limit,
+        )
+        cpu_scale = _get_scale(self.cpu_utilization, self.cpu_soft_limit, self.cpu_hard_limit)
+        # In quarters, so that usage hovering around a level doesn't resize the workers on every sample
+        target = math.floor(min(memory_scale, cpu_scale) * 4) / 4
+        previous = self.scale
+        if target < previous:
+            self.scale = target
+        elif target > previous:
+            self.scale = min(target, previous + self.recovery_step)
+        else:
+            return
+        metrics.governor_scale.set(self.scale)
+        cause = "memory" if memory_scale <= cpu_scale else "CPU"
+        if self.scale == 0:
+            self._record("pause")
+            logger.warning(
+                f"🛑 {cause} pressure (RSS {self.rss / 2**20:.0f}/{self.memory_limit / 2**20:.0f} MB, "
+                f"CPU {self.cpu_utilization:.0%}), only popping while idle until it drops",
+            )
+        elif self.scale < previous:
+            self._record("shrink")
+            logger.warning(
+                f"⚠️ {cause} pressure (RSS {self.rss / 2**20:.0f}/{self.memory_limit / 2**20:.0f} MB, "
+                f"CPU {self.cpu_utilization:.0%}), scaling capacity down to {self.scale:.0%}",
+            )
+        elif previous == 0:
+            self._record("resume")
+            logger.info(f"✅ Resource pressure dropped, resuming pops at {self.scale:.0%} capacity")
+        else:
+            self._record("restore")
+            logger.info(f"✅ Resource pressure dropped, restoring capacity to {self.scale:.0%}")
+
+    def _record(self, action):
+        metrics.governor_actions.labels(action).inc()
+
+    def is_paused(self):
+        """True while we're too close to a hard limit to take on more jobs than we already have"""
+        return self.scale <= 0
+
+    def limit_capacity(self, max_threads, queue_size):
+        """The threads and prefetched jobs a worker may use right now, out of those it's configured with"""
+        if self.scale >= 1:
+            return max_threads, queue_size
+        # A thread is always left, so that the jobs we're holding get done and release their memory
+        return max(1, int(max_threads * self.scale)), int(queue_size * self.scale)
+
+    def get_memory_headroom(self):
+        """Bytes left before the hard memory limit"""
+        return max(self.memory_limit * self.memory_hard_limit - self.rss, 0)
+
+    def estimate_job_memory(self, prompt_length, max_length):
+        """Rough bytes a job holds at its peak, from its prompt length in characters and its max tokens"""
+        return self.JOB_COPIES * (prompt_length + max_length * self.BYTES_PER_TOKEN)
+
+    def limit_context_length(self, max_context_length):
+        """The context length we should advertise in our pops, so that the horde only sends prompts that fit"""
+        if self.rss < self.memory_limit * self.memory_soft_limit:
+            return max_context_length
+        fits = int(self.get_memory_headroom() / (self.JOB_COPIES * self.BYTES_PER_TOKEN))
+        limited = max(min(max_context_length, fits), min(self.min_context_length, max_context_length))
+        if limited < max_context_length:
+            self._record("limit_context")
+        return limited
+
+    def admit(self, memory_needed):
+        """False if a popped job would take us past the hard memory limit"""
+        if memory_needed <= self.get_memory_headroom():
+            return True
+        self._record("reject_job")
+        return False
+
+
+resource_governor = ResourceGovernor(
+    memory_limit=int(os.environ.get("HORDE_MEMORY_LIMIT_MB", "0")) * 2**20,
+    cpu_limit=float(os.environ.get("HORDE_CPU_LIMIT", "0")),
+    memory_soft_limit=float(os.environ.get("HORDE_MEMORY_SOFT_LIMIT", "0.7")),
+    memory_hard_limit=float(os.environ.get("HORDE_MEMORY_HARD_LIMIT", "0.9")),
+    cpu_soft_limit=float(os.environ.get("HORDE_CPU_SOFT_LIMIT", "0.8")),
+    cpu_hard_limit=float(os.environ.get("HORDE_CPU_HARD_LIMIT", "0.95")),
+    interval=float(os.environ.get("HORDE_GOVERNOR_INTERVAL", "2")),
+)
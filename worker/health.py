@@ -0,0 +1,153 @@
+"""Shared view of which generation backends are healthy, so that workers stop popping jobs they can't serve"""
+import os
+import threading
+import time
+
+from worker import metrics
+from worker.http_pool import HttpClientPool
+from worker.logger import logger
+from worker.stats import bridge_stats
+
+
+class BackendHealth:
+    """Health of one backend, fed by the results of real jobs and by active probes"""
+
+    def __init__(self, url, probe=None):
+        self.url = url
+        self.probe = probe
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.last_failure_reason = None
+        self.timeouts = 0
+        self.changed = time.monotonic()
+        self.last_probe = time.monotonic()
+        self.listeners = []
+
+    def get_stats(self):
+        return {
+            "healthy": self.healthy,
+            "consecutive_failures": self.consecutive_failures,
+            "last_failure_reason": self.last_failure_reason,
+            "timeouts": self.timeouts,
+            "state_age": round(time.monotonic() - self.changed, 1),
+        }
+
+
+class HealthMonitor:
+    """One health state per backend endpoint, shared by every worker using it
+
+    Jobs report their successes and failures (connection errors and 5xx responses) as they happen,
+    so that the first worker noticing an outage takes every worker on that backend out of the pop
+    rotation. Timeouts are only counted, a slow job isn't an outage. While a backend is down it's
+    probed every probe_interval, and every worker resumes popping as soon as a probe succeeds.
+    Healthy backends are probed every check_interval, to notice outages even when idle.
+    """
+
+    def __init__(self, failure_threshold=3, probe_interval=2, check_interval=30):
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.check_interval = check_interval
+        self._backends = {}
+        self._thread = None
+        self._mutex = threading.Lock()
+
+    def _get(self, url):
+        """Must be called with the mutex held"""
+        endpoint = HttpClientPool.get_endpoint(url)
+        backend = self._backends.get(endpoint)
+        if backend is None:
+            backend = self._backends[endpoint] = BackendHealth(endpoint)
+        return backend
+
+    def register(self, url, probe=None, listener=None):
+        """Starts watching a backend. probe() should return True if the backend can serve requests.
+        listener() is called whenever the backend recovers"""
+        with self._mutex:
+            backend = self._get(url)
+            # Workers sharing a backend share one probe
+            if probe is not None and backend.probe is None:
+                backend.probe = probe
+            if listener is not None:
+                backend.listeners.append(listener)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._probe_loop, name="health-monitor", daemon=True)
+                self._thread.start()
+
+    def is_healthy(self, url):
+        backend = self._backends.get(HttpClientPool.get_endpoint(url))
+        return backend is None or backend.healthy
+
+    def record_success(self, url):
+        with self._mutex:
+            backend = self._get(url)
+            backend.consecutive_failures = 0
+            if backend.healthy:
+                return
+            self._set_state(backend, True)
+            listeners = list(backend.listeners)
+        for listener in listeners:
+            listener()
+
+    def record_failure(self, url, reason):
+        with self._mutex:
+            backend = self._get(url)
+            backend.consecutive_failures += 1
+            backend.last_failure_reason = reason
+            if backend.healthy and backend.consecutive_failures >= self.failure_threshold:
+                self._set_state(backend, False)
+            else:
+                self._report(backend)
+
+    def record_timeout(self, url):
+        """A generation which took too long. Long prompts and busy backends do that, so it's not an outage"""
+        with self._mutex:
+            backend = self._get(url)
+            backend.timeouts += 1
+            self._report(backend)
+        metrics.backend_timeouts.labels(backend.url).inc()
+
+    def _set_state(self, backend, healthy):
+        """Must be called with the mutex held"""
+        backend.healthy = healthy
+        backend.changed = time.monotonic()
+        if healthy:
+            logger.info(f"💚 Backend {backend.url} recovered, resuming jobs")
+        else:
+            logger.warning(
+                f"💔 Backend {backend.url} is failing ({backend.last_failure_reason}), "
+                "pausing jobs for it until it recovers",
+            )
+        self._report(backend)
+
+    def _report(self, backend):
+        bridge_stats.endpoint(backend.url).update_backend_health(backend.get_stats())
+
+    def _probe_loop(self):
+        while True:
+            time.sleep(min(self.probe_interval, self.check_interval))
+            now = time.monotonic()
+            with self._mutex:
+                due = [
+                    backend
+                    for backend in self._backends.values()
+                    if backend.probe is not None
+                    and now - backend.last_probe >= (self.check_interval if backend.healthy else self.probe_interval)
+                ]
+            for backend in due:
+                backend.last_probe = now
+                try:
+                    ok = backend.probe()
+                except Exception as err:
+                    logger.debug("Health probe of {} failed: {}", backend.url, err)
+                    ok = False
+                if ok:
+                    self.record_success(backend.url)
+                else:
+                    self.record_failure(backend.url, "health probe failed")
+
+
+health_monitor = HealthMonitor(
+    failure_threshold=int(os.environ.get("HORDE_HEALTH_FAILURE_THRESHOLD", "3")),
+    probe_interval=float(os.environ.get("HORDE_HEALTH_PROBE_INTERVAL", "2")),
+    check_interval=float(os.environ.get("HORDE_HEALTH_CHECK_INTERVAL", "30")),
+)
@@ -0,0 +1,220 @@
+"""Shared, keep-alive HTTP clients for the horde and the generation backends"""
+import os
+import socket
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from worker.logger import logger
+from worker.stats import bridge_stats
+
+
+class CachingResolver:
+    """Caches the address of each host the pool connects to, for a short while
+
+    Every new connection otherwise pays for a DNS lookup, which adds up when a burst of jobs opens
+    several connections to the same backend at once. Only the pool's own connections use it,
+    the rest of the process resolves names as usual.
+    """
+
+    def __init__(self, ttl, max_entries=256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._cache = {}
+        self._mutex = threading.Lock()
+
+    def resolve(self, host, port):
+        """Returns the address to connect to for host, from the cache while it's fresh"""
+        key = (host, port)
+        now = time.monotonic()
+        with self._mutex:
+            cached = self._cache.get(key)
+            if cached and cached[0] > now:
+                return cached[1]
+        address = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0][4][0]
+        with self._mutex:
+            if key not in self._cache and len(self._cache) >= self.max_entries:
+                for expired in [cached_key for cached_key, (expiry, _) in self._cache.items() if expiry <= now]:
+                    del self._cache[expired]
+                if len(self._cache) >= self.max_entries:
+                    # Still full of live entries, so the oldest one goes
+                    del self._cache[next(iter(self._cache))]
+            self._cache[key] = (now + self.ttl, address)
+        return address
+
+    def forget(self, host, port):
+        """Drops a cached address which we couldn't connect to, so the next connection looks it up again"""
+        with self._mutex:
+            self._cache.pop((host, port), None)
+
+
+def _make_caching_pool_class(pool_class, resolver):
+    """A urllib3 connection pool class whose connections resolve their host through resolver"""
+
+    class CachingConnection(pool_class.ConnectionCls):
+        def _new_conn(self):
+            host = self._dns_host
+            # The TLS handshake happens after this returns, so it still checks the certificate against the name
+            self._dns_host = resolver.resolve(host, self.port)
+            try:
+                return super()._new_conn()
+            except Exception:
+                # urllib3 wraps the socket errors in its own exceptions
+                resolver.forget(host, self.port)
+                raise
+            finally:
+                self._dns_host = host
+
+    return type(pool_class.__name__, (pool_class,), {"ConnectionCls": CachingConnection})
+
+
+class CachingDNSAdapter(HTTPAdapter):
+    """An HTTPAdapter whose connections use a CachingResolver"""
+
+    def __init__(self, resolver, **kwargs):
+        self.resolver = resolver
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        if self.resolver is None:
+            return
+        # Built from the current pool classes, which HTTP/2 may have replaced
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: _make_caching_pool_class(pool_class, self.resolver)
+            for scheme, pool_class in self.poolmanager.pool_classes_by_scheme.items()
+        }
+
+
+class HttpClientPool:
+    """One keep-alive requests.Session per endpoint (scheme + host), shared by every model using it
+
+    Reusing connections means we only pay for the TCP and TLS handshakes once per connection,
+    instead of once per request.
+    """
+
+    def __init__(self, pool_size=32, connect_timeout=5, dns_cache_ttl=60, http2=False):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.http2 = http2
+        self._sessions = {}
+        self._in_flight = {}
+        self._peak_in_flight = {}
+        self._initialized = False
+        self._resolver = CachingResolver(dns_cache_ttl) if dns_cache_ttl > 0 else None
+        self._mutex = threading.Lock()
+
+    @staticmethod
+    def get_endpoint(url):
+        parsed_url = urlparse(url)
+        return f"{parsed_url.scheme}://{parsed_url.netloc}"
+
+    def _initialize(self):
+        """Process-wide tweaks, applied once before the first connection is made"""
+        self._initialized = True
+        if self.http2:
+            try:
+                import urllib3.http2
+
+                urllib3.http2.inject_into_urllib3()
+                logger.debug("HTTP/2 enabled for backend connections")
+            except ImportError:
+                logger.warning("HTTP/2 requested but urllib3>=2.3 and h2 are not installed. Using HTTP/1.1")
+
+    def get_session(self, url):
+        """Returns the shared session for the endpoint serving this url"""
+        endpoint = self.get_endpoint(url)
+        with self._mutex:
+            if not self._initialized:
+                self._initialize()
+            session = self._sessions.get(endpoint)
+            if session is None:
+                session = requests.Session()
+                # We retry on our own terms in worker.retry, so urllib3 shouldn't retry behind our back
+                adapter = CachingDNSAdapter(
+                    self._resolver,
+                    pool_connections=1,
+                    pool_maxsize=self.pool_size,
+                    max_retries=0,
+                )
+                session.mount(f"{endpoint}/", adapter)
+                self._sessions[endpoint] = session
+                self._in_flight[endpoint] = 0
+                self._peak_in_flight[endpoint] = 0
+            return session
+
+    def request(self, method, url, read_timeout, total_timeout=None, connect_timeout=None, **kwargs):
+        """Sends a request through the endpoint's shared session
+
+        read_timeout is the longest we'll wait between bytes from the server, while total_timeout caps
+        the whole request including the body download, which requests can't do on its own.
+        """
+        session = self.get_session(url)
+        endpoint = self.get_endpoint(url)
+        timeout = (connect_timeout or self.connect_timeout, read_timeout)
+        deadline = time.monotonic() + total_timeout if total_timeout else None
+        with self._mutex:
+            self._in_flight[endpoint] += 1
+            self._peak_in_flight[endpoint] = max(self._peak_in_flight[endpoint], self._in_flight[endpoint])
+        try:
+            response = session.request(method, url, timeout=timeout, stream=deadline is not None, **kwargs)
+            if deadline is not None:
+                chunks = []
+                for chunk in response.iter_content(chunk_size=65536):
+                    chunks.append(chunk)
+                    if time.monotonic() > deadline:
+                        response.close()
+                        raise requests.exceptions.ReadTimeout(f"Request to {url} exceeded {total_timeout}s total")
+                response._content = b"".join(chunks)
+            return response
+        finally:
+            with self._mutex:
+                self._in_flight[endpoint] -= 1
+            self.report_stats(endpoint)
+
+    def post(self, url, read_timeout, **kwargs):
+        return self.request("POST", url, read_timeout, **kwargs)
+
+    def get(self, url, read_timeout, **kwargs):
+        return self.request("GET", url, read_timeout, **kwargs)
+
+    def put(self, url, read_timeout, **kwargs):
+        return self.request("PUT", url, read_timeout, **kwargs)
+
+    def get_pool_stats(self, endpoint):
+        """Returns how busy the connection pool for an endpoint is"""
+        session = self._sessions.get(endpoint)
+        connections = 0
+        requests_sent = 0
+        if session is not None:
+            adapter = session.get_adapter(f"{endpoint}/")
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                connections += pool.num_connections
+                requests_sent += pool.num_requests
+        return {
+            "in_flight": self._in_flight.get(endpoint, 0),
+            "peak_in_flight": self._peak_in_flight.get(endpoint, 0),
+            "pool_size": self.pool_size,
+            "utilization": round(self._in_flight.get(endpoint, 0) / self.pool_size, 2),
+            "connections_opened": connections,
+            "requests": requests_sent,
+        }
+
+    def report_stats(self, endpoint):
+        bridge_stats.endpoint(endpoint).update_http_pool_stats(self.get_pool_stats(endpoint))
+
+
+http_pool = HttpClientPool(
+    pool_size=int(os.environ.get("HORDE_HTTP_POOL_SIZE", "32")),
+    connect_timeout=float(os.environ.get("HORDE_HTTP_CONNECT_TIMEOUT", "5")),
+    dns_cache_ttl=int(os.environ.get("HORDE_DNS_CACHE_TTL", "60")),
+    http2=os.environ.get("HORDE_HTTP2", "false") == "true",
+)
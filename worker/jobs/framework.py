@@ -3,33 +3,67 @@ import contextlib
 import copy
 import json
 import sys
-import threading
 import time
 
 import requests
 
+from worker import metrics
 from worker.enums import JobStatus
+from worker.http_pool import http_pool
 from worker.logger import logger
+from worker.outbox import submit_outbox
+from worker.jobs.submitter import submit_pool
+from worker.retry import RETRYABLE_STATUS_CODES, RetryPolicy
+from worker.tracing import tracer
+from worker.utils import json_codec
 
 
 class HordeJobFramework:
-    """Get and process a job from the horde"""
+    """Get and process a job from the horde
+
+    Jobs pile up while the horde or the backends are slow, so their state lives in slots rather than
+    an instance dict, and the buffers they carry are dropped as soon as the job is done with them:
+    the inputs once the submit payload is encoded, and the submit payload once it has been submitted.
+    """
+
+    __slots__ = (
+        "model_manager",
+        "bridge_data",
+        "pop",
+        "status",
+        "start_time",
+        "process_time",
+        "stale_time",
+        "max_runtime",
+        "queued_at",
+        "submit_dict",
+        "submit_data",
+        "out_of_memory",
+        "trace",
+    )
 
     retry_interval = 1
+    # Jobs running longer than this after being popped are always considered stale
+    default_max_runtime = 1200
+    # Where finished jobs are submitted to on the horde, set by the extending classes
+    submit_endpoint = None
 
     def __init__(self, mm, bd, pop):
         self.model_manager = mm
         # Make a shallow copy of bridge data instead of deep copy to save memory
         self.bridge_data = bd
         self.pop = pop
-        self.loop_retry = 0
         self.status = JobStatus.INIT
         self.start_time = time.time()
         self.process_time = time.time()
         self.stale_time = None
+        self.max_runtime = self.default_max_runtime
+        # Set again by the worker when the job is queued
+        self.queued_at = time.monotonic()
         self.submit_dict = {}
-        self.headers = {"apikey": self.bridge_data.api_key}
+        self.submit_data = None
         self.out_of_memory = False
+        self.trace = tracer.start_trace(pop.get("id") if pop else None, model=getattr(bd, "model", None))
 
     def is_finished(self):
         """Check if the job is finished"""
@@ -45,7 +79,7 @@ class HordeJobFramework:
 
     def is_stale(self):
         """Check if the job is stale"""
-        if time.time() - self.start_time > 1200:
+        if time.time() - self.start_time > self.max_runtime:
             return True
         if not self.stale_time:
             return False
@@ -59,6 +93,15 @@ class HordeJobFramework:
         """Check if the job is faulted"""
         return self.status in [JobStatus.FAULTED, JobStatus.FINALIZING_FAULTED, JobStatus.DONE_FAULTED]
 
+    def fault(self, reason):
+        """Marks the job as failed, and counts why"""
+        self.status = JobStatus.FAULTED
+        metrics.job_faults.labels(getattr(self.bridge_data, "model", None), reason).inc()
+
+    def get_memory_footprint(self):
+        """Rough bytes the job will hold at its peak, set by the extending classes"""
+        return 0
+
     def is_out_of_memory(self):
         """Check if the job is out of memory"""
         return self.out_of_memory
@@ -75,99 +118,118 @@ class HordeJobFramework:
             self.submit_dict = {"success": True}
         except Exception as e:
             logger.error("Error while working: {}", e)
-            self.status = JobStatus.FAULTED
+            self.fault("exception")
             if "out of memory" in str(e).lower():
                 self.out_of_memory = True
 
-    def start_submit_thread(self):
-        """Start a thread to submit the job"""
+    def queue_submit(self):
+        """Hand the job over to the submit pool"""
         if not hasattr(self, 'current_id'):
             logger.error("Job missing current_id, cannot submit")
             return
         
-        # Ensure we have a valid ID before starting submission thread
-        if self.status == JobStatus.FAULTED and not hasattr(self, 'submit_dict'):
-            self.prepare_submit_payload()
-        
-        # Start the submission thread
-        submit_thread = threading.Thread(target=self.submit_job)
-        submit_thread.daemon = True
-        submit_thread.start()
-
-    def submit_job(self, endpoint):
-        """Submit a job to the API"""
+        self.trace.begin("submit_queue")
+        self.prepare_submit_data()
+        self.release_inputs()
+        # Persist the generation before anything can go wrong with the submission
+        if not self.is_faulted():
+            submit_outbox.add(
+                self.current_id,
+                self.bridge_data.worker_name,
+                f"{self.bridge_data.horde_url}{self.submit_endpoint}",
+                self.submit_data,
+            )
+        submit_pool.submit(self)
+
+    def prepare_submit_data(self):
+        """Prepares the encoded submit payload, once"""
+        if self.submit_data is not None:
+            return
         self.prepare_submit_payload()
         if self.status in [JobStatus.FAULTED, JobStatus.FINALIZING_FAULTED]:
             self.submit_dict = {"success": False, "state": "faulted"}
+        self.submit_data = json_codec.dumps(self.submit_dict)
 
-        with requests.Session() as s:
-            s.headers.update(self.headers)
-            # Always a good idea to set a timeout in case the horde is down
-            while True:
-                try:
-                    submit_req = s.post(
-                        f"{self.bridge_data.horde_url}{endpoint}",
-                        json=self.submit_dict,
-                        timeout=30,
-                    )
-                    if submit_req.status_code in [502, 503, 408, 500]:
-                        self.loop_retry += 1
-                        if self.loop_retry > 3:
-                            logger.error(
-                                f"Could not submit job after 3 retries: "
-                                f"{submit_req.status_code=}, {submit_req.text=}",
-                            )
-                            if self.status in [JobStatus.FINALIZING, JobStatus.FINALIZING_FAULTED]:
-                                self.status = JobStatus.DONE_FAULTED
-                            else:
-                                self.status = JobStatus.FAULTED
-                            return
-                        time.sleep(self.retry_interval)
-                        continue
-                    self.loop_retry = 0
-                    if submit_req.status_code == 404:
-                        logger.warning(f"Job already submitted {submit_req.text=}")
-                        # This will happen if the server already has this job submitted
-                        if self.status in [JobStatus.FINALIZING, JobStatus.FINALIZING_FAULTED]:
-                            self.status = JobStatus.DONE
-                        return
-                    if not submit_req.ok:
-                        logger.warning(
-                            f"Failed to submit job. "
-                            f"{submit_req.status_code=}, {submit_req.text=}, {self.status=}"
+    def release_inputs(self):
+        """Drops the pop and what was generated from it. Once the submit payload is encoded, nothing reads them"""
+        self.pop = None
+        self.submit_dict = {}
+
+    def release_submission(self):
+        """Drops the submit payload, once the horde has it or the outbox kept it for later"""
+        self.submit_data = None
+
+    def submit_job(self, endpoint=None):
+        """Submit a job to the API"""
+        self.trace.begin("submit")
+        self.prepare_submit_data()
+        job_id = getattr(self, 'current_id', None)
+
+        retry = RetryPolicy("Submit", max_attempts=4, base_delay=self.retry_interval)
+        headers = {"apikey": self.bridge_data.api_key, **json_codec.JSON_HEADERS}
+        submit_url = f"{self.bridge_data.horde_url}{endpoint or self.submit_endpoint}"
+        # Always a good idea to set a timeout in case the horde is down
+        while True:
+            try:
+                with self.trace.span("horde_submit", attempt=retry.attempts) as span:
+                    submit_req = http_pool.post(submit_url, read_timeout=30, data=self.submit_data, headers=headers)
+                    span.set(status_code=submit_req.status_code)
+                if submit_req.status_code in RETRYABLE_STATUS_CODES:
+                    if not retry.backoff(headers=submit_req.headers, reason=f"status {submit_req.status_code}"):
+                        logger.error(
+                            f"Could not submit job after {retry.attempts} attempts: "
+                            f"{submit_req.status_code=}, {submit_req.text=}. Kept in the outbox for later",
                         )
-                        if self.status in [JobStatus.FINALIZING, JobStatus.FINALIZING_FAULTED]:
-                            self.status = JobStatus.DONE
-                        return
-                    break
-                except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout) as e:
-                    self.loop_retry += 1
-                    if self.loop_retry > 3:
-                        logger.error(f"Retrieving job failed after 3 retries: {e}")
+                        submit_outbox.release(job_id)
+                        metrics.job_faults.labels(getattr(self.bridge_data, "model", None), "submit").inc()
                         if self.status in [JobStatus.FINALIZING, JobStatus.FINALIZING_FAULTED]:
                             self.status = JobStatus.DONE_FAULTED
                         else:
                             self.status = JobStatus.FAULTED
                         return
-                    time.sleep(self.retry_interval)
-
-        submit_json = submit_req.json()
+                    continue
+                if submit_req.status_code == 404:
+                    logger.warning(f"Job already submitted {submit_req.text=}")
+                    submit_outbox.remove(job_id)
+                    # This will happen if the server already has this job submitted
+                    if self.status in [JobStatus.FINALIZING, JobStatus.FINALIZING_FAULTED]:
+                        self.status = JobStatus.DONE
+                    return
+                if not submit_req.ok:
+                    logger.warning(
+                        f"Failed to submit job. "
+                        f"{submit_req.status_code=}, {submit_req.text=}, {self.status=}"
+                    )
+                    # The horde won't change its mind about this one
+                    submit_outbox.remove(job_id)
+                    if self.status in [JobStatus.FINALIZING, JobStatus.FINALIZING_FAULTED]:
+                        self.status = JobStatus.DONE
+                    return
+                break
+            except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout) as e:
+                if not retry.backoff(reason=type(e).__name__):
+                    logger.error(f"Submitting job failed after {retry.attempts} attempts: {e}. Kept in the outbox for later")
+                    submit_outbox.release(job_id)
+                    metrics.job_faults.labels(getattr(self.bridge_data, "model", None), "submit").inc()
+                    if self.status in [JobStatus.FINALIZING, JobStatus.FINALIZING_FAULTED]:
+                        self.status = JobStatus.DONE_FAULTED
+                    else:
+                        self.status = JobStatus.FAULTED
+                    return
+
+        submit_outbox.remove(job_id)
+        submit_json = json_codec.loads_response(submit_req)
         
-        # Mark job as done and clear any unneeded data to help with memory usage
         if self.status in [JobStatus.FINALIZING, JobStatus.FINALIZING_FAULTED]:
             self.status = JobStatus.DONE
         
-        # Help garbage collection by clearing large data
-        self.submit_dict = {}
-        self.pop = None
-        
         # Process any post-submit tasks if needed
-        self.post_submit_tasks(submit_req)
+        self.post_submit_tasks(submit_json)
 
     def prepare_submit_payload(self):
         """Prepare payload for submission"""
         pass
 
-    def post_submit_tasks(self, submit_req):
+    def post_submit_tasks(self, submit_json):
         """Process any post-submit tasks"""
         pass
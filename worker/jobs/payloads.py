@@ -0,0 +1,107 @@
+"""Transformation of horde payloads into backend requests, compiled once per configuration"""
+import sys
+from collections import namedtuple
+
+# Only exact mentions of these terms get the AIPG context injected
+AIPG_TERMS = ("aipg", "ai power grid", "aipowergrid")
+
+AIPG_CONTEXT = sys.intern(
+    """AI Power Grid (AIPG) is a distributed network for AI workloads with native cryptocurrency incentives. Key points:
+
+• Platform: Distributed AI compute network built on AI Horde with workflow engine
+• Tokenomics: 150M max supply
+• Network: P2P port 8865, RPC port 9788, PoW/PoUW consensus
+• Links: aipowergrid.io, explorer.aipowergrid.io, pool.aipowergrid.io
+• Social: @AIPowerGrid (Twitter), t.me/AIPowerGrid (Telegram)
+• Meet founder: https://calendly.com/half-aipowergrid/30min"""
+)
+AIPG_SYSTEM_PROMPT = sys.intern(
+    "You are a helpful assistant with expertise in AI Power Grid (AIPG). "
+    "Provide concise, accurate information about the platform."
+)
+DEFAULT_SYSTEM_PROMPT = sys.intern("You are a helpful assistant.")
+
+# How a model expects its request parameters
+# max_tokens_field: the name of the generation length parameter
+# sampling: whether the model accepts temperature, top_p, stop and the penalties
+ModelParameterRule = namedtuple("ModelParameterRule", ["max_tokens_field", "sampling"])
+DEFAULT_PARAMETER_RULE = ModelParameterRule("max_tokens", True)
+MODEL_PARAMETER_RULES = {
+    # Reasoning models reject max_tokens and the sampling parameters
+    "o1-mini": ModelParameterRule("max_completion_tokens", False),
+}
+
+
+class TermMatcher:
+    """Case-insensitive search for several terms at once
+
+    On CPython, one lowercase copy searched with the C substring search measures several times
+    faster than a re.IGNORECASE alternation, so that's what we do, once per prompt.
+    """
+
+    def __init__(self, terms):
+        # Shortest first, as those are the cheapest to look for
+        self.terms = tuple(sorted({term.lower() for term in terms}, key=len))
+
+    def search(self, text):
+        if not text or not self.terms:
+            return False
+        lowered = text.lower()
+        for term in self.terms:
+            if term in lowered:
+                return True
+        return False
+
+
+class PayloadPipeline:
+    """Turns horde text payloads into OpenAI chat completion requests for one model
+
+    Everything that doesn't depend on the job (matchers, prompts, message templates and the
+    model's parameter mapping) is prepared once here, when the configuration is loaded.
+    """
+
+    def __init__(self, model, aipg_terms=AIPG_TERMS, parameter_rules=None):
+        self.model = model
+        self.matcher = TermMatcher(aipg_terms)
+        rules = dict(MODEL_PARAMETER_RULES)
+        for rule_model, rule in (parameter_rules or {}).items():
+            rules[rule_model] = ModelParameterRule(
+                rule.get("max_tokens_field", DEFAULT_PARAMETER_RULE.max_tokens_field),
+                rule.get("sampling", DEFAULT_PARAMETER_RULE.sampling),
+            )
+        self.parameter_rule = rules.get(model, DEFAULT_PARAMETER_RULE)
+        # These are shared by every request and never modified
+        self.default_system_message = {"role": "system", "content": DEFAULT_SYSTEM_PROMPT}
+        self.aipg_system_message = {"role": "system", "content": AIPG_SYSTEM_PROMPT}
+        self.aipg_prefix = sys.intern(f"{AIPG_CONTEXT}\n\nUser Query: ")
+        self.signature = self.get_signature(model, aipg_terms, parameter_rules)
+
+    @staticmethod
+    def get_signature(model, aipg_terms=AIPG_TERMS, parameter_rules=None):
+        """Identifies the configuration a pipeline was compiled from"""
+        return (model, tuple(aipg_terms), repr(sorted((parameter_rules or {}).items())))
+
+    def transform(self, payload):
+        """Builds the chat completion request for a horde payload"""
+        prompt = payload.get("prompt", "")
+        if self.matcher.search(prompt):
+            system_message = self.aipg_system_message
+            prompt = self.aipg_prefix + prompt
+        else:
+            system_message = self.default_system_message
+        request = {
+            "model": self.model,
+            "messages": [system_message, {"role": "user", "content": prompt}],
+            self.parameter_rule.max_tokens_field: int(payload.get("max_length", 80)),
+        }
+        if not self.parameter_rule.sampling:
+            return request
+        request["temperature"] = float(payload.get("temperature", 0.8))
+        request["top_p"] = float(payload.get("top_p", 0.9))
+        if "stop_sequence" in payload:
+            request["stop"] = payload["stop_sequence"]
+        if "frequency_penalty" in payload:
+            request["frequency_penalty"] = float(payload["frequency_penalty"])
+        if "presence_penalty" in payload:
+            request["presence_penalty"] = float(payload["presence_penalty"])
+        return request
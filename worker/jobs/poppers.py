@@ -1,29 +1,37 @@
 import copy
-import json
 import time
 
 import requests
 
 from worker.consts import BRIDGE_VERSION
+from worker.governor import resource_governor
 from worker.logger import logger
+from worker.retry import RetryPolicy
 from worker.stats import bridge_stats
+from worker.utils import json_codec
 
 # Add a timestamp for rate limiting status messages
 _last_status_update = 0
 _status_counter = 0
-_waiting_start_time = None  # Track when we started waiting for jobs
-_last_job_completed = None  # Track when last job was completed
-_last_job_info = None  # Store information about the last job
+
+def make_pop_retry():
+    """Backoff for one worker's consecutive failed pops.
+    Popping is retried forever by the worker loop, so we don't count attempts or spend the retry budget"""
+    return RetryPolicy("Pop", max_attempts=None, base_delay=2, max_delay=60, budget=None)
+
 
 class JobPopper:
     retry_interval = 1
     BRIDGE_AGENT = f"AI Horde Worker:{BRIDGE_VERSION}:https://github.com/db0/AI-Horde-Worker"
 
-    def __init__(self, mm, bd):
+    def __init__(self, mm, bd, pop_retry=None):
         self.model_manager = mm
         self.bridge_data = copy.deepcopy(bd)
         self.pop = None
-        self.headers = {"apikey": self.bridge_data.api_key}
+        # Poppers only last one pop, so the worker passes in its own policy to back off across them
+        self.pop_retry = pop_retry or make_pop_retry()
+        self.headers = {"apikey": self.bridge_data.api_key, **json_codec.JSON_HEADERS}
+        self.stats = bridge_stats.worker(self.bridge_data.worker_name)
         # This should be set by the extending class
         self.endpoint = None
 
@@ -34,61 +42,59 @@ class JobPopper:
             # logger.debug(self.pop_payload)
             pop_req = requests.post(
                 self.bridge_data.horde_url + self.endpoint,
-                json=self.pop_payload,
+                data=json_codec.dumps(self.pop_payload),
                 headers=self.headers,
                 timeout=40,
             )
             # logger.debug(self.pop_payload)
             node = pop_req.headers.get("horde-node", "unknown")
-            logger.debug(f"Job pop took {pop_req.elapsed.total_seconds()} (node: {node})")
-            bridge_stats.update_pop_stats(node, pop_req.elapsed.total_seconds())
+            logger.debug("Job pop took {} (node: {})", pop_req.elapsed.total_seconds(), node)
+            self.stats.update_pop_stats(node, pop_req.elapsed.total_seconds())
         except requests.exceptions.ConnectionError:
-            logger.warning(f"Server {self.bridge_data.horde_url} unavailable during pop. Waiting 10 seconds...")
-            time.sleep(10)
+            logger.warning(f"Server {self.bridge_data.horde_url} unavailable during pop.")
+            self.pop_retry.backoff(min_delay=10, reason="connection error during pop")
             return None
         except TypeError:
-            logger.warning(f"Server {self.bridge_data.horde_url} unavailable during pop. Waiting 2 seconds...")
-            time.sleep(2)
+            logger.warning(f"Server {self.bridge_data.horde_url} unavailable during pop.")
+            self.pop_retry.backoff(reason="horde unavailable during pop")
             return None
         except requests.exceptions.ReadTimeout:
-            logger.warning(f"Server {self.bridge_data.horde_url} timed out during pop. Waiting 2 seconds...")
-            time.sleep(2)
+            logger.warning(f"Server {self.bridge_data.horde_url} timed out during pop.")
+            self.pop_retry.backoff(reason="timeout during pop")
             return None
         except requests.exceptions.InvalidHeader:
             logger.warning(
                 f"Server {self.bridge_data.horde_url} Something is wrong with the API key you are sending. "
-                "Please check your bridgeData api_key variable. Waiting 10 seconds...",
+                "Please check your bridgeData api_key variable.",
             )
-            time.sleep(10)
+            self.pop_retry.backoff(min_delay=10, reason="invalid header during pop")
             return None
 
         try:
-            self.pop = pop_req.json()  # I'll use it properly later
-        except json.decoder.JSONDecodeError:
+            self.pop = json_codec.loads_response(pop_req)  # I'll use it properly later
+        except json_codec.JSONDecodeError:
             logger.error(
                 f"Could not decode response from {self.bridge_data.horde_url} as json. "
                 "Please inform its administrator!",
             )
-            time.sleep(2)
+            self.pop_retry.backoff(headers=pop_req.headers, reason="invalid json during pop")
             return None
         if not pop_req.ok:
             logger.warning(f"{self.pop['message']} ({pop_req.status_code})")
             if "errors" in self.pop:
                 logger.warning(f"Detailed Request Errors: {self.pop['errors']}")
-            time.sleep(2)
+            self.pop_retry.backoff(headers=pop_req.headers, reason=f"status {pop_req.status_code} during pop")
             return None
+        self.pop_retry.reset()
+        self.stats.record_pop_success()
         return [self.pop]
 
     def report_skipped_info(self, reason):
         """Report why we skipped a job"""
-        global _last_status_update, _status_counter, _waiting_start_time, _last_job_completed, _last_job_info
+        global _last_status_update, _status_counter
         
         current_time = time.time()
         
-        # Initialize waiting start time if this is our first check
-        if _waiting_start_time is None:
-            _waiting_start_time = current_time
-        
         # Only show status updates every 5 seconds
         if current_time - _last_status_update < 5:
             _status_counter += 1
@@ -97,12 +103,13 @@ class JobPopper:
         # Get worker count - this shows active inference threads
         worker_count = len(self.bridge_data.get_running_models()) if hasattr(self.bridge_data, 'get_running_models') else 0
         
-        # Get stats from bridge_stats
+        # Get stats from bridge_stats, added up across all workers
+        totals = bridge_stats.get_totals()
         stats_parts = []
         
         # Add kudos per hour if available
-        if "kudos_per_hour" in bridge_stats.stats:
-            kudos_val = bridge_stats.stats['kudos_per_hour']
+        if "kudos_per_hour" in totals:
+            kudos_val = totals['kudos_per_hour']
             # Format kudos value - if over 1000, use K format
             if kudos_val >= 1000:
                 kudos_str = f"{kudos_val/1000:.1f}K"
@@ -112,8 +119,8 @@ class JobPopper:
             stats_parts.append(f"🌟{kudos_str:<6} kudos/hr")
         
         # Add jobs per hour if available
-        if "jobs_per_hour" in bridge_stats.stats:
-            jobs_val = bridge_stats.stats['jobs_per_hour']
+        if "jobs_per_hour" in totals:
+            jobs_val = totals['jobs_per_hour']
             # Format jobs value - if over 1000, use K format
             if jobs_val >= 1000:
                 jobs_str = f"{jobs_val/1000:.1f}K"
@@ -122,19 +129,24 @@ class JobPopper:
             # Add jobs with extra spacing for growing numbers
             stats_parts.append(f"🔄 {jobs_str:<6} jobs/hr")
         
+        # Tail latency of the generations, which is what makes jobs go stale
+        generation_latency = totals["latency"].get("generation")
+        if generation_latency:
+            stats_parts.append(f"⏱️ p50 {generation_latency['p50']:.1f}s p99 {generation_latency['p99']:.1f}s")
+        
         # Show time since last job if we have that info
         last_job_str = ""
-        if _last_job_completed is not None:
-            time_since_job = current_time - _last_job_completed
+        last_job = totals.get("last_job")
+        if last_job is not None:
+            time_since_job = current_time - last_job['completed']
             last_job_str = f"⏱️ Last job: {self._format_time_period(time_since_job)} ago"
             
             # Add kudos from last job if available
-            if _last_job_info and 'kudos' in _last_job_info:
-                last_job_str += f" ({_last_job_info['kudos']} kudos)"
+            last_job_str += f" ({last_job['kudos']} kudos)"
                 
             # Add model from last job if available
-            if _last_job_info and 'model' in _last_job_info:
-                model_name = _last_job_info['model']
+            if last_job['model']:
+                model_name = last_job['model']
                 # Truncate model name if too long
                 if len(model_name) > 15:
                     model_name = model_name[:12] + "..."
@@ -190,8 +202,8 @@ class JobPopper:
 
 
 class ScribePopper(JobPopper):
-    def __init__(self, mm, bd):
-        super().__init__(mm, bd)
+    def __init__(self, mm, bd, pop_retry=None):
+        super().__init__(mm, bd, pop_retry)
         self.endpoint = "/api/v2/generate/text/pop"
         
         # For both OpenAI and KoboldAI, use the model_name from bridge_data
@@ -212,7 +224,8 @@ class ScribePopper(JobPopper):
             "name": self.bridge_data.worker_name,
             "models": self.available_models,
             "max_length": self.bridge_data.max_length,
-            "max_context_length": self.bridge_data.max_context_length,
+            # Under memory pressure, we only ask for prompts we have room for
+            "max_context_length": resource_governor.limit_context_length(self.bridge_data.max_context_length),
             "priority_usernames": self.bridge_data.priority_usernames,
             "threads": self.bridge_data.max_threads,
             "bridge_agent": self.BRIDGE_AGENT,
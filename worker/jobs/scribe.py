@@ -13,15 +13,44 @@ import requests
 
 from worker.consts import BRIDGE_VERSION
 from worker.enums import JobStatus
+from worker.governor import resource_governor
+from worker.health import health_monitor
+from worker.http_pool import http_pool
 from worker.jobs.framework import HordeJobFramework
-from worker.jobs.poppers import _last_job_completed, _last_job_info, _waiting_start_time
+from worker.latency import latency_model
 from worker.logger import logger
+from worker.retry import RetryPolicy
 from worker.stats import bridge_stats
+from worker.tokens import estimate_tokens, get_usage, token_estimator
+from worker.utils import json_codec
 
 
 class ScribeHordeJob(HordeJobFramework):
     """Process a scribe job from the horde"""
 
+    __slots__ = (
+        "current_model",
+        "seed",
+        "text",
+        "current_id",
+        "current_payload",
+        "requested_softprompt",
+        "censored",
+        "max_seconds",
+        "prompt_tokens",
+        "completion_tokens",
+        "ttft",
+        "generation_time",
+    )
+
+    # Gives the HTTP timeout a chance to fire before the worker declares the job stale
+    STALE_GRACE_SECONDS = 5
+    # Room for the system prompt, AIPG context and chat template the OpenAI path wraps the prompt in
+    CHAT_OVERHEAD_TOKENS = 200
+    CALIBRATION_MIN_TOKENS = 1000
+    VALIDATION_TIMEOUT = 10
+    submit_endpoint = "/api/v2/generate/text/submit"
+
     def __init__(self, mm, bd, pop):
         # mm will always be None for the scribe
         super().__init__(mm, bd, pop)
@@ -38,12 +67,31 @@ class ScribeHordeJob(HordeJobFramework):
         self.current_payload = self.pop["payload"]
         self.current_payload["quiet"] = True
         self.requested_softprompt = self.current_payload.get("softprompt")
+        # We keep what we need from the pop, the rest of it is dead weight while the job waits
+        self.pop = None
         self.censored = None
         self.max_seconds = None
+        # Token accounting, filled in from the backend's usage data when it reports any
+        self.prompt_tokens = None
+        self.completion_tokens = None
+        self.ttft = None
+        self.generation_time = None
+
+    @property
+    def backend_url(self):
+        """The URL of the backend serving this job"""
+        return self.bridge_data.backend_url
+
+    def get_memory_footprint(self):
+        return resource_governor.estimate_job_memory(
+            len(self.current_payload.get("prompt") or ""),
+            self.current_payload.get("max_length", 80),
+        )
 
     @logger.catch(reraise=True)
     def start_job(self):
         """Starts a Scribe job from a pop request"""
+        self.trace.begin("preparing")
         # Format with consistent width
         job_id = self.current_id[:8]
         model_name = self.current_model
@@ -69,11 +117,20 @@ class ScribeHordeJob(HordeJobFramework):
         
         super().start_job()
         if self.status == JobStatus.FAULTED:
-            self.start_submit_thread()
+            self.queue_submit()
             return
         # we also re-use this for the https timeout to llm inference
-        self.max_seconds = (self.current_payload.get("max_length", 80) / 2) + 10
-        self.stale_time = time.time() + self.max_seconds
+        # Until we've learned how fast this backend/model is, we fall back to a generous guess
+        max_length = self.current_payload.get("max_length", 80)
+        self.max_seconds = latency_model.get_timeout(
+            self.backend_url,
+            self.current_model,
+            max_length,
+            default=(max_length / 2) + 10,
+        )
+        self.stale_time = time.time() + self.max_seconds + self.STALE_GRACE_SECONDS
+        # Slow backends may legitimately need longer than the default safety net
+        self.max_runtime = max(self.max_runtime, time.time() - self.start_time + self.max_seconds * 2)
         # These params will always exist in the payload from the horde
         gen_payload = self.current_payload
         if "width" in gen_payload or "length" in gen_payload or "steps" in gen_payload:
@@ -81,25 +138,50 @@ class ScribeHordeJob(HordeJobFramework):
             error_col = f"{error_info:<21}"
             error_type_col = f"Text-only worker{'':<4}"  # Adjusted width for alignment
             logger.error(f"{error_col}| {error_type_col}| Aborting")
-            self.status = JobStatus.FAULTED
-            self.start_submit_thread()
+            self.fault("image_payload")
+            self.queue_submit()
+            return
+        if not self.preflight():
+            self.fault("preflight")
+            self.queue_submit()
             return
         
         try:
             prompt_length = len(self.current_payload['prompt'])
-            logger.debug(
-                f"Prompt length is {prompt_length} characters",
-            )
+            logger.debug("Prompt length is {} characters", prompt_length)
             time_state = time.time()
+            self.trace.begin("generation", api_type=self.bridge_data.api_type)
             
             # Handle based on API type
             if self.bridge_data.api_type == "openai":
                 self.handle_openai_generation()
             else:
                 self.handle_koboldai_generation()
+            # The handlers already submitted the faulted job when they gave up
+            if self.status == JobStatus.FAULTED:
+                return
+            health_monitor.record_success(self.backend_url)
                 
             self.seed = 0
             gen_time = time.time() - time_state
+            self.generation_time = gen_time
+            # Not every backend reports usage, so we estimate whatever is missing
+            if self.completion_tokens is None:
+                self.completion_tokens = estimate_tokens(self.text)
+            if self.prompt_tokens is None:
+                self.prompt_tokens = estimate_tokens(self.current_payload.get("prompt"))
+            self.trace.annotate(
+                completion_tokens=self.completion_tokens,
+                prompt_tokens=self.prompt_tokens,
+                ttft=self.ttft,
+            )
+            latency_model.observe(
+                self.backend_url,
+                self.current_model,
+                duration=gen_time,
+                tokens=self.completion_tokens,
+                ttft=self.ttft,
+            )
             
             # Format completion info to match waiting messages
             complete_info = f"✅ Complete {job_id}"  # Even shorter message as requested
@@ -107,8 +189,7 @@ class ScribeHordeJob(HordeJobFramework):
             model_col = f"{model_name:<16}"         # Reduced width to match thread_col in poppers.py
             
             # Determine speed indicator
-            tokens_generated = self.current_payload['max_length']
-            tokens_per_second = tokens_generated / gen_time
+            tokens_per_second = self.completion_tokens / gen_time if gen_time > 0 else 0
 
             if tokens_per_second >= 10:
                 speed_indicator = "🐇Fast"
@@ -129,75 +210,111 @@ class ScribeHordeJob(HordeJobFramework):
             )
             trace = "".join(traceback.format_exception(type(err), err, err.__traceback__))
             logger.trace(trace)
-            self.status = JobStatus.FAULTED
-            self.start_submit_thread()
+            self.fault("exception")
+            self.queue_submit()
             return
-        self.start_submit_thread()
+        self.queue_submit()
         
+    def preflight(self):
+        """Makes sure the prompt fits the backend's context window before we spend a request on it
+        Prompts which are too long are truncated from the left, as the horde would.
+        Returns False if the job cannot be served and should go straight back to the horde"""
+        max_length = self.current_payload.get("max_length", 80)
+        context_length = min(
+            self.current_payload.get("max_context_length", self.bridge_data.max_context_length),
+            self.bridge_data.max_context_length,
+        )
+        max_prompt_tokens = context_length - max_length
+        if self.bridge_data.api_type == "openai":
+            max_prompt_tokens -= self.CHAT_OVERHEAD_TOKENS
+        if max_prompt_tokens <= 0:
+            logger.warning(
+                f"Job {self.current_id[:8]} asks for {max_length} tokens, "
+                f"which leaves no room for a prompt in a {context_length} token context. Returning it.",
+            )
+            return False
+        prompt = self.current_payload.get("prompt", "")
+        prompt_tokens = token_estimator.estimate(prompt, self.current_model)
+        if prompt_tokens <= max_prompt_tokens:
+            return True
+        if not self.bridge_data.truncate_prompts:
+            logger.warning(
+                f"Job {self.current_id[:8]} prompt is ~{prompt_tokens} tokens "
+                f"but only {max_prompt_tokens} fit. Returning it.",
+            )
+            return False
+        self.current_payload["prompt"] = token_estimator.truncate_left(prompt, max_prompt_tokens, self.current_model)
+        logger.debug("Truncated prompt of job {} from ~{} to {} tokens", self.current_id[:8], prompt_tokens, max_prompt_tokens)
+        return True
+
     def handle_koboldai_generation(self):
         """Handle generation using KoboldAI API"""
         if self.requested_softprompt != self.bridge_data.current_softprompt:
-            requests.put(
+            http_pool.put(
                 self.bridge_data.kai_url + "/api/latest/config/soft_prompt",
+                read_timeout=self.VALIDATION_TIMEOUT,
                 json={"value": self.requested_softprompt},
             )
             time.sleep(1)  # Wait a second to unload the softprompt
         
-        loop_retry = 0
+        retry = RetryPolicy("KoboldAI", max_attempts=5, base_delay=2, deadline=self.stale_time)
         gen_success = False
-        while not gen_success and loop_retry < 5:
+        while not gen_success:
             try:
-                gen_req = requests.post(
-                    self.bridge_data.kai_url + "/api/latest/generate",
-                    json=self.current_payload,
-                    timeout=self.max_seconds,
-                )
+                with self.trace.span("backend_request", attempt=retry.attempts) as span:
+                    gen_req = http_pool.post(
+                        self.bridge_data.kai_url + "/api/latest/generate",
+                        read_timeout=retry.timeout(self.max_seconds),
+                        total_timeout=retry.timeout(self.max_seconds),
+                        data=json_codec.dumps(self.current_payload),
+                        headers={**json_codec.JSON_HEADERS, **self.trace.headers(span)},
+                    )
+                    span.set(status_code=gen_req.status_code, ttfb=gen_req.elapsed.total_seconds())
             except requests.exceptions.ConnectionError:
-                logger.error(f"Worker {self.bridge_data.kai_url} unavailable. Retrying in 3 seconds...")
-                loop_retry += 1
-                time.sleep(3)
+                logger.error(f"Worker {self.bridge_data.kai_url} unavailable.")
+                health_monitor.record_failure(self.backend_url, "connection error")
+                if not retry.backoff(reason="connection error"):
+                    break
                 continue
             except requests.exceptions.ReadTimeout:
                 logger.error(f"Worker {self.bridge_data.kai_url} request timeout. Aborting.")
-                self.status = JobStatus.FAULTED
-                self.start_submit_thread()
+                health_monitor.record_timeout(self.backend_url)
+                self.fault("backend_timeout")
+                self.queue_submit()
                 return
             
-            if not isinstance(gen_req.json(), dict):
-                logger.error(
-                    (
-                        f"KAI instance {self.bridge_data.kai_url} API unexpected response on generate: {gen_req}. "
-                        "Retrying in 3 seconds..."
-                    ),
-                )
-                time.sleep(3)
-                loop_retry += 1
-                continue
             if gen_req.status_code == 503:
                 logger.debug(
-                    f"KAI instance {self.bridge_data.kai_url} Busy (attempt {loop_retry}). Will try again...",
+                    f"KAI instance {self.bridge_data.kai_url} Busy (attempt {retry.attempts}). Will try again...",
                 )
-                time.sleep(3)
-                loop_retry += 1
+                if not retry.backoff(headers=gen_req.headers, reason="busy"):
+                    break
                 continue
             if gen_req.status_code == 422:
                 logger.error(
                     f"KAI instance {self.bridge_data.kai_url} reported validation error.",
                 )
-                self.status = JobStatus.FAULTED
-                self.start_submit_thread()
+                self.fault("validation_error")
+                self.queue_submit()
                 return
             try:
-                req_json = gen_req.json()
-            except json.decoder.JSONDecodeError:
+                req_json = json_codec.loads_response(gen_req)
+            except json_codec.JSONDecodeError:
                 logger.error(
                     (
                         f"Something went wrong when trying to generate on {self.bridge_data.kai_url}. "
-                        "Please check the health of the KAI worker. Retrying 3 seconds...",
+                        "Please check the health of the KAI worker."
                     ),
                 )
-                loop_retry += 1
-                time.sleep(3)
+                if not retry.backoff(reason="invalid json"):
+                    break
+                continue
+            if not isinstance(req_json, dict):
+                logger.error(
+                    f"KAI instance {self.bridge_data.kai_url} API unexpected response on generate: {gen_req}.",
+                )
+                if not retry.backoff(reason="unexpected response"):
+                    break
                 continue
             try:
                 self.text = req_json["results"][0]["text"]
@@ -205,19 +322,25 @@ class ScribeHordeJob(HordeJobFramework):
                 logger.error(
                     (
                         f"Unexpected response received from {self.bridge_data.kai_url}: {req_json}. "
-                        "Please check the health of the KAI worker. Retrying in 3 seconds..."
+                        "Please check the health of the KAI worker."
                     ),
                 )
                 logger.debug(self.current_payload)
-                loop_retry += 1
-                time.sleep(3)
+                if not retry.backoff(reason="unexpected response"):
+                    break
                 continue
             gen_success = True
+
+        if not gen_success:
+            logger.error("Failed to generate text after multiple retries")
+            self.fault("retries_exhausted")
+            self.queue_submit()
     
     def handle_openai_generation(self):
         """Handle generation using OpenAI API"""
         # Transform the payload to OpenAI format
-        openai_payload = self.transform_to_openai_format()
+        with self.trace.span("payload_transform"):
+            openai_payload = self.transform_to_openai_format()
         
         # Set up headers
         headers = {
@@ -226,71 +349,81 @@ class ScribeHordeJob(HordeJobFramework):
         }
         
         # Log the model and payload for debugging
-        logger.debug(f"Using model: {self.bridge_data.openai_model}")
-        logger.debug(f"OpenAI request payload: {openai_payload}")
+        logger.debug("Using model: {}", self.bridge_data.openai_model)
+        logger.debug("OpenAI request payload: {}", openai_payload)
         
         # Make request to OpenAI API
-        loop_retry = 0
+        retry = RetryPolicy("OpenAI", max_attempts=5, base_delay=2, deadline=self.stale_time)
         gen_success = False
         
-        while not gen_success and loop_retry < 5:
+        while not gen_success:
             try:
                 # Use chat completions API with OpenAI
-                gen_req = requests.post(
-                    f"{self.bridge_data.openai_url}/chat/completions",
-                    json=openai_payload,
-                    headers=headers,
-                    timeout=self.max_seconds
-                )
+                with self.trace.span("backend_request", attempt=retry.attempts) as span:
+                    gen_req = http_pool.post(
+                        f"{self.bridge_data.openai_url}/chat/completions",
+                        read_timeout=retry.timeout(self.max_seconds),
+                        total_timeout=retry.timeout(self.max_seconds),
+                        data=json_codec.dumps(openai_payload),
+                        headers={**headers, **self.trace.headers(span)},
+                    )
+                    span.set(status_code=gen_req.status_code, ttfb=gen_req.elapsed.total_seconds())
                 
                 # Log the full request and response for debugging
-                logger.debug(f"API URL: {self.bridge_data.openai_url}/chat/completions")
-                logger.debug(f"Request headers: {headers}")
-                logger.debug(f"Response status: {gen_req.status_code}")
-                logger.debug(f"Response headers: {gen_req.headers}")
+                logger.debug("API URL: {}/chat/completions", self.bridge_data.openai_url)
+                logger.debug("Response status: {}", gen_req.status_code)
+                logger.debug("Response headers: {}", gen_req.headers)
                 
                 # Handle response status
                 if gen_req.status_code != 200:
                     error_message = f"OpenAI API error: {gen_req.status_code}"
                     try:
-                        error_data = gen_req.json()
-                        logger.debug(f"Error response data: {error_data}")
+                        error_data = json_codec.loads_response(gen_req)
+                        logger.debug("Error response data: {}", error_data)
                         if "error" in error_data:
                             error_message = f"OpenAI API error: {error_data['error'].get('message', 'Unknown error')}"
-                    except json.JSONDecodeError:
-                        logger.debug(f"Non-JSON error response: {gen_req.text}")
+                    except json_codec.JSONDecodeError:
+                        logger.opt(lazy=True).debug("Non-JSON error response: {}", lambda: gen_req.text)
                         pass
                     
                     logger.error(error_message)
                     
                     # Handle specific status codes
                     if gen_req.status_code == 429:
-                        logger.warning("Rate limit exceeded or quota reached. Retrying in 5 seconds...")
-                        time.sleep(5)
+                        logger.warning("Rate limit exceeded or quota reached.")
                     elif gen_req.status_code >= 500:
-                        logger.warning("Server error from OpenAI. Retrying in 3 seconds...")
-                        time.sleep(3)
+                        logger.warning("Server error from OpenAI.")
+                        health_monitor.record_failure(self.backend_url, f"status {gen_req.status_code}")
                     else:
                         # Client errors like 401, 403, 404 are likely not recoverable
-                        self.status = JobStatus.FAULTED
+                        self.fault("client_error")
                         # Make sure we have text set to something, even if empty
                         if self.text is None:
                             self.text = ""
-                        self.start_submit_thread()
+                        self.queue_submit()
                         return
                     
-                    loop_retry += 1
+                    if not retry.backoff(headers=gen_req.headers, reason=f"status {gen_req.status_code}"):
+                        break
                     continue
                 
                 # Parse response
                 try:
-                    response_data = gen_req.json()
-                    logger.debug(f"OpenAI API response: {response_data}")
+                    response_data = json_codec.loads_response(gen_req)
+                    logger.debug("OpenAI API response: {}", response_data)
+                    self.prompt_tokens, self.completion_tokens, self.ttft = get_usage(response_data)
+                    # Large prompts teach the estimator this model's bytes per token.
+                    # On small ones, the system prompt and chat template would skew the ratio.
+                    if self.prompt_tokens and self.prompt_tokens > self.CALIBRATION_MIN_TOKENS:
+                        token_estimator.calibrate(self.current_model, self.current_payload["prompt"], self.prompt_tokens)
                     
                     # Special handling for o1-mini model which might have a different response format
                     if self.bridge_data.openai_model == "o1-mini":
                         # Log the entire response for debugging
-                        logger.info(f"o1-mini response structure: {json.dumps(response_data, indent=2)}")
+                        logger.opt(lazy=True).debug(
+                            "o1-mini response structure: {}",
+                            lambda: json.dumps(response_data, indent=2),
+                        )
                         
                         # Try different ways to extract the content
                         if "choices" in response_data and len(response_data["choices"]) > 0:
@@ -299,7 +432,7 @@ class ScribeHordeJob(HordeJobFramework):
                             # Try standard message format first
                             if "message" in choice and "content" in choice["message"]:
                                 content = choice["message"]["content"]
-                                logger.info(f"o1-mini extracted content: '{content}'")
+                                logger.debug("o1-mini extracted content: '{}'", content)
                                 if content.strip():  # Check if content is not just whitespace
                                     self.text = content
                                 else:
@@ -308,10 +441,10 @@ class ScribeHordeJob(HordeJobFramework):
                             # Try text/content directly in choice
                             elif "text" in choice:
                                 self.text = choice["text"]
-                                logger.info(f"o1-mini extracted text: '{self.text}'")
+                                logger.debug("o1-mini extracted text: '{}'", self.text)
                             elif "content" in choice:
                                 self.text = choice["content"]
-                                logger.info(f"o1-mini extracted content directly: '{self.text}'")
+                                logger.debug("o1-mini extracted content directly: '{}'", self.text)
                             # Try finish_reason to see if it's empty for a reason
                             elif "finish_reason" in choice:
                                 reason = choice.get("finish_reason")
@@ -334,134 +467,71 @@ class ScribeHordeJob(HordeJobFramework):
                     # Standard handling for other models
                     # Extract text from response
                     if "choices" in response_data and len(response_data["choices"]) > 0:
-                        logger.debug(f"Response choices: {response_data['choices']}")
+                        logger.debug("Response choices: {}", response_data["choices"])
                         if "message" in response_data["choices"][0]:
                             message_content = response_data["choices"][0]["message"].get("content", "")
-                            logger.debug(f"Message content: '{message_content}'")
+                            logger.debug("Message content: '{}'", message_content)
                             self.text = message_content
                         else:
                             logger.error(f"Unexpected response format from OpenAI API. Choice structure: {response_data['choices'][0]}")
-                            loop_retry += 1
-                            time.sleep(2)
+                            if not retry.backoff(reason="unexpected response format"):
+                                break
                             continue
                     else:
                         logger.error(f"No choices returned from OpenAI API. Full response: {response_data}")
-                        loop_retry += 1
-                        time.sleep(2)
+                        if not retry.backoff(reason="no choices returned"):
+                            break
                         continue
                     
                     gen_success = True
                     
-                except json.JSONDecodeError:
+                except json_codec.JSONDecodeError:
                     logger.error("Failed to parse JSON response from OpenAI API")
-                    loop_retry += 1
-                    time.sleep(2)
+                    if not retry.backoff(reason="invalid json"):
+                        break
                     continue
                 
             except requests.exceptions.ConnectionError:
-                logger.error(f"OpenAI API connection error. Retrying in 3 seconds... (attempt {loop_retry + 1}/5)")
-                loop_retry += 1
-                time.sleep(3)
+                logger.error(f"OpenAI API connection error (attempt {retry.attempts}/5)")
+                health_monitor.record_failure(self.backend_url, "connection error")
+                if not retry.backoff(reason="connection error"):
+                    break
                 continue
             except requests.exceptions.ReadTimeout:
-                logger.error(f"OpenAI API request timeout. Retrying in 3 seconds... (attempt {loop_retry + 1}/5)")
-                loop_retry += 1
-                time.sleep(3)
+                logger.error(f"OpenAI API request timeout (attempt {retry.attempts}/5)")
+                health_monitor.record_timeout(self.backend_url)
+                if not retry.backoff(reason="request timeout"):
+                    break
                 continue
             except requests.exceptions.RequestException as e:
                 logger.error(f"OpenAI API request exception: {e}")
-                self.status = JobStatus.FAULTED
-                self.start_submit_thread()
+                self.fault("request_exception")
+                self.queue_submit()
                 return
         
         if not gen_success:
             logger.error("Failed to generate text after multiple retries")
-            self.status = JobStatus.FAULTED
-            self.start_submit_thread()
+            self.fault("retries_exhausted")
+            self.queue_submit()
             return
     
     def transform_to_openai_format(self):
         """Transform Horde payload to OpenAI format"""
-        payload = self.current_payload
-        
-        # Extract parameters from payload
-        prompt = payload.get("prompt", "")
-        max_tokens = int(payload.get("max_length", 80))
-        
-        # Only check for exact AIPG terms
-        aipg_terms = ["aipg", "ai power grid", "aipowergrid"]
-        
-        # Only inject if there's an exact match for AIPG terms
-        has_aipg_mention = any(term in prompt.lower() for term in aipg_terms)
-        
-        # Inject context only for direct AIPG mentions
-        if has_aipg_mention:
-            aipg_context = """AI Power Grid (AIPG) is a distributed network for AI workloads with native cryptocurrency incentives. Key points:
-
-• Platform: Distributed AI compute network built on AI Horde with workflow engine
-• Tokenomics: 150M max supply
-• Network: P2P port 8865, RPC port 9788, PoW/PoUW consensus
-• Links: aipowergrid.io, explorer.aipowergrid.io, pool.aipowergrid.io
-• Social: @AIPowerGrid (Twitter), t.me/AIPowerGrid (Telegram)
-• Meet founder: https://calendly.com/half-aipowergrid/30min"""
-            
-            # Prepend context to the prompt
-            prompt = f"{aipg_context}\n\nUser Query: {prompt}"
-            
-            # Also set expert system prompt
-            system_prompt = "You are a helpful assistant with expertise in AI Power Grid (AIPG). Provide concise, accurate information about the platform."
-        else:
-            # Default system prompt for non-AIPG queries
-            system_prompt = "You are a helpful assistant."
-        
-        # Use OpenAI model from bridge data
-        model = self.bridge_data.openai_model
-        
-        # Special handling for o1-mini model
-        if model == "o1-mini":
-            openai_payload = {
-                "model": model,
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": prompt}
-                ],
-                "max_completion_tokens": max_tokens
-            }
-            logger.info(f"Using o1-mini with payload: {json.dumps(openai_payload, indent=2)}")
-        else:
-            temperature = float(payload.get("temperature", 0.8))
-            top_p = float(payload.get("top_p", 0.9))
-            
-            openai_payload = {
-                "model": model,
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": prompt}
-                ],
-                "max_tokens": max_tokens,
-                "temperature": temperature,
-                "top_p": top_p
-            }
-            
-            if "stop_sequence" in payload:
-                openai_payload["stop"] = payload["stop_sequence"]
-            
-            if "frequency_penalty" in payload:
-                openai_payload["frequency_penalty"] = float(payload["frequency_penalty"])
-            
-            if "presence_penalty" in payload:
-                openai_payload["presence_penalty"] = float(payload["presence_penalty"])
-        
+        openai_payload = self.bridge_data.get_payload_pipeline().transform(self.current_payload)
+        if self.bridge_data.openai_model == "o1-mini":
+            logger.opt(lazy=True).debug("Using o1-mini with payload: {}", lambda: json.dumps(openai_payload, indent=2))
         return openai_payload
 
-    def submit_job(self, endpoint="/api/v2/generate/text/submit"):
-        """Submits the job to the server to earn our kudos."""
-        super().submit_job(endpoint=endpoint)
+    def release_inputs(self):
+        super().release_inputs()
+        # The prompt and the generation are the bulk of a job, and the submit payload has its own copy
+        self.current_payload = None
+        self.text = None
 
     def prepare_submit_payload(self):
         """Prepare the payload for submission"""
         # Ensure we always have an ID
-        if not hasattr(self, 'current_id') or not self.current_id:
+        if not self.current_id:
             logger.error("Missing job ID for submission")
             self.status = JobStatus.DONE_FAULTED
             return
@@ -469,25 +539,20 @@ class ScribeHordeJob(HordeJobFramework):
         self.submit_dict = {
             "id": self.current_id,
             "generation": self.text if self.text else "",
-            "seed": self.seed if hasattr(self, 'seed') and self.seed is not None else 0,
+            "seed": self.seed if self.seed is not None else 0,
         }
-        if hasattr(self, 'censored') and self.censored:
+        if self.censored:
             self.submit_dict["state"] = self.censored
 
-    def post_submit_tasks(self, submit_req):
-        # Store information about the completed job
-        global _last_job_completed, _last_job_info
-        _last_job_completed = time.time()
-        
-        # Store relevant job info for stats display
-        _last_job_info = {
-            'model': self.current_model,
-            'kudos': submit_req.json()["reward"],
-            'id': self.current_id
-        }
-        
-        # Reset waiting time when a job is completed
-        global _waiting_start_time
-        _waiting_start_time = time.time()
-        
-        bridge_stats.update_inference_stats(self.current_model, submit_req.json()["reward"])
+    def post_submit_tasks(self, submit_json):
+        worker_stats = bridge_stats.worker(self.bridge_data.worker_name)
+        # Shown on the status line while we wait for jobs
+        worker_stats.record_last_job(self.current_model, submit_json["reward"], self.current_id)
+        worker_stats.update_inference_stats(
+            self.current_model,
+            submit_json["reward"],
+            prompt_tokens=self.prompt_tokens,
+            completion_tokens=self.completion_tokens,
+            generation_time=self.generation_time,
+            ttft=self.ttft,
+        )
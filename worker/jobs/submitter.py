@@ -0,0 +1,137 @@
+"""Fixed-size pool of threads submitting finished jobs to the horde"""
+import itertools
+import os
+import queue
+import threading
+import time
+
+import requests
+
+from worker.http_pool import http_pool
+from worker.logger import logger
+from worker.outbox import submit_outbox
+from worker.retry import RETRYABLE_STATUS_CODES, RetryPolicy
+from worker.stats import bridge_stats
+from worker.utils import json_codec
+
+
+class SubmitPool:
+    """Submits finished jobs from a bounded set of threads, most urgent first
+
+    Jobs are ordered by the time they go stale, so a job which is about to be dropped by the horde
+    isn't stuck behind fresh ones while the horde is slow. When the backlog grows past max_backlog,
+    is_backlogged() tells the popper to stop asking for more work until we've caught up.
+    """
+
+    def __init__(self, threads=4, max_backlog=16):
+        self.threads = threads
+        self.max_backlog = max_backlog
+        self._queue = queue.PriorityQueue()
+        # Breaks ties between jobs with the same deadline, as jobs can't be compared
+        self._sequence = itertools.count()
+        self._workers = []
+        self._in_progress = 0
+        self._mutex = threading.Lock()
+
+    def _start(self):
+        """Starts the submit threads on first use"""
+        for index in range(self.threads):
+            worker = threading.Thread(target=self._run, name=f"submitter-{index}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, job):
+        """Queues a finished job for submission"""
+        deadline = job.stale_time or job.start_time + job.max_runtime
+        with self._mutex:
+            if not self._workers:
+                self._start()
+        self._queue.put((deadline, next(self._sequence), time.monotonic(), job))
+        self.report_stats()
+
+    def backlog(self):
+        """Jobs waiting for a submit thread, plus those being submitted"""
+        return self._queue.qsize() + self._in_progress
+
+    def is_backlogged(self):
+        """True when we shouldn't pop more jobs until the submissions caught up"""
+        return self.backlog() >= self.max_backlog
+
+    def _run(self):
+        while True:
+            _, _, queued_at, job = self._queue.get()
+            with self._mutex:
+                self._in_progress += 1
+            started = time.monotonic()
+            try:
+                job.submit_job()
+            except Exception as err:
+                logger.error("Unexpected error while submitting job: {}", err)
+            finally:
+                # Outbox replays aren't traced, their jobs were traced when they first ran
+                trace = getattr(job, "trace", None)
+                if trace is not None:
+                    trace.finish("faulted" if job.is_faulted() else "ok")
+                    # The outbox holds its own reference to the payload if the horde didn't take it
+                    job.release_submission()
+                with self._mutex:
+                    self._in_progress -= 1
+                finished = time.monotonic()
+                bridge_stats.process.update_submit_stats(
+                    queue_time=started - queued_at,
+                    submit_time=finished - started,
+                    backlog=self.backlog(),
+                    # Replays from the outbox have no model
+                    model_name=getattr(getattr(job, "bridge_data", None), "model", None) or "outbox",
+                )
+                self._queue.task_done()
+
+    def report_stats(self):
+        bridge_stats.process.update_submit_stats(backlog=self.backlog())
+
+
+class OutboxSubmission:
+    """A generation left over in the outbox, from a previous run or an earlier failed submission"""
+
+    def __init__(self, entry, api_key):
+        self.entry = entry
+        self.headers = {"apikey": api_key, **json_codec.JSON_HEADERS}
+        self.start_time = entry.created
+        self.max_runtime = submit_outbox.max_age
+        # Replays are never more urgent than the jobs we're working on right now
+        self.stale_time = time.time() + self.max_runtime
+
+    def submit_job(self):
+        retry = RetryPolicy("Outbox", max_attempts=4, base_delay=1)
+        while True:
+            try:
+                submit_req = http_pool.post(self.entry.url, read_timeout=30, data=self.entry.payload, headers=self.headers)
+            except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout) as err:
+                if retry.backoff(reason=type(err).__name__):
+                    continue
+                submit_outbox.release(self.entry.job_id)
+                return
+            if submit_req.status_code in RETRYABLE_STATUS_CODES:
+                if retry.backoff(headers=submit_req.headers, reason=f"status {submit_req.status_code}"):
+                    continue
+                submit_outbox.release(self.entry.job_id)
+                return
+            break
+        submit_outbox.remove(self.entry.job_id)
+        if submit_req.ok:
+            reward = json_codec.loads_response(submit_req).get("reward", 0)
+            logger.info("Submitted job {} from the outbox for {} kudos", self.entry.job_id, reward)
+        else:
+            # Most likely the horde expired it, or it was submitted before we crashed
+            logger.warning(
+                "Horde refused job {} from the outbox: {} {}",
+                self.entry.job_id,
+                submit_req.status_code,
+                submit_req.text,
+            )
+
+
+submit_pool = SubmitPool(
+    threads=int(os.environ.get("HORDE_SUBMIT_THREADS", "4")),
+    max_backlog=int(os.environ.get("HORDE_SUBMIT_MAX_BACKLOG", "16")),
+)
@@ -0,0 +1,208 @@
+"""Learned per-backend/model latency estimates, used to size timeouts and stale detection"""
+import atexit
+import json
+import os
+import threading
+import time
+from statistics import NormalDist
+
+from worker.logger import logger
+
+
+class EWMA:
+    """Exponentially weighted moving average which also tracks the variance"""
+
+    def __init__(self, alpha, mean=None, var=0.0, count=0):
+        self.alpha = alpha
+        self.mean = mean
+        self.var = var
+        self.count = count
+
+    def update(self, value):
+        self.count += 1
+        if self.mean is None:
+            self.mean = value
+            self.var = 0.0
+            return
+        diff = value - self.mean
+        incr = self.alpha * diff
+        self.mean += incr
+        self.var = (1 - self.alpha) * (self.var + diff * incr)
+
+    @property
+    def std(self):
+        return self.var**0.5
+
+    def to_dict(self):
+        return {"mean": self.mean, "var": self.var, "count": self.count}
+
+    @classmethod
+    def from_dict(cls, alpha, data):
+        return cls(alpha, mean=data.get("mean"), var=data.get("var", 0.0), count=data.get("count", 0))
+
+
+class LatencyEstimate:
+    """Time-to-first-token and per-token generation time for a single backend/model"""
+
+    def __init__(self, alpha, ttft=None, seconds_per_token=None):
+        self.ttft = ttft or EWMA(alpha)
+        # We track the inverse of tokens/sec as it adds up linearly with the amount of tokens
+        self.seconds_per_token = seconds_per_token or EWMA(alpha)
+
+    @property
+    def count(self):
+        return self.seconds_per_token.count
+
+    @property
+    def tokens_per_second(self):
+        if not self.seconds_per_token.mean:
+            return None
+        return 1 / self.seconds_per_token.mean
+
+    def observe(self, duration, tokens, ttft=None):
+        if ttft is not None:
+            self.ttft.update(ttft)
+        else:
+            # Non-streaming backends can't tell us when the first token arrived
+            ttft = self.ttft.mean or 0
+        if tokens <= 0:
+            return
+        generation_time = max(duration - ttft, 0.001)
+        self.seconds_per_token.update(generation_time / tokens)
+
+    def predict(self, tokens):
+        """Returns the expected duration and its standard deviation for generating this many tokens"""
+        mean = (self.ttft.mean or 0) + tokens * self.seconds_per_token.mean
+        var = self.ttft.var + (tokens**2) * self.seconds_per_token.var
+        return mean, var**0.5
+
+
+class LatencyModel:
+    """Online model of how fast each backend/model generates
+
+    Completed jobs feed it their duration and token counts. Once a backend/model has enough samples,
+    timeouts and stale times are derived from the predicted duration plus a quantile margin,
+    instead of a one-size-fits-all formula.
+    """
+
+    def __init__(
+        self,
+        filename=None,
+        alpha=0.1,
+        quantile=0.99,
+        min_samples=5,
+        min_timeout=10,
+        max_timeout=1200,
+        safety_factor=1.5,
+    ):
+        self.filename = filename
+        self.alpha = alpha
+        self.z = NormalDist().inv_cdf(quantile)
+        self.min_samples = min_samples
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.safety_factor = safety_factor
+        self.estimates = {}
+        self.save_interval = 60
+        self._last_save = time.time()
+        self._dirty = False
+        self._loaded = False
+        self._mutex = threading.Lock()
+        # Job threads and the state store both save, and only one of them may write the file at a time
+        self._save_mutex = threading.Lock()
+
+    @staticmethod
+    def get_key(backend, model):
+        return f"{backend}|{model}"
+
+    def get_estimate(self, backend, model):
+        self._ensure_loaded()
+        with self._mutex:
+            return self.estimates.get(self.get_key(backend, model))
+
+    def observe(self, backend, model, duration, tokens, ttft=None):
+        """Feeds the result of a completed generation into the model"""
+        self._ensure_loaded()
+        key = self.get_key(backend, model)
+        with self._mutex:
+            if key not in self.estimates:
+                self.estimates[key] = LatencyEstimate(self.alpha)
+            self.estimates[key].observe(duration, tokens, ttft)
+            self._dirty = True
+            should_save = time.time() - self._last_save > self.save_interval
+        if should_save:
+            self.save()
+
+    def get_timeout(self, backend, model, tokens, default):
+        """Returns the timeout to use for generating this many tokens
+        Falls back to `default` until the backend/model has been observed enough times"""
+        estimate = self.get_estimate(backend, model)
+        if not estimate or estimate.count < self.min_samples:
+            return default
+        mean, std = estimate.predict(tokens)
+        timeout = (mean + self.z * std) * self.safety_factor
+        return min(max(timeout, self.min_timeout), self.max_timeout)
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._mutex:
+            if self._loaded:
+                return
+            self._loaded = True
+            self._load()
+
+    def _load(self):
+        if not self.filename or not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename, "rt", encoding="utf-8") as model_file:
+                data = json.load(model_file)
+            for key, value in data.get("estimates", {}).items():
+                self.estimates[key] = LatencyEstimate(
+                    self.alpha,
+                    ttft=EWMA.from_dict(self.alpha, value.get("ttft", {})),
+                    seconds_per_token=EWMA.from_dict(self.alpha, value.get("seconds_per_token", {})),
+                )
+            logger.debug(f"Loaded latency estimates for {len(self.estimates)} models from {self.filename}")
+        except (OSError, ValueError, AttributeError) as err:
+            logger.warning(f"Could not load latency model from {self.filename}: {err}")
+
+    def save(self):
+        """Atomically writes the model to disk"""
+        if not self.filename:
+            return
+        with self._save_mutex:
+            with self._mutex:
+                if not self._dirty:
+                    return
+                data = {
+                    "estimates": {
+                        key: {
+                            "ttft": estimate.ttft.to_dict(),
+                            "seconds_per_token": estimate.seconds_per_token.to_dict(),
+                        }
+                        for key, estimate in self.estimates.items()
+                    },
+                }
+                self._dirty = False
+                self._last_save = time.time()
+            tmp_filename = f"{self.filename}.tmp"
+            try:
+                with open(tmp_filename, "wt", encoding="utf-8") as model_file:
+                    json.dump(data, model_file)
+                os.replace(tmp_filename, self.filename)
+            except OSError as err:
+                logger.warning(f"Could not save latency model to {self.filename}: {err}")
+                # Try again on the next save
+                with self._mutex:
+                    self._dirty = True
+
+
+latency_model = LatencyModel(
+    filename=os.environ.get("HORDE_LATENCY_MODEL_FILE", "latency_model.json"),
+    quantile=float(os.environ.get("HORDE_LATENCY_QUANTILE", "0.99")),
+    min_samples=int(os.environ.get("HORDE_LATENCY_MIN_SAMPLES", "5")),
+    max_timeout=int(os.environ.get("HORDE_LATENCY_MAX_TIMEOUT", "1200")),
+)
+atexit.register(latency_model.save)
@@ -1,4 +1,7 @@
+import atexit
+import queue
 import sys
+import threading
 from functools import partialmethod
 
 from loguru import logger
@@ -125,44 +128,99 @@ logger.__class__.init_err = partialmethod(logger.__class__.log, "INIT_ERR")
 logger.__class__.message = partialmethod(logger.__class__.log, "MESSAGE")
 logger.__class__.stats = partialmethod(logger.__class__.log, "STATS")
 
+class BackgroundSink:
+    """Single loguru sink which routes every record to stdout or stderr from a background thread
+
+    Worker threads only pay for formatting the line and putting it in a queue,
+    while the (potentially blocking) terminal and pipe writes happen elsewhere.
+    """
+
+    def __init__(self):
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._writer, name="LogWriter", daemon=True)
+                self._thread.start()
+
+    def __call__(self, message):
+        if self._thread is None:
+            self._start()
+        # Resolve the stream when writing, so that redirections of sys.stdout/err are honoured
+        self._queue.put((message.record["level"].name in STDERR_LEVELS, str(message)))
+
+    def _writer(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            to_stderr, text = item
+            stream = sys.stderr if to_stderr else sys.stdout
+            try:
+                stream.write(text)
+                # Only flush once we've caught up with the queue
+                if self._queue.empty():
+                    stream.flush()
+            except (OSError, ValueError):
+                pass
+
+    def flush(self):
+        """Writes out everything logged so far and stops the writer thread"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._queue.put(None)
+        thread.join(timeout=5)
+
+
+STDERR_LEVELS = ["WARNING", "ERROR", "CRITICAL"]
+
+
+def should_log(record):
+    """Single filter replacing the per-handler ones, so each record is only checked once"""
+    name = record["level"].name
+    if name == "INFO":
+        return True
+    if name in STATS_LEVELS:
+        return False
+    if record["level"].no < verbosity + quiet:
+        return False
+    if name in STDOUT_LEVELS or name in INIT_LEVELS or name in MESSAGE_LEVELS:
+        return True
+    # Anything else only goes to stderr from warnings upwards
+    return record["level"].no >= 30
+
+
+def format_record(record):
+    name = record["level"].name
+    if name in STDOUT_LEVELS:
+        return genfmt + "\n{exception}"
+    if name in INIT_LEVELS:
+        return initfmt + "\n{exception}"
+    if name in MESSAGE_LEVELS:
+        return msgfmt + "\n{exception}"
+    return logfmt + "\n{exception}"
+
+
+background_sink = BackgroundSink()
+atexit.register(background_sink.flush)
+
 # Simplified config that only logs to stdout/stderr without file logging
-# But ensures important job information is shown
+# But ensures important job information is shown.
+# Everything below INFO is discarded by loguru before any formatting happens,
+# so debug calls passing their data as arguments (instead of f-strings) are nearly free.
 config = {
     "handlers": [
         {
-            "sink": sys.stderr,
-            "format": logfmt,
-            "colorize": True,
-            "filter": is_stderr_log,
-            "level": "WARNING",  # Only log warnings and above to stderr
-        },
-        {
-            "sink": sys.stdout,
-            "format": genfmt,
-            "level": "PROMPT",
-            "colorize": True,
-            "filter": is_stdout_log,
-        },
-        {
-            "sink": sys.stdout,
-            "format": initfmt,
-            "level": "INIT",
-            "colorize": True,
-            "filter": is_init_log,
-        },
-        {
-            "sink": sys.stdout,
-            "format": msgfmt,
-            "level": "MESSAGE",
-            "colorize": True,
-            "filter": is_msg_log,
-        },
-        {
-            "sink": sys.stdout,
-            "format": logfmt,
-            "level": "INFO",  # Show INFO level messages to capture job status
+            "sink": background_sink,
+            "format": format_record,
+            "level": "INFO",
             "colorize": True,
-            "filter": lambda record: record["level"].name == "INFO"
+            "filter": should_log,
         },
     ],
 }
@@ -0,0 +1,379 @@
+"""Prometheus metrics of the bridge, and the embedded HTTP server which exposes them"""
+import bisect
+import math
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from worker.logger import logger
+
+# Seconds, from a fast pop to a long generation
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, 120, 300)
+RATE_BUCKETS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+class _CounterValue:
+    def __init__(self):
+        self.value = 0
+        self._mutex = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._mutex:
+            self.value += amount
+
+    def samples(self, name, labels):
+        yield f"{name}{_format_labels(labels)} {_format_value(self.value)}"
+
+
+class _GaugeValue(_CounterValue):
+    def __init__(self):
+        super().__init__()
+        self.function = None
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """Reads the value from function() whenever we're scraped, instead of keeping it up to date"""
+        self.function = function
+
+    def samples(self, name, labels):
+        value = self.value
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception as err:
+                logger.debug("Could not read metric {}: {}", name, err)
+                return
+        yield f"{name}{_format_labels(labels)} {_format_value(value)}"
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # The last one is the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._mutex = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._mutex:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self, name, labels):
+        with self._mutex:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip((*self.buckets, math.inf), counts):
+            cumulative += count
+            yield f"{name}_bucket{_format_labels((*labels, ('le', _format_value(float(bound)))))} {cumulative}"
+        yield f"{name}_sum{_format_labels(labels)} {_format_value(total)}"
+        yield f"{name}_count{_format_labels(labels)} {cumulative}"
+
+
+class Metric:
+    """A named metric, with one value per combination of label values
+
+    Values are created on first use and then looked up without locking,
+    so recording a metric costs a dict lookup and a short uncontended lock.
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._mutex = threading.Lock()
+
+    def _new_value(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+        key = tuple(str(value) for value in values)
+        value = self._values.get(key)
+        if value is None:
+            with self._mutex:
+                value = self._values.setdefault(key, self._new_value())
+        return value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in list(self._values.items()):
+            lines.extend(value.samples(self.name, tuple(zip(self.labelnames, key))))
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new_value(self):
+        return _CounterValue()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def _new_value(self):
+        return _GaugeValue()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def set_function(self, function):
+        self.labels().set_function(function)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_value(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+class MetricsRegistry:
+    """All the metrics of the process, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self.metrics = {}
+        self._mutex = threading.Lock()
+
+    def _register(self, metric):
+        with self._mutex:
+            if metric.name in self.metrics:
+                return self.metrics[metric.name]
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = "HordeBridgeMetrics"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        route = self.server.routes.get(url.path)
+        if route is None:
+            status, content_type, body = 404, "text/plain; charset=utf-8", "Not found\n"
+        else:
+            try:
+                status, content_type, body = route(dict(parse_qsl(url.query)))
+            except Exception as err:
+                logger.error("Error while serving {}: {}", self.path, err)
+                status, content_type, body = 500, "text/plain; charset=utf-8", "Internal error\n"
+        payload = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):  # noqa: A002
+        # Scrapes every few seconds would drown out the worker's own logs
+        pass
+
+
+class MetricsServer:
+    """Serves the metrics from a background thread. Scrapes only read the metrics, so they never block jobs
+
+    Started by the first worker, shared by every worker of the process. Other status pages can be added to routes,
+    as functions taking the query parameters and returning the status code, content type and body.
+    """
+
+    def __init__(self, port, host="0.0.0.0"):
+        # No port disables the server
+        self.port = port
+        self.host = host
+        self.routes = {"/metrics": self.serve_metrics}
+        self._server = None
+        self._mutex = threading.Lock()
+
+    def serve_metrics(self, _query):
+        return 200, "text/plain; version=0.0.4; charset=utf-8", metrics_registry.render()
+
+    def start(self):
+        with self._mutex:
+            if self._server is not None or not self.port:
+                return
+            try:
+                self._server = ThreadingHTTPServer((self.host, self.port), _Handler)
+            except OSError as err:
+                # Most likely another bridge on this host already has the port
+                logger.warning(f"Could not serve metrics on port {self.port}: {err}")
+                self.port = None
+                return
+            self._server.daemon_threads = True
+            self._server.routes = self.routes
+            threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True).start()
+            logger.info(f"📈 Serving metrics on http://{self.host}:{self.port}/metrics")
+
+
+metrics_registry = MetricsRegistry()
+
+pop_seconds = metrics_registry.histogram(
+    "horde_pop_seconds",
+    "Time taken by job pops, per horde node",
+    ["node"],
+)
+queue_wait_seconds = metrics_registry.histogram(
+    "horde_job_queue_wait_seconds",
+    "Time popped jobs waited for a free thread",
+    ["model"],
+)
+generation_seconds = metrics_registry.histogram(
+    "horde_generation_seconds",
+    "Time the backend took to generate a job",
+    ["model"],
+)
+ttft_seconds = metrics_registry.histogram(
+    "horde_ttft_seconds",
+    "Time until the backend returned the first token",
+    ["model"],
+)
+tokens_per_second = metrics_registry.histogram(
+    "horde_tokens_per_second",
+    "Completion tokens per second of generation, per job",
+    ["model"],
+    buckets=RATE_BUCKETS,
+)
+submit_seconds = metrics_registry.histogram(
+    "horde_submit_seconds",
+    "Time taken to submit a finished job to the horde",
+)
+submit_queue_seconds = metrics_registry.histogram(
+    "horde_submit_queue_seconds",
+    "Time finished jobs waited for a submit thread",
+)
+jobs_completed = metrics_registry.counter(
+    "horde_jobs_completed_total",
+    "Jobs generated and accepted by the horde",
+    ["model"],
+)
+kudos_earned = metrics_registry.counter(
+    "horde_kudos_total",
+    "Kudos awarded by the horde",
+    ["model"],
+)
+completion_tokens = metrics_registry.counter(
+    "horde_completion_tokens_total",
+    "Tokens generated by the backend",
+    ["model"],
+)
+job_faults = metrics_registry.counter(
+    "horde_job_faults_total",
+    "Jobs which failed, by reason",
+    ["model", "reason"],
+)
+retries = metrics_registry.counter(
+    "horde_retries_total",
+    "Retried requests, per retry policy",
+    ["policy"],
+)
+jobs_in_flight = metrics_registry.gauge(
+    "horde_jobs_in_flight",
+    "Jobs being generated or submitted right now",
+    ["worker", "model"],
+)
+jobs_waiting = metrics_registry.gauge(
+    "horde_jobs_waiting",
+    "Popped jobs waiting for a free thread",
+    ["worker", "model"],
+)
+executor_utilization = metrics_registry.gauge(
+    "horde_executor_utilization",
+    "Share of the worker's threads which are busy",
+    ["worker", "model"],
+)
+submit_backlog = metrics_registry.gauge(
+    "horde_submit_backlog",
+    "Finished jobs waiting to be submitted",
+)
+outbox_depth = metrics_registry.gauge(
+    "horde_outbox_depth",
+    "Finished generations the horde hasn't accepted yet",
+)
+backend_healthy = metrics_registry.gauge(
+    "horde_backend_healthy",
+    "1 while a generation backend is considered healthy",
+    ["endpoint"],
+)
+backend_timeouts = metrics_registry.counter(
+    "horde_backend_timeouts_total",
+    "Generation requests which timed out. Slow jobs, so they don't count against the backend's health",
+    ["endpoint"],
+)
+governor_scale = metrics_registry.gauge(
+    "horde_governor_capacity_scale",
+    "Share of the configured threads and prefetch the resource governor allows, 0 when pops are paused",
+)
+governor_rss = metrics_registry.gauge(
+    "horde_governor_rss_bytes",
+    "Resident memory of the bridge, as last sampled by the resource governor",
+)
+governor_memory_limit = metrics_registry.gauge(
+    "horde_governor_memory_limit_bytes",
+    "Memory the bridge may use, from HORDE_MEMORY_LIMIT_MB or the container's limit",
+)
+governor_cpu_utilization = metrics_registry.gauge(
+    "horde_governor_cpu_utilization",
+    "Share of the CPUs available to the bridge which it used, as last sampled by the resource governor",
+)
+governor_actions = metrics_registry.counter(
+    "horde_governor_actions_total",
+    "Times the resource governor shrank, paused, resumed or restored capacity, limited a pop or rejected a job",
+    ["action"],
+)
+
+metrics_server = MetricsServer(int(os.environ.get("HORDE_METRICS_PORT", "8000")))
@@ -0,0 +1,150 @@
+"""Durable record of finished generations which the horde hasn't accepted yet"""
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from worker.logger import logger
+from worker.stats import bridge_stats
+
+OutboxEntry = namedtuple("OutboxEntry", ["job_id", "worker_name", "url", "payload", "created", "attempts"])
+
+
+class SubmitOutbox:
+    """Finished generations are written here before we submit them and removed once the horde took them
+
+    Whatever is left over, because the horde was unreachable or because we crashed, is replayed by the
+    worker on its next start and then periodically. Entries are keyed by job id, so writing the same job
+    twice keeps a single entry. The horde expires jobs after a while, so older entries are compacted away.
+    """
+
+    def __init__(self, filename, max_age=1800, compact_interval=300):
+        # No filename disables the outbox
+        self.filename = filename
+        self.max_age = max_age
+        self.compact_interval = compact_interval
+        self._connection = None
+        # Jobs which are being submitted right now, so that replays don't submit them twice
+        self._in_flight = set()
+        self._last_compaction = 0
+        self._mutex = threading.Lock()
+
+    def _connect(self):
+        """Opens the database on first use. Must be called with the mutex held"""
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.filename, check_same_thread=False, isolation_level=None)
+            # Must be set before the first table is created to have any effect
+            self._connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            # A committed entry survives a process crash in WAL mode, which is what we care about
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                "job_id TEXT PRIMARY KEY, worker_name TEXT, url TEXT, payload BLOB, "
+                "created REAL, attempts INTEGER DEFAULT 0)",
+            )
+        return self._connection
+
+    def add(self, job_id, worker_name, url, payload):
+        """Records a generation before it's submitted"""
+        if not self.filename:
+            return
+        with self._mutex:
+            try:
+                self._connect().execute(
+                    "INSERT INTO outbox (job_id, worker_name, url, payload, created) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(job_id) DO UPDATE SET payload = excluded.payload",
+                    (job_id, worker_name, url, payload, time.time()),
+                )
+                self._in_flight.add(job_id)
+            except sqlite3.Error as err:
+                # Not being able to persist is no reason to not submit
+                logger.warning("Could not write job {} to the outbox: {}", job_id, err)
+        self.report_stats()
+
+    def remove(self, job_id):
+        """Forgets a generation the horde has accepted, or will never accept"""
+        if not self.filename:
+            return
+        with self._mutex:
+            self._in_flight.discard(job_id)
+            try:
+                self._connect().execute("DELETE FROM outbox WHERE job_id = ?", (job_id,))
+            except sqlite3.Error as err:
+                logger.warning("Could not remove job {} from the outbox: {}", job_id, err)
+        self.report_stats()
+
+    def release(self, job_id):
+        """Keeps a generation we couldn't submit for a later replay"""
+        if not self.filename:
+            return
+        with self._mutex:
+            self._in_flight.discard(job_id)
+            try:
+                self._connect().execute("UPDATE outbox SET attempts = attempts + 1 WHERE job_id = ?", (job_id,))
+            except sqlite3.Error as err:
+                logger.warning("Could not update job {} in the outbox: {}", job_id, err)
+
+    def claim_pending(self, worker_name):
+        """Returns this worker's generations which are due a replay, and marks them as being submitted"""
+        if not self.filename:
+            return []
+        self.compact()
+        with self._mutex:
+            try:
+                rows = self._connect().execute(
+                    "SELECT job_id, worker_name, url, payload, created, attempts FROM outbox "
+                    "WHERE worker_name = ? AND created > ? ORDER BY created",
+                    (worker_name, time.time() - self.max_age),
+                ).fetchall()
+            except sqlite3.Error as err:
+                logger.warning("Could not read the outbox: {}", err)
+                return []
+            entries = [OutboxEntry(*row) for row in rows if row[0] not in self._in_flight]
+            self._in_flight.update(entry.job_id for entry in entries)
+            return entries
+
+    def compact(self, force=False):
+        """Drops generations the horde has expired by now and gives the space back"""
+        if not self.filename:
+            return
+        if not force and time.monotonic() - self._last_compaction < self.compact_interval:
+            return
+        self._last_compaction = time.monotonic()
+        with self._mutex:
+            try:
+                connection = self._connect()
+                expired = connection.execute(
+                    "DELETE FROM outbox WHERE created <= ?",
+                    (time.time() - self.max_age,),
+                ).rowcount
+                connection.execute("PRAGMA incremental_vacuum")
+                connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            except sqlite3.Error as err:
+                logger.warning("Could not compact the outbox: {}", err)
+                return
+        if expired:
+            logger.warning("Dropped {} generations from the outbox which the horde has expired", expired)
+        self.report_stats()
+
+    def get_stats(self):
+        """Returns how many generations are waiting and how old the oldest one is"""
+        with self._mutex:
+            depth, oldest = self._connect().execute("SELECT COUNT(*), MIN(created) FROM outbox").fetchone()
+        return {
+            "depth": depth,
+            "oldest_age": round(time.time() - oldest, 1) if oldest else 0,
+        }
+
+    def report_stats(self):
+        try:
+            bridge_stats.process.update_outbox_stats(self.get_stats())
+        except sqlite3.Error:
+            pass
+
+
+submit_outbox = SubmitOutbox(
+    os.environ.get("HORDE_OUTBOX_FILE", "submit_outbox.sqlite3"),
+    max_age=int(os.environ.get("HORDE_OUTBOX_MAX_AGE", "1800")),
+)
@@ -0,0 +1,180 @@
+"""Opt-in sampling profiler and thread dumps, to see where a running bridge spends its time"""
+import collections
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+
+import psutil
+
+from worker.logger import logger
+from worker.metrics import metrics_server
+
+
+def get_thread_cpu_times():
+    """Returns the CPU seconds (user + system) each thread has used so far, by thread ident"""
+    try:
+        native_times = {thread.id: thread.user_time + thread.system_time for thread in psutil.Process().threads()}
+    except (psutil.Error, OSError):
+        return {}
+    return {
+        thread.ident: native_times[thread.native_id]
+        for thread in threading.enumerate()
+        if thread.native_id in native_times
+    }
+
+
+def _clean(label):
+    # Frames are separated by ; in the collapsed format. Spaces are fine, as the count follows the last one
+    return label.replace(";", ":")
+
+
+class SamplingProfiler:
+    """Samples the stack of every thread at an interval, using sys._current_frames()
+
+    Nothing is traced between samples, so the overhead is one stack walk per thread per interval and it's
+    safe to run in production. Results are written as collapsed stacks, one line per distinct stack, which
+    flamegraph.pl, speedscope and most flamegraph tools read directly. A thread that's waiting on I/O or
+    on the GIL shows up in the frame it's blocked in, just like one burning CPU does, so the samples are
+    read next to the per-thread CPU time we log along with them.
+    """
+
+    def __init__(self, output_dir=".", interval=0.01, default_duration=30, max_duration=600):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.default_duration = default_duration
+        self.max_duration = max_duration
+        self._labels = {}
+        self._running = None
+        self._mutex = threading.Lock()
+
+    def _frame_label(self, frame):
+        code = frame.f_code
+        label = self._labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            label = self._labels[code] = _clean(label)
+        return label
+
+    def sample(self, duration):
+        """Samples for duration seconds from the calling thread. Returns the collapsed stacks and CPU times"""
+        names = {}
+        stacks = collections.Counter()
+        own_ident = threading.get_ident()
+        cpu_before = get_thread_cpu_times()
+        deadline = time.monotonic() + duration
+        samples = 0
+        while time.monotonic() < deadline:
+            for thread in threading.enumerate():
+                names[thread.ident] = _clean(thread.name)
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(self._frame_label(frame))
+                    frame = frame.f_back
+                labels.append(names.get(ident, f"thread-{ident}"))
+                stacks[";".join(reversed(labels))] += 1
+            samples += 1
+            time.sleep(self.interval)
+        cpu_after = get_thread_cpu_times()
+        cpu_times = {
+            names.get(ident, f"thread-{ident}"): round(cpu_after[ident] - cpu_before.get(ident, 0), 3)
+            for ident in cpu_after
+        }
+        collapsed = "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+        return collapsed, cpu_times, samples
+
+    def profile(self, duration=None):
+        """Profiles every thread, writes the collapsed stacks to a file and returns them.
+        Returns None if a profile is already running"""
+        duration = min(float(duration or self.default_duration), self.max_duration)
+        with self._mutex:
+            if self._running is not None:
+                return None
+            self._running = time.monotonic()
+        try:
+            logger.info(f"🔬 Profiling all threads for {duration:.0f}s")
+            collapsed, cpu_times, samples = self.sample(duration)
+        finally:
+            with self._mutex:
+                self._running = None
+        filename = os.path.join(self.output_dir, f"profile-{time.strftime('%Y%m%d-%H%M%S')}.collapsed")
+        try:
+            with open(filename, "wt", encoding="utf-8") as profile_file:
+                profile_file.write(collapsed)
+        except OSError as err:
+            logger.warning(f"Could not write the profile to {filename}: {err}")
+        else:
+            logger.info(f"🔬 Wrote {samples} samples to {filename}")
+        busiest = sorted(cpu_times.items(), key=lambda item: item[1], reverse=True)
+        logger.info(
+            "🔬 CPU seconds per thread during the profile: {}",
+            ", ".join(f"{name}={seconds}" for name, seconds in busiest if seconds > 0) or "none",
+        )
+        return collapsed
+
+    def start(self, duration=None):
+        """Profiles from a background thread"""
+        threading.Thread(target=self.profile, args=(duration,), name="profiler", daemon=True).start()
+
+    def dump_threads(self):
+        """Logs and writes the current stack of every thread, with the CPU time it has used so far"""
+        cpu_times = get_thread_cpu_times()
+        frames = sys._current_frames()
+        lines = [f"Thread dump of process {os.getpid()} at {time.strftime('%Y-%m-%d %H:%M:%S')}"]
+        for thread in threading.enumerate():
+            cpu_time = cpu_times.get(thread.ident)
+            lines.append(
+                f"\n--- {thread.name} (ident {thread.ident}, native id {thread.native_id}"
+                f"{', daemon' if thread.daemon else ''}"
+                f"{f', {cpu_time:.2f}s CPU' if cpu_time is not None else ''})",
+            )
+            frame = frames.get(thread.ident)
+            if frame is not None:
+                lines.append("".join(traceback.format_stack(frame)).rstrip())
+        dump = "\n".join(lines) + "\n"
+        filename = os.path.join(self.output_dir, f"threads-{time.strftime('%Y%m%d-%H%M%S')}.txt")
+        try:
+            with open(filename, "wt", encoding="utf-8") as dump_file:
+                dump_file.write(dump)
+            logger.info(f"🧵 Wrote a dump of {threading.active_count()} threads to {filename}")
+        except OSError as err:
+            logger.warning(f"Could not write the thread dump to {filename}: {err}")
+            logger.info(dump)
+        return dump
+
+    def serve_profile(self, query):
+        collapsed = self.profile(query.get("seconds"))
+        if collapsed is None:
+            return 409, "text/plain; charset=utf-8", "A profile is already running\n"
+        return 200, "text/plain; charset=utf-8", collapsed
+
+    def serve_threads(self, _query):
+        return 200, "text/plain; charset=utf-8", self.dump_threads()
+
+    def install(self):
+        """SIGUSR1 profiles for the default duration and SIGUSR2 dumps the threads. Also serves both next to
+        the metrics, as /debug/profile?seconds=N and /debug/threads. Must be called from the main thread"""
+        metrics_server.routes["/debug/profile"] = self.serve_profile
+        metrics_server.routes["/debug/threads"] = self.serve_threads
+        if not hasattr(signal, "SIGUSR1"):
+            # Windows has no user signals
+            return
+        # Signal handlers run in the main thread between bytecodes, so they only hand the work off
+        signal.signal(signal.SIGUSR1, lambda _signum, _frame: self.start())
+        signal.signal(
+            signal.SIGUSR2,
+            lambda _signum, _frame: threading.Thread(target=self.dump_threads, daemon=True).start(),
+        )
+        logger.info(f"🔬 Profiler ready: kill -USR1 {os.getpid()} to profile, kill -USR2 {os.getpid()} to dump threads")
+
+
+profiler = SamplingProfiler(
+    output_dir=os.environ.get("HORDE_PROFILE_DIR", "."),
+    interval=float(os.environ.get("HORDE_PROFILE_INTERVAL", "0.01")),
+    default_duration=float(os.environ.get("HORDE_PROFILE_DURATION", "30")),
+)
@@ -0,0 +1,207 @@
+"""Shared retry policy for the horde and the generation backends"""
+import email.utils
+import os
+import random
+import re
+import threading
+import time
+
+from worker import metrics
+from worker.logger import logger
+
+# Status codes which are worth another attempt. Everything else in the 4xx range is our fault.
+RETRYABLE_STATUS_CODES = frozenset([408, 425, 429, 500, 502, 503, 504])
+
+# Matches the duration format used by OpenAI-compatible rate-limit headers, e.g. "1m30.5s", "250ms", "7.66s"
+DURATION_REGEX = re.compile(r"^(?:(?P<h>\d+(?:\.\d+)?)h)?(?:(?P<m>\d+(?:\.\d+)?)m(?!s))?(?:(?P<s>\d+(?:\.\d+)?)s)?(?:(?P<ms>\d+(?:\.\d+)?)ms)?$")
+
+
+def parse_duration(value):
+    """Parses a rate-limit header duration into seconds. Returns None if it can't be understood"""
+    if value is None:
+        return None
+    value = str(value).strip()
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    match = DURATION_REGEX.match(value)
+    if not match or not any(match.groupdict().values()):
+        return None
+    parts = {key: float(val) if val else 0.0 for key, val in match.groupdict().items()}
+    return parts["h"] * 3600 + parts["m"] * 60 + parts["s"] + parts["ms"] / 1000
+
+
+def parse_retry_after(headers):
+    """Returns how many seconds the server asked us to wait before retrying, or None if it didn't say"""
+    if not headers:
+        return None
+    retry_after = headers.get("retry-after")
+    if retry_after is not None:
+        delay = parse_duration(retry_after)
+        if delay is not None:
+            return delay
+        # Retry-After can also be an HTTP date
+        with_date = email.utils.parsedate_tz(retry_after)
+        if with_date:
+            return max(email.utils.mktime_tz(with_date) - time.time(), 0.0)
+    # OpenAI-compatible backends (OpenAI, Groq...) report separate request and token buckets.
+    # Only the exhausted bucket tells us how long to wait.
+    delays = []
+    for bucket in ("requests", "tokens"):
+        if headers.get(f"x-ratelimit-remaining-{bucket}") != "0":
+            continue
+        delay = parse_duration(headers.get(f"x-ratelimit-reset-{bucket}"))
+        if delay is not None:
+            delays.append(delay)
+    if delays:
+        return max(delays)
+    reset = headers.get("x-ratelimit-reset")
+    if reset is not None:
+        delay = parse_duration(reset)
+        if delay is not None:
+            # Some servers send an epoch timestamp instead of a duration
+            return max(delay - time.time(), 0.0) if delay > 1e9 else delay
+    return None
+
+
+class RetryBudget:
+    """Process-wide token bucket which caps retries to a fraction of first attempts
+
+    Every new operation deposits `ratio` tokens and every retry withdraws a whole one,
+    so during an upstream incident we retry at most `ratio` times per request instead of
+    multiplying the load by the number of attempts. A small trickle of tokens per second
+    ensures that low-traffic workers can still retry.
+    """
+
+    def __init__(self, ratio=0.2, min_per_second=0.5, max_tokens=20):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.exhausted = 0
+        self._last_refill = time.monotonic()
+        self._mutex = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.max_tokens, self.tokens + (now - self._last_refill) * self.min_per_second)
+        self._last_refill = now
+
+    def deposit(self):
+        """Called once per new operation"""
+        with self._mutex:
+            self._refill()
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        """Returns True if we're allowed to retry"""
+        with self._mutex:
+            self._refill()
+            if self.tokens < 1:
+                self.exhausted += 1
+                return False
+            self.tokens -= 1
+            return True
+
+
+retry_budget = RetryBudget(
+    ratio=float(os.environ.get("HORDE_RETRY_BUDGET_RATIO", "0.2")),
+    min_per_second=float(os.environ.get("HORDE_RETRY_BUDGET_MIN_PER_SECOND", "0.5")),
+    max_tokens=int(os.environ.get("HORDE_RETRY_BUDGET_MAX_TOKENS", "20")),
+)
+
+
+class RetryPolicy:
+    """Jittered exponential backoff, bounded by attempts, by a deadline and by the shared retry budget
+
+    Typical usage inside a request loop:
+
+        retry = RetryPolicy("openai", max_attempts=5, deadline=self.stale_time)
+        while True:
+            req = session.post(..., timeout=retry.timeout(self.max_seconds))
+            if req.status_code in RETRYABLE_STATUS_CODES and retry.backoff(headers=req.headers):
+                continue
+            break
+    """
+
+    def __init__(
+        self,
+        name,
+        max_attempts=5,
+        base_delay=1.0,
+        max_delay=30.0,
+        deadline=None,
+        budget=retry_budget,
+    ):
+        self.name = name
+        # None means retry forever (e.g. popping, where the caller loops anyway)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # Absolute epoch time after which there is no point trying again
+        self.deadline = deadline
+        self.budget = budget
+        self.attempts = 1
+        self.last_delay = 0
+        if self.budget:
+            self.budget.deposit()
+
+    def reset(self):
+        """Forget past failures, for long-lived policies"""
+        self.attempts = 1
+        self.last_delay = 0
+
+    def remaining(self):
+        """Seconds left until the deadline, or None if there isn't one"""
+        if self.deadline is None:
+            return None
+        return self.deadline - time.time()
+
+    def timeout(self, default):
+        """Caps a request timeout so that a single attempt can't overrun the deadline"""
+        remaining = self.remaining()
+        if remaining is None:
+            return default
+        return max(min(default, remaining), 1)
+
+    def next_delay(self, headers=None, min_delay=0):
+        """Calculates how long to wait before the next attempt"""
+        ceiling = min(self.max_delay, self.base_delay * (2 ** (self.attempts - 1)))
+        # "Equal jitter" keeps a floor under the delay while still spreading out the herd
+        delay = ceiling / 2 + random.uniform(0, ceiling / 2)
+        hinted = parse_retry_after(headers)
+        if hinted is not None:
+            # The server knows better than us. Add a little jitter so all threads don't wake at once
+            delay = hinted + random.uniform(0, min(1.0, hinted * 0.1 + 0.1))
+        return max(delay, min_delay)
+
+    def backoff(self, headers=None, min_delay=0, reason=None):
+        """Sleeps until the next attempt is due.
+        Returns False without sleeping if the caller should give up instead"""
+        if self.max_attempts is not None and self.attempts >= self.max_attempts:
+            logger.debug("{}: giving up after {} attempts ({})", self.name, self.attempts, reason)
+            return False
+        delay = self.next_delay(headers=headers, min_delay=min_delay)
+        remaining = self.remaining()
+        if remaining is not None and delay >= remaining:
+            logger.warning(
+                "{}: not retrying ({}), next attempt in {:.1f}s would pass the job deadline ({:.1f}s left)",
+                self.name,
+                reason,
+                delay,
+                max(remaining, 0),
+            )
+            return False
+        if self.budget and not self.budget.withdraw():
+            logger.warning("{}: process retry budget exhausted, not retrying ({})", self.name, reason)
+            return False
+        self.attempts += 1
+        self.last_delay = delay
+        metrics.retries.labels(self.name).inc()
+        if reason:
+            logger.debug("{}: {}. Retrying in {:.1f}s (attempt {})", self.name, reason, delay, self.attempts)
+        time.sleep(delay)
+        return True
@@ -0,0 +1,93 @@
+"""Periodic snapshots of what the bridge has learned, so that a restart picks up where it left off"""
+import atexit
+import json
+import os
+import threading
+import time
+
+from worker.latency import latency_model
+from worker.logger import logger
+from worker.stats import bridge_stats
+from worker.tokens import token_estimator
+
+
+class StateStore:
+    """Saves the stats windows and the token calibrations every interval, and restores them on start
+
+    Snapshots are written to a temporary file which then replaces the previous one, so a crash
+    mid-write never leaves a corrupt snapshot behind. The latency model keeps its own file,
+    which is flushed on the same schedule.
+    """
+
+    # 2: the latency histograms are windowed
+    version = 2
+
+    def __init__(self, filename, interval=60):
+        # No filename disables the snapshots
+        self.filename = filename
+        self.interval = interval
+        self._restored = False
+        self._thread = None
+        self._mutex = threading.Lock()
+
+    def restore(self):
+        """Loads the last snapshot. Only the first worker to start does, the others wait for it"""
+        with self._mutex:
+            if self._restored:
+                return
+            self._restored = True
+            if not self.filename or not os.path.exists(self.filename):
+                return
+            try:
+                with open(self.filename, "rt", encoding="utf-8") as state_file:
+                    state = json.load(state_file)
+                if state.get("version") != self.version:
+                    logger.warning(f"Ignoring {self.filename}, it was written by another version of the bridge")
+                    return
+                bridge_stats.restore_state(state["stats"])
+                token_estimator.restore_calibration(state.get("bytes_per_token", {}))
+            except (OSError, ValueError, KeyError, TypeError) as err:
+                logger.warning(f"Could not restore the state from {self.filename}: {err}")
+                return
+            age = time.time() - state.get("saved", 0)
+            logger.info(f"♻️ Restored the stats of {len(state['stats']['workers'])} workers, saved {age:.0f}s ago")
+
+    def start(self):
+        with self._mutex:
+            if self._thread is not None or not self.filename:
+                return
+            self._thread = threading.Thread(target=self._run, name="state-store", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.save()
+
+    def save(self):
+        """Atomically writes a snapshot to disk"""
+        latency_model.save()
+        if not self.filename:
+            return
+        state = {
+            "version": self.version,
+            "saved": time.time(),
+            "stats": bridge_stats.export_state(),
+            "bytes_per_token": token_estimator.export_calibration(),
+        }
+        tmp_filename = f"{self.filename}.tmp"
+        try:
+            with open(tmp_filename, "wt", encoding="utf-8") as state_file:
+                json.dump(state, state_file)
+                state_file.flush()
+                os.fsync(state_file.fileno())
+            os.replace(tmp_filename, self.filename)
+        except (OSError, TypeError, ValueError) as err:
+            logger.warning(f"Could not save the state to {self.filename}: {err}")
+
+
+state_store = StateStore(
+    os.environ.get("HORDE_STATE_FILE", "bridge_state.json"),
+    interval=float(os.environ.get("HORDE_STATE_SAVE_INTERVAL", "60")),
+)
+atexit.register(state_store.save)
@@ -1,56 +1,351 @@
 """Bridge Stats Tracker"""
+import copy
 import json
+import math
 import threading
 import time
-from collections import deque
 
+from worker import metrics
 
-class BridgeStats:
-    """Convenience functions for the stats"""
 
-    stats = {}  # Deliberately on class level
+class RollingWindow:
+    """Count and sum of the values recorded over the last `window` seconds
 
-    def __init__(self):
-        self.kudos_record = deque()
-        self.pop_record = deque()
+    Values are added up in a ring of fixed-size time buckets, and a bucket is subtracted from the
+    running totals when it falls out of the window. Updates and reads are O(1) and memory is bounded
+    by the number of buckets, however many events we get. The window edge is only as precise as a bucket.
+    """
+
+    def __init__(self, window, bucket_seconds=1):
+        self.window = window
+        self.bucket_seconds = bucket_seconds
+        self.size = int(math.ceil(window / bucket_seconds))
+        self.counts = [0] * self.size
+        self.totals = [0.0] * self.size
+        self.count = 0
+        self.total = 0.0
+        # Absolute number of the newest bucket
+        self.current = None
+        # When the oldest value still in the window was recorded
+        self.first_event = None
+
+    def _advance(self, now):
+        bucket = int(now // self.bucket_seconds)
+        if self.current is None:
+            self.current = bucket
+            return
+        if bucket <= self.current:
+            return
+        # Never more than one lap around the ring, however long we've been idle
+        for step in range(1, min(bucket - self.current, self.size) + 1):
+            index = (self.current + step) % self.size
+            self.count -= self.counts[index]
+            self.total -= self.totals[index]
+            self.counts[index] = 0
+            self.totals[index] = 0.0
+        self.current = bucket
+        if self.count == 0:
+            # Also clears any floating point drift from the subtractions
+            self.total = 0.0
+            self.first_event = None
+
+    def add(self, value, now=None):
+        now = time.time() if now is None else now
+        self._advance(now)
+        index = self.current % self.size
+        self.counts[index] += 1
+        self.totals[index] += value
+        self.count += 1
+        self.total += value
+        if self.first_event is None:
+            self.first_event = now
+
+    def get_count(self, now=None):
+        self._advance(time.time() if now is None else now)
+        return self.count
+
+    def get_total(self, now=None):
+        self._advance(time.time() if now is None else now)
+        return self.total
+
+    def get_average(self, now=None):
+        self._advance(time.time() if now is None else now)
+        return self.total / self.count if self.count else 0
+
+    def to_dict(self):
+        return {
+            "window": self.window,
+            "bucket_seconds": self.bucket_seconds,
+            "counts": self.counts,
+            "totals": self.totals,
+            "current": self.current,
+            "first_event": self.first_event,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        rolling_window = cls(data["window"], bucket_seconds=data["bucket_seconds"])
+        if len(data["counts"]) != rolling_window.size or len(data["totals"]) != rolling_window.size:
+            raise ValueError("bucket count does not match the window")
+        rolling_window.counts = list(data["counts"])
+        rolling_window.totals = [float(total) for total in data["totals"]]
+        rolling_window.count = sum(rolling_window.counts)
+        rolling_window.total = sum(rolling_window.totals)
+        rolling_window.current = data["current"]
+        rolling_window.first_event = data["first_event"]
+        return rolling_window
+
+    def get_period(self, now=None):
+        """Seconds of history the window holds, up to the window size"""
+        now = time.time() if now is None else now
+        self._advance(now)
+        if self.first_event is None:
+            return 0
+        return min(now - self.first_event, self.window)
+
+
+class LatencyHistogram:
+    """Log-bucketed histogram of latencies, in the spirit of HdrHistogram
+
+    Each bucket is `precision` wider than the previous one, so percentiles are reported within that
+    relative error anywhere between min_value and max_value. Recording is O(1), memory is fixed by the
+    range and precision, and histograms with the same settings merge by adding up their buckets,
+    whether they come from other threads or, through to_dict(), from other processes.
+    """
+
+    PERCENTILES = (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("p999", 0.999))
+
+    def __init__(self, min_value=0.001, max_value=3600, precision=0.02):
+        self.min_value = min_value
+        self.max_value = max_value
+        self.precision = precision
+        self._log_base = math.log1p(precision)
+        # Bucket 0 holds everything up to min_value, bucket i everything up to min_value * (1 + precision) ** i
+        self.size = int(math.ceil(math.log(max_value / min_value) / self._log_base)) + 1
+        self.counts = [0] * self.size
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        if value <= self.min_value:
+            index = 0
+        else:
+            index = min(int(math.ceil(math.log(value / self.min_value) / self._log_base)), self.size - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def get_percentile(self, quantile):
+        if not self.count:
+            return None
+        rank = max(math.ceil(quantile * self.count), 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                # The upper bound of the bucket, but never more than we've actually seen
+                return min(self.min_value * (1 + self.precision) ** index, self.max)
+        return self.max
+
+    def get_percentiles(self):
+        if not self.count:
+            return {}
+        percentiles = {name: round(self.get_percentile(quantile), 3) for name, quantile in self.PERCENTILES}
+        percentiles["count"] = self.count
+        percentiles["max"] = round(self.max, 3)
+        return percentiles
+
+    def merge(self, other):
+        """Adds the other histogram's values to this one"""
+        if (other.min_value, other.max_value, other.precision) != (self.min_value, self.max_value, self.precision):
+            raise ValueError("Only histograms with the same range and precision can be merged")
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def copy(self):
+        histogram = LatencyHistogram(self.min_value, self.max_value, self.precision)
+        histogram.merge(self)
+        return histogram
+
+    def to_dict(self):
+        return {
+            "min_value": self.min_value,
+            "max_value": self.max_value,
+            "precision": self.precision,
+            # Most buckets are empty, so only the others are written
+            "counts": {str(index): count for index, count in enumerate(self.counts) if count},
+            "total": self.total,
+            "max": self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls(data["min_value"], data["max_value"], data["precision"])
+        for index, count in data["counts"].items():
+            histogram.counts[int(index)] = count
+        histogram.count = sum(histogram.counts)
+        histogram.total = data["total"]
+        histogram.max = data["max"]
+        return histogram
+
+
+class WindowedHistogram:
+    """The latencies of the last one to two windows, so that percentiles follow what's happening now
+
+    Values go into the current histogram, which becomes the previous one every window seconds.
+    Reads merge both, so they always cover at least one full window, and a regression in the tail
+    shows up within a window instead of being diluted by days of history.
+    """
+
+    def __init__(self, window=600, started=None):
+        self.window = window
+        self.started = time.time() if started is None else started
+        self.current = LatencyHistogram()
+        self.previous = LatencyHistogram()
+
+    def _rotate(self, now):
+        elapsed = now - self.started
+        if elapsed < self.window:
+            return
+        # After a quiet spell, the previous window may be long gone too
+        self.previous = self.current if elapsed < 2 * self.window else LatencyHistogram()
+        self.current = LatencyHistogram()
+        self.started += (elapsed // self.window) * self.window
+
+    def record(self, value, now=None):
+        self._rotate(time.time() if now is None else now)
+        self.current.record(value)
+
+    def get(self, now=None):
+        """Returns the latencies of the live windows, merged"""
+        self._rotate(time.time() if now is None else now)
+        merged = self.previous.copy()
+        merged.merge(self.current)
+        return merged
+
+    def to_dict(self):
+        return {
+            "started": self.started,
+            "current": self.current.to_dict(),
+            "previous": self.previous.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, data, window=600, now=None):
+        """Whatever expired while we were down is dropped"""
+        histogram = cls(window, data["started"])
+        histogram.current = LatencyHistogram.from_dict(data["current"])
+        histogram.previous = LatencyHistogram.from_dict(data["previous"])
+        histogram._rotate(time.time() if now is None else now)
+        return histogram
+
+
+class StatsScope:
+    """The stats of one worker, one endpoint or the whole process
+
+    Every scope has its own lock, so workers never wait on each other to record their stats.
+    """
+
+    WINDOWS = ("pop_times_5_mins", "pop_times_1_hour", "kudos_1_hour")
+    # Describe this process right now rather than what it learned, so they're never persisted
+    LIVE_STATS = ("health", "outbox", "http_pool")
+    LIVE_SUBSTATS = {"submit": ("backlog", "peak_backlog"), "dispatch": ("queued",)}
+    # Seconds each latency histogram window covers
+    LATENCY_WINDOW = 600
+
+    def __init__(self, name):
+        self.name = name
+        self.stats = {}
+        # When the horde last answered a pop, even if it had no job for us. Live state, so never persisted
+        self.last_pop_success = None
+        # Latency histograms by kind (pop, generation, ttft, submit), then by horde node or model
+        self.histograms = {}
+        self._create_windows()
         # We are called from diverse thread contexts
         self._mutex = threading.Lock()
 
+    def _create_windows(self):
+        self.pop_times_5_mins = RollingWindow(60 * 5, bucket_seconds=1)
+        self.pop_times_1_hour = RollingWindow(3600, bucket_seconds=60)
+        self.kudos_1_hour = RollingWindow(3600, bucket_seconds=10)
+
     def reset(self):
         with self._mutex:
-            self.kudos_record = deque()
-            self.pop_record = deque()
-            BridgeStats.stats = {}
+            self._create_windows()
+            self.histograms = {}
+            self.stats = {}
 
-    def update_pop_stats(self, node, pop_time):
+    def _record_latency(self, kind, key, value):
+        """Must be called with the mutex held"""
+        histograms = self.histograms.setdefault(kind, {})
+        if key not in histograms:
+            histograms[key] = WindowedHistogram(self.LATENCY_WINDOW)
+        histograms[key].record(value)
+
+    def get_histogram(self, kind):
+        """Returns the recent latencies of one kind merged across nodes or models, or None"""
         with self._mutex:
-            self.pop_record.append((node, pop_time, time.time()))
+            histograms = list(self.histograms.get(kind, {}).values())
+            if not histograms:
+                return None
+            merged = histograms[0].get()
+            for histogram in histograms[1:]:
+                merged.merge(histogram.get())
+        return merged
 
-            # only keep pop stats for an hour
+    def update_pop_stats(self, node, pop_time):
+        metrics.pop_seconds.labels(node).observe(pop_time)
+        with self._mutex:
             now = time.time()
-            too_old = now - 3600
-            while self.pop_record and self.pop_record[0][2] < too_old:
-                self.pop_record.popleft()
-
-            # Calculate some facts
-            recent = now - (60 * 5)
-            average_1_hour = (
-                sum(poptime for _, poptime, _ in self.pop_record) / len(self.pop_record) if self.pop_record else 0
-            )
-            data_5_mins = [poptime for _, poptime, when in self.pop_record if when > recent]
-            average_5_mins = sum(data_5_mins) / len(data_5_mins) if data_5_mins else 0
+            self._record_latency("pop", node, pop_time)
+            self.pop_times_5_mins.add(pop_time, now)
+            self.pop_times_1_hour.add(pop_time, now)
+            self.stats["pop_time_avg_5_mins"] = round(self.pop_times_5_mins.get_average(now), 2)
+            self.stats["pop_time_avg_1_hour"] = round(self.pop_times_1_hour.get_average(now), 2)
 
-            if self.pop_record:
-                self.stats["pop_time_avg_5_mins"] = round(average_5_mins, 2)
-                self.stats["pop_time_avg_1_hour"] = round(average_1_hour, 2)
+    def record_pop_success(self):
+        self.last_pop_success = time.time()
 
-    def update_inference_stats(self, model_name, kudos):
+    def update_inference_stats(
+        self,
+        model_name,
+        kudos,
+        prompt_tokens=None,
+        completion_tokens=None,
+        generation_time=None,
+        ttft=None,
+    ):
         """Updates the stats for a model inference"""
+        metrics.jobs_completed.labels(model_name).inc()
+        metrics.kudos_earned.labels(model_name).inc(kudos)
+        if completion_tokens is not None:
+            metrics.completion_tokens.labels(model_name).inc(completion_tokens)
+        if generation_time:
+            metrics.generation_seconds.labels(model_name).observe(generation_time)
+            if completion_tokens is not None:
+                metrics.tokens_per_second.labels(model_name).observe(completion_tokens / generation_time)
+        if ttft is not None:
+            metrics.ttft_seconds.labels(model_name).observe(ttft)
         with self._mutex:
             if "inference" not in self.stats:
                 self.stats["inference"] = {}
             if model_name not in self.stats["inference"]:
-                self.stats["inference"][model_name] = {"kudos": 0, "count": 0}
+                self.stats["inference"][model_name] = {
+                    "kudos": 0,
+                    "count": 0,
+                    "prompt_tokens": 0,
+                    "completion_tokens": 0,
+                    "generation_time": 0,
+                    "token_kudos": 0,
+                    "ttft_total": 0,
+                    "ttft_count": 0,
+                }
             self.stats["inference"][model_name]["count"] += 1
             self.stats["inference"][model_name]["kudos"] = round(self.stats["inference"][model_name]["kudos"] + kudos)
             stats_for_model = self.stats["inference"][model_name]
@@ -58,31 +353,260 @@ class BridgeStats:
                 stats_for_model["kudos"] / stats_for_model["count"],
                 2,
             )
+            # Real throughput, based on the tokens the backend actually generated
+            if prompt_tokens is not None:
+                stats_for_model["prompt_tokens"] += prompt_tokens
+            if completion_tokens is not None and generation_time:
+                stats_for_model["completion_tokens"] += completion_tokens
+                stats_for_model["generation_time"] += generation_time
+                # Only count the kudos of jobs we know the tokens of, so the ratio stays honest
+                stats_for_model["token_kudos"] += kudos
+                stats_for_model["tokens_per_second"] = round(
+                    stats_for_model["completion_tokens"] / stats_for_model["generation_time"],
+                    1,
+                )
+                if stats_for_model["token_kudos"]:
+                    stats_for_model["tokens_per_kudo"] = round(
+                        stats_for_model["completion_tokens"] / stats_for_model["token_kudos"],
+                        2,
+                    )
+            if ttft is not None:
+                stats_for_model["ttft_total"] += ttft
+                stats_for_model["ttft_count"] += 1
+                stats_for_model["avg_ttft"] = round(stats_for_model["ttft_total"] / stats_for_model["ttft_count"], 3)
+                self._record_latency("ttft", model_name, ttft)
+            if generation_time:
+                self._record_latency("generation", model_name, generation_time)
 
             # Remember the kudos we got awarded over the last hour
             now = time.time()
-            too_old = now - 3600
-            self.kudos_record.append((kudos, now))
-            oldest = self.kudos_record[0][1] if self.kudos_record else now
-            while self.kudos_record and self.kudos_record[0][1] < too_old:
-                oldest = self.kudos_record.popleft()[1]
-            period = now - oldest
-
-            # Calculate the total kudos
-            total_kudos = sum(score for score, _ in self.kudos_record)
-            # If period is less than an hour, extrapolate
-            total_kudos = 0 if period < 10 else total_kudos * (3600 / period)
-            jobs_per_hour = 1 if period < 10 else len(self.kudos_record) * (3600 / period)
-
-            if self.kudos_record:
-                self.stats["kudos_per_hour"] = round(total_kudos)
-                self.stats["jobs_per_hour"] = round(jobs_per_hour)
-                self.stats["avg_kudos_per_job"] = round(total_kudos / jobs_per_hour, 1)
+            self.kudos_1_hour.add(kudos, now)
+            self._update_hourly_rates(now)
+
+    def _update_hourly_rates(self, now):
+        """Must be called with the mutex held"""
+        period = self.kudos_1_hour.get_period(now)
+
+        # Calculate the total kudos
+        total_kudos = self.kudos_1_hour.get_total(now)
+        # If period is less than an hour, extrapolate
+        total_kudos = 0 if period < 10 else total_kudos * (3600 / period)
+        jobs_per_hour = 1 if period < 10 else self.kudos_1_hour.get_count(now) * (3600 / period)
+
+        self.stats["kudos_per_hour"] = round(total_kudos)
+        self.stats["jobs_per_hour"] = round(jobs_per_hour)
+        self.stats["avg_kudos_per_job"] = round(total_kudos / jobs_per_hour, 1)
+
+    def update_http_pool_stats(self, pool_stats):
+        """Records how busy the connection pool of an endpoint is"""
+        with self._mutex:
+            self.stats["http_pool"] = pool_stats
+
+    def update_submit_stats(self, queue_time=None, submit_time=None, backlog=None, model_name=None):
+        """Records how long submissions take and how many are waiting"""
+        if backlog is not None:
+            metrics.submit_backlog.set(backlog)
+        if submit_time is not None:
+            metrics.submit_seconds.observe(submit_time)
+            metrics.submit_queue_seconds.observe(queue_time or 0)
+        with self._mutex:
+            if "submit" not in self.stats:
+                self.stats["submit"] = {
+                    "submitted": 0,
+                    "queue_time_total": 0,
+                    "submit_time_total": 0,
+                    "backlog": 0,
+                    "peak_backlog": 0,
+                }
+            submit_stats = self.stats["submit"]
+            if backlog is not None:
+                submit_stats["backlog"] = backlog
+                submit_stats["peak_backlog"] = max(submit_stats.get("peak_backlog", 0), backlog)
+            if submit_time is not None:
+                self._record_latency("submit", model_name, (queue_time or 0) + submit_time)
+                submit_stats["submitted"] += 1
+                submit_stats["queue_time_total"] += queue_time or 0
+                submit_stats["submit_time_total"] += submit_time
+                submit_stats["avg_queue_time"] = round(submit_stats["queue_time_total"] / submit_stats["submitted"], 3)
+                submit_stats["avg_submit_time"] = round(
+                    submit_stats["submit_time_total"] / submit_stats["submitted"],
+                    3,
+                )
+                submit_stats["last_submit_latency"] = round((queue_time or 0) + submit_time, 3)
+
+    def update_dispatch_stats(self, start_gap, queued):
+        """Records how long a job waited to be started once both it and a thread were ready"""
+        with self._mutex:
+            if "dispatch" not in self.stats:
+                self.stats["dispatch"] = {"jobs_started": 0, "start_gap_total": 0, "max_start_gap": 0}
+            dispatch_stats = self.stats["dispatch"]
+            dispatch_stats["jobs_started"] += 1
+            dispatch_stats["start_gap_total"] += start_gap
+            dispatch_stats["avg_start_gap"] = round(dispatch_stats["start_gap_total"] / dispatch_stats["jobs_started"], 4)
+            dispatch_stats["last_start_gap"] = round(start_gap, 4)
+            dispatch_stats["max_start_gap"] = round(max(dispatch_stats["max_start_gap"], start_gap), 4)
+            dispatch_stats["queued"] = queued
+
+    def update_backend_health(self, health_stats):
+        """Records whether a generation backend is currently considered healthy"""
+        metrics.backend_healthy.labels(self.name).set(1 if health_stats["healthy"] else 0)
+        with self._mutex:
+            self.stats["health"] = health_stats
+
+    def record_last_job(self, model_name, kudos, job_id):
+        """Remembers the last job this worker completed, for the status line"""
+        with self._mutex:
+            self.stats["last_job"] = {"completed": time.time(), "model": model_name, "kudos": kudos, "id": job_id}
+
+    def update_outbox_stats(self, outbox_stats):
+        """Records how many finished generations are still waiting to be accepted by the horde"""
+        metrics.outbox_depth.set(outbox_stats["depth"])
+        with self._mutex:
+            self.stats["outbox"] = outbox_stats
+
+    def snapshot(self):
+        """Returns a copy of the stats which is safe to read while they keep changing"""
+        with self._mutex:
+            stats = copy.deepcopy(self.stats)
+            if self.histograms:
+                stats["latency"] = {
+                    kind: {key: histogram.get().get_percentiles() for key, histogram in histograms.items()}
+                    for kind, histograms in self.histograms.items()
+                }
+            return stats
+
+    def export_state(self):
+        """Everything needed to pick up where we left off after a restart"""
+        with self._mutex:
+            return {
+                "stats": self._without_live_stats(copy.deepcopy(self.stats)),
+                "windows": {name: getattr(self, name).to_dict() for name in self.WINDOWS},
+                "histograms": {
+                    kind: {key: histogram.to_dict() for key, histogram in histograms.items()}
+                    for kind, histograms in self.histograms.items()
+                },
+            }
+
+    def _without_live_stats(self, stats):
+        for key in self.LIVE_STATS:
+            stats.pop(key, None)
+        for key, live_keys in self.LIVE_SUBSTATS.items():
+            for live_key in live_keys:
+                stats.get(key, {}).pop(live_key, None)
+        return stats
+
+    def restore_state(self, state):
+        windows = {name: RollingWindow.from_dict(state["windows"][name]) for name in self.WINDOWS}
+        histograms = {
+            kind: {
+                key: WindowedHistogram.from_dict(histogram, self.LATENCY_WINDOW)
+                for key, histogram in by_key.items()
+            }
+            for kind, by_key in state.get("histograms", {}).items()
+        }
+        with self._mutex:
+            self.histograms = histograms
+            self.stats = self._without_live_stats(state["stats"])
+            for name, rolling_window in windows.items():
+                setattr(self, name, rolling_window)
+            now = time.time()
+            # Whatever is older than the windows has expired while we were down
+            if self.kudos_1_hour.get_count(now):
+                self._update_hourly_rates(now)
+            else:
+                for key in ("kudos_per_hour", "jobs_per_hour", "avg_kudos_per_job"):
+                    self.stats.pop(key, None)
+            if self.pop_times_1_hour.get_count(now):
+                self.stats["pop_time_avg_5_mins"] = round(self.pop_times_5_mins.get_average(now), 2)
+                self.stats["pop_time_avg_1_hour"] = round(self.pop_times_1_hour.get_average(now), 2)
+
+
+class BridgeStats:
+    """Registry of the stats, in a scope per worker, per endpoint and one for the whole process
+
+    Scopes are created once and then looked up without locking. Reads merge the scopes into a snapshot.
+    """
+
+    def __init__(self):
+        self.process = StatsScope("process")
+        self._workers = {}
+        self._endpoints = {}
+        self._mutex = threading.Lock()
+
+    def _get_scope(self, scopes, name):
+        scope = scopes.get(name)
+        if scope is None:
+            with self._mutex:
+                scope = scopes.setdefault(name, StatsScope(name))
+        return scope
+
+    def worker(self, worker_name):
+        """The stats of one worker, and so of one model"""
+        return self._get_scope(self._workers, worker_name)
+
+    def endpoint(self, endpoint):
+        """The stats of one backend or horde endpoint"""
+        return self._get_scope(self._endpoints, endpoint)
+
+    def reset(self):
+        with self._mutex:
+            self.process.reset()
+            self._workers = {}
+            self._endpoints = {}
+
+    def export_state(self):
+        return {
+            "process": self.process.export_state(),
+            "workers": {name: scope.export_state() for name, scope in list(self._workers.items())},
+        }
+
+    def restore_state(self, state):
+        """Restores the scopes saved by export_state()
+        Endpoint scopes only hold the live state of connections and backends, so they start afresh"""
+        self.process.restore_state(state["process"])
+        for name, scope_state in state.get("workers", {}).items():
+            self.worker(name).restore_state(scope_state)
+
+    def get_totals(self, worker_stats=None):
+        """Adds up the throughput of all workers, and finds the last job any of them completed"""
+        if worker_stats is None:
+            worker_stats = {name: scope.snapshot() for name, scope in list(self._workers.items())}
+        totals = {}
+        last_job = None
+        for stats in worker_stats.values():
+            for key in ("kudos_per_hour", "jobs_per_hour"):
+                if key in stats:
+                    totals[key] = totals.get(key, 0) + stats[key]
+            if "last_job" in stats and (last_job is None or stats["last_job"]["completed"] > last_job["completed"]):
+                last_job = stats["last_job"]
+        if last_job is not None:
+            totals["last_job"] = last_job
+        latency = {kind: self.get_latency(kind).get_percentiles() for kind in ("pop", "generation", "ttft", "submit")}
+        totals["latency"] = {kind: percentiles for kind, percentiles in latency.items() if percentiles}
+        return totals
+
+    def get_latency(self, kind):
+        """Merges one kind of latency histogram across every worker and the process"""
+        merged = LatencyHistogram()
+        for scope in [self.process, *list(self._workers.values())]:
+            histogram = scope.get_histogram(kind)
+            if histogram is not None:
+                merged.merge(histogram)
+        return merged
+
+    def snapshot(self):
+        """Returns a copy of every scope, along with the totals across workers"""
+        worker_stats = {name: scope.snapshot() for name, scope in list(self._workers.items())}
+        return {
+            "totals": self.get_totals(worker_stats),
+            "process": self.process.snapshot(),
+            "workers": worker_stats,
+            "endpoints": {name: scope.snapshot() for name, scope in list(self._endpoints.items())},
+        }
 
     def get_pretty_stats(self):
         """Returns a pretty string of the stats"""
-        with self._mutex:
-            return json.dumps(self.stats, indent=4)
+        return json.dumps(self.snapshot(), indent=4)
 
 
 bridge_stats = BridgeStats()
@@ -0,0 +1,88 @@
+"""Liveness and readiness of the bridge, served next to the metrics for the container orchestrator"""
+import os
+import threading
+import time
+
+from worker.metrics import metrics_server
+from worker.stats import bridge_stats
+from worker.utils import json_codec
+
+
+class BridgeStatus:
+    """Tells the orchestrator whether the bridge should be restarted (/healthz) or is worth sending work to (/readyz)
+
+    A worker is alive while its job loop keeps beating and its popper and refresher threads are running.
+    It is ready while it's alive, its backend is available, it isn't backlogged with submits and,
+    whenever it has room for more jobs, the horde answered its pops recently.
+    The bridge is alive while all its workers are, and ready while any of them is.
+    """
+
+    def __init__(self, heartbeat_timeout=60, pop_timeout=300):
+        self.heartbeat_timeout = heartbeat_timeout
+        self.pop_timeout = pop_timeout
+        # When each worker was registered, which is as long as it has gone without a pop until its first one
+        self._workers = {}
+        self._mutex = threading.Lock()
+
+    def register(self, worker):
+        with self._mutex:
+            self._workers.setdefault(worker, time.time())
+
+    def get_worker_status(self, worker):
+        now = time.monotonic()
+        heartbeat_age = now - worker.last_heartbeat
+        threads_alive = all(thread is None or thread.is_alive() for thread in (worker.popper, worker.refresher))
+        alive = not worker.should_stop and heartbeat_age < self.heartbeat_timeout and threads_alive
+
+        snapshot = worker.bridge_snapshot
+        backend_available = snapshot is not None and worker.can_process_jobs()
+        last_pop = bridge_stats.worker(worker.bridge_data.worker_name).last_pop_success
+        pop_age = time.time() - last_pop if last_pop else None
+        with self._mutex:
+            registered = self._workers.get(worker, time.time())
+        # A worker with no room for jobs doesn't pop, which is no reason to take it out of rotation
+        waiting_on_pops = snapshot is not None and worker.free_capacity() > 0
+        # Until its first successful pop, e.g. on a bad API key, a worker has gone without pops since it started
+        without_pops = pop_age if pop_age is not None else time.time() - registered
+        pop_stale = waiting_on_pops and without_pops > self.pop_timeout
+        backlogged = worker.is_submit_backlogged()
+        return {
+            "alive": alive,
+            "ready": alive and backend_available and not backlogged and not pop_stale,
+            "heartbeat_age": round(heartbeat_age, 1),
+            "threads_alive": threads_alive,
+            "backend_available": backend_available,
+            "last_pop_success_age": round(pop_age, 1) if pop_age is not None else None,
+            "submit_backlogged": backlogged,
+            "running_jobs": len(worker.running_jobs),
+            "waiting_jobs": len(worker.waiting_jobs),
+        }
+
+    def get_status(self):
+        with self._mutex:
+            workers = list(self._workers)
+        statuses = {worker.bridge_data.worker_name: self.get_worker_status(worker) for worker in workers}
+        return {
+            # Still starting up counts as alive, but not as ready
+            "alive": all(status["alive"] for status in statuses.values()),
+            "ready": any(status["ready"] for status in statuses.values()),
+            "workers": statuses,
+        }
+
+    def _respond(self, key):
+        status = self.get_status()
+        return 200 if status[key] else 503, "application/json", json_codec.dumps(status).decode("utf-8")
+
+    def serve_liveness(self, _query):
+        return self._respond("alive")
+
+    def serve_readiness(self, _query):
+        return self._respond("ready")
+
+
+bridge_status = BridgeStatus(
+    heartbeat_timeout=float(os.environ.get("HORDE_HEARTBEAT_TIMEOUT", "60")),
+    pop_timeout=float(os.environ.get("HORDE_READY_POP_TIMEOUT", "300")),
+)
+metrics_server.routes["/healthz"] = bridge_status.serve_liveness
+metrics_server.routes["/readyz"] = bridge_status.serve_readiness
@@ -0,0 +1,150 @@
+"""Token counting helpers, used for accounting and for checking prompts fit the context window"""
+import threading
+from collections import OrderedDict
+
+from worker.logger import logger
+
+# Across the tokenizers used by common LLMs, English text averages roughly 4 bytes of UTF-8 per token
+BYTES_PER_TOKEN = 4.0
+
+
+def _count_bytes(text):
+    # Avoids allocating an encoded copy of huge prompts, which are nearly always ASCII
+    if text.isascii():
+        return len(text)
+    return len(text.encode("utf-8", errors="ignore"))
+
+
+class TokenEstimator:
+    """Fast prompt token estimates
+
+    Uses the model's own tokenizer when one is available locally, otherwise a bytes-per-token
+    heuristic which is calibrated per model from the usage data the backends report.
+    Recent results are kept in an LRU, as the same prompt gets measured several times per job.
+    """
+
+    def __init__(self, cache_size=256, calibration_alpha=0.1):
+        self.cache_size = cache_size
+        self.calibration_alpha = calibration_alpha
+        self.bytes_per_token = {}
+        self._tokenizers = {}
+        self._cache = OrderedDict()
+        self._mutex = threading.Lock()
+
+    def get_tokenizer(self, model):
+        """Returns a locally installed tokenizer for this model, or None
+        We never download anything here, as this runs in the hot path"""
+        if not model:
+            return None
+        if model in self._tokenizers:
+            return self._tokenizers[model]
+        tokenizer = None
+        try:
+            from transformers import AutoTokenizer
+
+            tokenizer = AutoTokenizer.from_pretrained(model, local_files_only=True)
+            logger.debug(f"Using local tokenizer for {model}")
+        except ImportError:
+            pass
+        except Exception:
+            # Not cached locally or not a huggingface model name
+            pass
+        self._tokenizers[model] = tokenizer
+        return tokenizer
+
+    def get_bytes_per_token(self, model):
+        return self.bytes_per_token.get(model, BYTES_PER_TOKEN)
+
+    def estimate(self, text, model=None):
+        """Estimates how many tokens a piece of text will use"""
+        if not text:
+            return 0
+        # str caches its own hash, so this key is cheap even for huge prompts
+        key = (model, len(text), hash(text))
+        with self._mutex:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        tokenizer = self.get_tokenizer(model)
+        if tokenizer:
+            tokens = len(tokenizer.encode(text, add_special_tokens=False))
+        else:
+            tokens = max(1, round(_count_bytes(text) / self.get_bytes_per_token(model)))
+        with self._mutex:
+            self._cache[key] = tokens
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return tokens
+
+    def calibrate(self, model, text, tokens):
+        """Adjusts the heuristic for a model using a token count reported by its backend"""
+        if not text or not tokens or self.get_tokenizer(model):
+            return
+        observed = _count_bytes(text) / tokens
+        with self._mutex:
+            current = self.bytes_per_token.get(model, BYTES_PER_TOKEN)
+            self.bytes_per_token[model] = current + self.calibration_alpha * (observed - current)
+
+    def export_calibration(self):
+        with self._mutex:
+            return dict(self.bytes_per_token)
+
+    def restore_calibration(self, bytes_per_token):
+        """Restores calibrations from a previous run, without overriding what we've learned since"""
+        with self._mutex:
+            for model, value in bytes_per_token.items():
+                self.bytes_per_token.setdefault(model, float(value))
+
+    def truncate_left(self, text, max_tokens, model=None):
+        """Drops the start of the text so that it fits into max_tokens, as the horde does"""
+        if max_tokens <= 0:
+            return ""
+        tokenizer = self.get_tokenizer(model)
+        if tokenizer:
+            token_ids = tokenizer.encode(text, add_special_tokens=False)
+            if len(token_ids) <= max_tokens:
+                return text
+            return tokenizer.decode(token_ids[-max_tokens:])
+        # Without a tokenizer we keep a little margin, as we're only guessing where the tokens fall
+        max_chars = int(max_tokens * self.get_bytes_per_token(model) * 0.95)
+        if len(text) <= max_chars:
+            return text
+        return text[-max_chars:]
+
+
+token_estimator = TokenEstimator()
+
+
+def estimate_tokens(text, model=None):
+    """Cheaply estimates how many tokens a piece of text will use"""
+    return token_estimator.estimate(text, model)
+
+
+def _get_number(usage, key):
+    """The value of key if it's a usable number. Backends send nulls, strings and negative values too"""
+    value = usage.get(key)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0 or value != value:
+        return None
+    return value
+
+
+def get_usage(response_data):
+    """Extracts (prompt_tokens, completion_tokens, ttft) from an OpenAI-compatible response
+    Any value which the backend did not report, or reported as something other than a number, is returned as None.
+    Never raises, as a generation we already have shouldn't fail over its accounting"""
+    usage = response_data.get("usage") if isinstance(response_data, dict) else None
+    if not isinstance(usage, dict):
+        return None, None, None
+    prompt_tokens = _get_number(usage, "prompt_tokens")
+    completion_tokens = _get_number(usage, "completion_tokens")
+    # Groq reports the server-side time spent queueing and reading the prompt,
+    # which is as close as we get to time-to-first-token on a non-streaming request
+    ttft = None
+    prompt_time = _get_number(usage, "prompt_time")
+    if prompt_time is not None:
+        ttft = (_get_number(usage, "queue_time") or 0) + prompt_time
+    return (
+        int(prompt_tokens) if prompt_tokens is not None else None,
+        int(completion_tokens) if completion_tokens is not None else None,
+        ttft,
+    )
@@ -0,0 +1,250 @@
+"""Per-job traces, timing every phase of a job from its pop to its submission"""
+import contextlib
+import hashlib
+import os
+import queue
+import threading
+import time
+import uuid
+
+from worker.http_pool import http_pool
+from worker.logger import logger
+from worker.utils import json_codec
+
+
+def make_trace_id(job_id):
+    """The horde job id, as a W3C trace id, so traces can be looked up by job"""
+    try:
+        return uuid.UUID(str(job_id)).hex
+    except ValueError:
+        return hashlib.sha256(str(job_id).encode("utf-8")).hexdigest()[:32]
+
+
+class Span:
+    def __init__(self, name, parent_id=None, start=None, **attributes):
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.start = time.time() if start is None else start
+        self.end = None
+        self.attributes = attributes
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def finish(self, end=None):
+        if self.end is None:
+            self.end = time.time() if end is None else end
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "end": self.end,
+            "duration": round(self.end - self.start, 6),
+            "attributes": self.attributes,
+        }
+
+
+class JobTrace:
+    """The spans of one job: a root span, one span per phase of the job, and spans for the requests it sends
+
+    Phases follow each other, so starting one ends the previous one. Spans are recorded for every job,
+    as that costs next to nothing, but only sampled and failed traces are exported.
+    """
+
+    def __init__(self, tracer, job_id, **attributes):
+        self.tracer = tracer
+        self.job_id = job_id
+        self.trace_id = make_trace_id(job_id)
+        self.sampled = tracer.is_sampled(self.trace_id)
+        self.root = Span("job", job_id=job_id, **attributes)
+        self.phase = None
+        self.spans = []
+        self.finished = False
+        self._mutex = threading.Lock()
+
+    def begin(self, phase, **attributes):
+        """Ends the current phase of the job and starts the next one"""
+        now = time.time()
+        with self._mutex:
+            if self.phase is not None:
+                self.phase.finish(now)
+            self.phase = Span(phase, parent_id=self.root.span_id, start=now, **attributes)
+            self.spans.append(self.phase)
+
+    def annotate(self, **attributes):
+        """Adds attributes to the current phase"""
+        (self.phase or self.root).set(**attributes)
+
+    def add_span(self, name, start, end, **attributes):
+        """Records something which was timed before the job existed"""
+        span = Span(name, parent_id=self.root.span_id, start=start, **attributes)
+        span.finish(end)
+        with self._mutex:
+            self.root.start = min(self.root.start, start)
+            self.spans.append(span)
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        """Times a block within the current phase, noting the exception if it raised one"""
+        phase = self.phase
+        span = Span(name, parent_id=(phase or self.root).span_id, **attributes)
+        try:
+            yield span
+        except BaseException as err:
+            span.set(error=type(err).__name__)
+            raise
+        finally:
+            span.finish()
+            with self._mutex:
+                self.spans.append(span)
+
+    def headers(self, span=None):
+        """Lets the backend tie its own logs to this job"""
+        flags = "01" if self.sampled else "00"
+        return {
+            "X-Request-ID": str(self.job_id),
+            "traceparent": f"00-{self.trace_id}-{(span or self.phase or self.root).span_id}-{flags}",
+        }
+
+    def finish(self, status="ok"):
+        with self._mutex:
+            if self.finished:
+                return
+            self.finished = True
+            now = time.time()
+            if self.phase is not None:
+                self.phase.finish(now)
+            self.root.finish(now)
+            self.root.set(status=status)
+        if self.sampled or status != "ok":
+            self.tracer.export(self)
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            **self.root.to_dict(),
+            "spans": [span.to_dict() for span in self.spans if span.end is not None],
+        }
+
+
+class Tracer:
+    """Exports finished job traces from a background thread, as JSON lines to a file and/or as OTLP/HTTP
+
+    Whether a job is sampled is decided from its trace id, so every span of a job gets the same decision.
+    When the exporter can't keep up, traces are dropped rather than slowing down jobs.
+    """
+
+    def __init__(self, filename=None, otlp_endpoint=None, sample_rate=0.1, service_name="horde-bridge"):
+        # Neither output disables the exports. Request ids are still sent to the backends
+        self.filename = filename
+        self.otlp_endpoint = otlp_endpoint.rstrip("/") if otlp_endpoint else None
+        self.sample_rate = sample_rate
+        self.service_name = service_name
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=1000)
+        self._thread = None
+        self._mutex = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.filename or self.otlp_endpoint)
+
+    def is_sampled(self, trace_id):
+        return self.enabled and int(trace_id[:8], 16) < self.sample_rate * 0x100000000
+
+    def start_trace(self, job_id, **attributes):
+        return JobTrace(self, job_id, **attributes)
+
+    def export(self, trace):
+        if not self.enabled:
+            return
+        with self._mutex:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                self._thread.start()
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < 100:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            traces = [trace.to_dict() for trace in batch]
+            if self.filename:
+                try:
+                    with open(self.filename, "ab") as tracefile:
+                        tracefile.writelines(json_codec.dumps(trace) + b"\n" for trace in traces)
+                except OSError as err:
+                    logger.warning(f"Could not write traces to {self.filename}: {err}")
+            if self.otlp_endpoint:
+                try:
+                    http_pool.post(
+                        f"{self.otlp_endpoint}/v1/traces",
+                        read_timeout=10,
+                        data=json_codec.dumps(self.to_otlp(traces)),
+                        headers=json_codec.JSON_HEADERS,
+                    )
+                except Exception as err:
+                    logger.debug("Could not export {} traces to {}: {}", len(traces), self.otlp_endpoint, err)
+
+    @staticmethod
+    def _otlp_attributes(attributes):
+        converted = []
+        for key, value in attributes.items():
+            if isinstance(value, bool):
+                converted.append({"key": key, "value": {"boolValue": value}})
+            elif isinstance(value, int):
+                converted.append({"key": key, "value": {"intValue": str(value)}})
+            elif isinstance(value, float):
+                converted.append({"key": key, "value": {"doubleValue": value}})
+            elif value is not None:
+                converted.append({"key": key, "value": {"stringValue": str(value)}})
+        return converted
+
+    def _otlp_span(self, trace_id, span):
+        otlp_span = {
+            "traceId": trace_id,
+            "spanId": span["span_id"],
+            "name": span["name"],
+            "kind": 1,
+            "startTimeUnixNano": str(int(span["start"] * 1e9)),
+            "endTimeUnixNano": str(int(span["end"] * 1e9)),
+            "attributes": self._otlp_attributes(span["attributes"]),
+        }
+        if span["parent_id"]:
+            otlp_span["parentSpanId"] = span["parent_id"]
+        if span["attributes"].get("error") or span["attributes"].get("status", "ok") != "ok":
+            otlp_span["status"] = {"code": 2}
+        return otlp_span
+
+    def to_otlp(self, traces):
+        """Converts traces to the OTLP/HTTP JSON encoding"""
+        spans = []
+        for trace in traces:
+            spans.append(self._otlp_span(trace["trace_id"], trace))
+            spans.extend(self._otlp_span(trace["trace_id"], span) for span in trace["spans"])
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": self._otlp_attributes({"service.name": self.service_name})},
+                    "scopeSpans": [{"scope": {"name": "worker.tracing"}, "spans": spans}],
+                },
+            ],
+        }
+
+
+tracer = Tracer(
+    filename=os.environ.get("HORDE_TRACE_FILE"),
+    otlp_endpoint=os.environ.get("HORDE_TRACE_OTLP_ENDPOINT"),
+    sample_rate=float(os.environ.get("HORDE_TRACE_SAMPLE_RATE", "0.1")),
+)
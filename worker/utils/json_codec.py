@@ -0,0 +1,60 @@
+"""Fast JSON encoding and decoding, using orjson or msgspec when they're installed"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+if orjson is not None:
+    BACKEND = "orjson"
+    # orjson.JSONDecodeError subclasses json.JSONDecodeError
+    JSONDecodeError = (json.JSONDecodeError,)
+
+    def dumps(obj):
+        """Serializes to UTF-8 bytes, ready to be sent as a request body"""
+        return orjson.dumps(obj)
+
+    def loads(data):
+        """Deserializes from bytes or str"""
+        return orjson.loads(data)
+
+elif msgspec is not None:
+    BACKEND = "msgspec"
+    JSONDecodeError = (json.JSONDecodeError, msgspec.DecodeError)
+    _encoder = msgspec.json.Encoder()
+    _decoder = msgspec.json.Decoder()
+
+    def dumps(obj):
+        """Serializes to UTF-8 bytes, ready to be sent as a request body"""
+        return _encoder.encode(obj)
+
+    def loads(data):
+        """Deserializes from bytes or str"""
+        return _decoder.decode(data)
+
+else:
+    BACKEND = "json"
+    JSONDecodeError = (json.JSONDecodeError,)
+
+    def dumps(obj):
+        """Serializes to UTF-8 bytes, ready to be sent as a request body"""
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def loads(data):
+        """Deserializes from bytes or str"""
+        return json.loads(data)
+
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+def loads_response(response):
+    """Parses the body of a requests.Response straight from its bytes
+    Callers should keep the result instead of calling this (or response.json()) again"""
+    return loads(response.content)
@@ -0,0 +1,84 @@
+"""Process-wide cache for the lookups every worker makes against the same backends"""
+import hashlib
+import os
+import threading
+import time
+
+from worker.logger import logger
+
+
+class _Entry:
+    def __init__(self):
+        self.expires = 0
+        self.value = None
+        self.error = None
+        # Set while nobody is loading the value
+        self.ready = threading.Event()
+        self.ready.set()
+
+
+class TTLCache:
+    """Remembers results for a while, and makes concurrent callers share a single lookup
+
+    When nine workers validate the same backend at once, the first one does the request while
+    the others wait for its result instead of sending their own (single-flight).
+    Failures are remembered too, for a shorter while, so a backend which is down isn't hammered either.
+    """
+
+    def __init__(self, ttl=120, error_ttl=5):
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._mutex = threading.Lock()
+
+    @staticmethod
+    def make_key(kind, url, credential=None):
+        """Keys by url and credential, without keeping credentials around in plain text"""
+        digest = hashlib.sha256(credential.encode("utf-8")).hexdigest()[:16] if credential else None
+        return (kind, url, digest)
+
+    def get(self, key, loader, ttl=None):
+        """Returns the cached value for the key, calling loader() to fetch it if needed.
+        Exceptions raised by the loader are re-raised to everyone waiting for it"""
+        while True:
+            with self._mutex:
+                entry = self._entries.get(key)
+                if entry is None:
+                    entry = self._entries[key] = _Entry()
+                if entry.ready.is_set():
+                    if entry.expires > time.monotonic():
+                        self.hits += 1
+                        if entry.error is not None:
+                            raise entry.error
+                        return entry.value
+                    # Expired, we'll be the ones refreshing it
+                    entry.ready.clear()
+                    self.misses += 1
+                    break
+            # Someone else is already loading it
+            entry.ready.wait()
+        try:
+            entry.value = loader()
+            entry.error = None
+            entry.expires = time.monotonic() + (ttl or self.ttl)
+            return entry.value
+        except Exception as err:
+            entry.value = None
+            entry.error = err
+            entry.expires = time.monotonic() + self.error_ttl
+            logger.debug("Lookup for {} failed, remembering that for {}s: {}", key[:2], self.error_ttl, err)
+            raise
+        finally:
+            entry.ready.set()
+
+    def invalidate(self, key):
+        with self._mutex:
+            self._entries.pop(key, None)
+
+
+validation_cache = TTLCache(
+    ttl=int(os.environ.get("HORDE_VALIDATION_CACHE_TTL", "120")),
+    error_ttl=int(os.environ.get("HORDE_VALIDATION_ERROR_TTL", "5")),
+)
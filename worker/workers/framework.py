@@ -2,21 +2,50 @@
 import threading
 import time
 import sys
+from collections import deque, namedtuple
 from concurrent.futures import ThreadPoolExecutor
 
 from loguru import logger
+from worker import metrics
+from worker.governor import resource_governor
+from worker.jobs.poppers import make_pop_retry
+from worker.jobs.submitter import OutboxSubmission, submit_pool
+from worker.outbox import submit_outbox
+from worker.state import state_store
 from worker.stats import bridge_stats
+from worker.status import bridge_status
+
+# What the job loop needs to know about the configuration and the backend, published by the refresher
+BridgeSnapshot = namedtuple("BridgeSnapshot", ["available", "max_threads", "queue_size", "refreshed"])
 
 
 class WorkerFramework:
+    # How often the configuration and backend health are refreshed, and how often while the backend is down
+    refresh_interval = 60
+    unavailable_refresh_interval = 5
+
     def __init__(self, this_model_manager, this_bridge_data):
         self.model_manager = this_model_manager
         self.bridge_data = this_bridge_data
         self.running_jobs = []
-        self.waiting_jobs = []
+        # Filled by the popper thread, emptied by the job loop
+        self.waiting_jobs = deque()
+        # When job slots were freed, to measure how long it takes us to fill them again
+        self.freed_slots = deque(maxlen=64)
         self.run_count = 0
         self.pilot_job_was_run = False
-        self.last_config_reload = 0
+        self.last_outbox_replay = 0
+        self.bridge_snapshot = None
+        self.refresher = None
+        self.popper = None
+        # Kept across pops, so that only this worker backs off while its pops keep failing
+        self.pop_retry = make_pop_retry()
+        # Updated on every turn of the job loop, so we can tell when it's stuck
+        self.last_heartbeat = time.monotonic()
+        # Wakes up the job loop when a job finished or a new one arrived
+        self.wakeup = threading.Event()
+        # Wakes up the popper when there's room for more jobs
+        self.capacity_freed = threading.Event()
         self.is_daemon = False
         self.should_stop = False
         self.should_restart = False
@@ -37,6 +66,7 @@ class WorkerFramework:
         # Clear any existing jobs on restart to prevent memory leaks
         self.running_jobs.clear()
         self.waiting_jobs.clear()
+        self.freed_slots.clear()
 
     @logger.catch(reraise=True)
     def stop(self):
@@ -47,7 +77,18 @@ class WorkerFramework:
 
     @logger.catch(reraise=True)
     def start(self):
-        self.reload_data()
+        # Before anything gets recorded, so we carry on from the previous run's stats
+        state_store.restore()
+        state_store.start()
+        resource_governor.start()
+        self.refresh_bridge_data()
+        self.register_metrics()
+        bridge_status.register(self)
+        metrics.metrics_server.start()
+        # Anything a previous run couldn't submit goes out first
+        self.replay_outbox()
+        self.start_refresher()
+        self.start_popper()
         self.exit_rc = 1
 
         self.consecutive_failed_jobs = 0  # Moved out of the loop to capture failure across soft-restarts
@@ -62,7 +103,7 @@ class WorkerFramework:
                 self.run_count = 0
                 logger.info(f"🔄 Worker restarting...")
 
-            with ThreadPoolExecutor(max_workers=self.bridge_data.max_threads) as self.executor:
+            with ThreadPoolExecutor(max_workers=self.bridge_snapshot.max_threads) as self.executor:
                 while not self.should_stop:
                     if self.should_restart:
                         self.executor.shutdown(wait=False)
@@ -88,11 +129,10 @@ class WorkerFramework:
                         sys.exit(self.exit_rc)
 
     def process_jobs(self):
-        if time.time() - self.last_config_reload > 60:
-            self.reload_bridge_data()
-        if not self.can_process_jobs():
-            time.sleep(5)
-            return
+        # Only ever look at the published snapshot here, so that a slow backend check can't hold up this loop
+        # Whether we can take on new jobs is up to the popper. Jobs we already have are always dispatched and reaped
+        snapshot = self.bridge_snapshot
+        self.last_heartbeat = time.monotonic()
         
         # Show a compact status display every 30 seconds
         current_time = time.time()
@@ -118,12 +158,9 @@ class WorkerFramework:
             
             self._last_status_display = current_time
         
-        # Add job to queue if we have space
-        if len(self.waiting_jobs) < self.bridge_data.queue_size:
-            self.add_job_to_queue()
-        
-        # Start new jobs
-        while len(self.running_jobs) < self.bridge_data.max_threads and self.start_job():
+        # Start new jobs. The popper thread keeps the queue filled
+        max_threads, _ = self.get_capacity()
+        while len(self.running_jobs) < max_threads and self.start_job():
             pass
         
         # Check if any jobs are done
@@ -132,55 +169,150 @@ class WorkerFramework:
             if self.should_restart or self.should_stop:
                 break
         
-        # Give the CPU a break
-        time.sleep(0.02)
+        # Sleep until a job finishes or a new one is popped. The timeout is for noticing stale jobs
+        self.wakeup.wait(0.5)
+        self.wakeup.clear()
+
+    def register_metrics(self):
+        """Reports this worker's load whenever the metrics are scraped"""
+        labels = (self.bridge_data.worker_name, getattr(self.bridge_data, "model", None))
+        metrics.jobs_in_flight.labels(*labels).set_function(lambda: len(self.running_jobs))
+        metrics.jobs_waiting.labels(*labels).set_function(lambda: len(self.waiting_jobs))
+        metrics.executor_utilization.labels(*labels).set_function(
+            lambda: len(self.running_jobs) / max(self.bridge_snapshot.max_threads, 1),
+        )
+
+    def replay_outbox(self):
+        """Submits the generations which the horde didn't accept yet, including those from before a restart"""
+        self.last_outbox_replay = time.time()
+        entries = submit_outbox.claim_pending(self.bridge_data.worker_name)
+        if entries:
+            logger.info(f"📤 Replaying {len(entries)} unsubmitted generations from the outbox")
+        for entry in entries:
+            submit_pool.submit(OutboxSubmission(entry, self.bridge_data.api_key))
 
     def can_process_jobs(self):
-        """This function returns true when this worker can start polling for jobs from the AI Horde
+        """This function returns true when this worker can start polling for jobs from the AI Horde"""
+        return self.bridge_snapshot.available
+
+    def is_backend_available(self):
+        """Checked by the refresher after each reload.
         This function MUST be overriden, according to the logic for this worker type"""
         return False
 
+    def is_submit_backlogged(self):
+        """True when finished jobs are piling up faster than we can submit them"""
+        if submit_pool.is_backlogged():
+            logger.debug("Submit backlog at {} jobs, not popping new jobs", submit_pool.backlog())
+            return True
+        return False
+
+    def get_capacity(self):
+        """The threads and queue_size we may use right now, which the resource governor shrinks under pressure"""
+        snapshot = self.bridge_snapshot
+        return resource_governor.limit_capacity(snapshot.max_threads, snapshot.queue_size)
+
+    def free_capacity(self):
+        """How many more jobs we can take on: a free thread for each, plus the queue_size we may hold in reserve"""
+        max_threads, queue_size = self.get_capacity()
+        return max_threads + queue_size - len(self.running_jobs) - len(self.waiting_jobs)
+
+    def can_pop(self):
+        """True if the popper should ask the horde for another job right now"""
+        if self.should_stop or self.should_restart or not self.can_process_jobs():
+            return False
+        # Jobs in flight are what frees memory once done. A worker holding none can't make things better by waiting,
+        # so it takes one job at a time
+        if resource_governor.is_paused() and (self.running_jobs or self.waiting_jobs):
+            return False
+        return self.free_capacity() > 0 and not self.is_submit_backlogged()
+
+    def start_popper(self):
+        """Pops jobs from a background thread, so that a slow pop never delays reaping and starting jobs"""
+        if self.popper is not None:
+            return
+        self.popper = threading.Thread(
+            target=self._pop_loop,
+            name=f"popper-{threading.current_thread().name}",
+            daemon=True,
+        )
+        self.popper.start()
+
+    def _pop_loop(self):
+        while not self.should_stop:
+            if not self.can_pop():
+                self.capacity_freed.wait(1)
+                self.capacity_freed.clear()
+                continue
+            try:
+                self.add_job_to_queue()
+            except Exception as err:
+                logger.error("Error while popping a job: {}", err)
+                time.sleep(1)
+
     def add_job_to_queue(self):
         """Picks up a job from the horde and adds it to the local queue
         Returns the job object created, if any"""
         if jobs := self.pop_job():
-            self.waiting_jobs.extend(jobs)
+            queued_at = time.monotonic()
+            for job in jobs:
+                job.queued_at = queued_at
+                # Better to hand a job straight back than to have the container killed with every job in it
+                if not resource_governor.admit(job.get_memory_footprint()):
+                    logger.warning(
+                        f"🛑 Returning a job which needs ~{job.get_memory_footprint() / 2**20:.0f} MB, "
+                        f"only {resource_governor.get_memory_headroom() / 2**20:.0f} MB are left",
+                    )
+                    job.fault("memory_pressure")
+                    job.queue_submit()
+                    continue
+                job.trace.begin("waiting")
+                self.waiting_jobs.append(job)
+            self.wakeup.set()
+
+    def on_job_done(self, _future):
+        """Called from the job's thread as soon as it finishes"""
+        self.freed_slots.append(time.monotonic())
+        self.wakeup.set()
+        self.capacity_freed.set()
 
     def pop_job(self):
         """Polls the AI Horde for new jobs and creates as many Job classes needed
         As the amount of jobs returned"""
-        job_popper = self.PopperClass(self.model_manager, self.bridge_data)
+        job_popper = self.PopperClass(self.model_manager, self.bridge_data, self.pop_retry)
+        pop_started = time.time()
         pops = job_popper.horde_pop()
         if not pops:
             return None
+        pop_finished = time.time()
         new_jobs = []
         for pop in pops:
             new_job = self.JobClass(self.model_manager, self.bridge_data, pop)
+            new_job.trace.add_span("pop", pop_started, pop_finished, jobs=len(pops))
             new_jobs.append(new_job)
         return new_jobs
 
     def start_job(self):
         """Starts a job previously picked up from the horde
-        Returns True to continue starting jobs until queue is full
-        Returns False to break out of the loop and poll the horde again"""
-        job = None
-        # Queue disabled
-        if self.bridge_data.queue_size == 0:
-            if jobs := self.pop_job():
-                job = jobs[0]
-            if self.should_stop:
-                return False
-        elif len(self.waiting_jobs) > 0:
-            job = self.waiting_jobs.pop(0)
-        else:
-            #  This causes a break on the main loop outside
+        Returns True to continue starting jobs until the threads are full
+        Returns False when there's nothing left to start"""
+        if not self.waiting_jobs:
             return False
-        # Run the job
-        if job:
-            self.running_jobs.append((self.executor.submit(job.start_job), time.monotonic(), job))
-            logger.debug("New job processing")
-        else:
-            logger.debug("No new job to start")
+        job = self.waiting_jobs.popleft()
+        job.trace.begin("executor_queue")
+        job_thread = self.executor.submit(job.start_job)
+        job_thread.add_done_callback(self.on_job_done)
+        self.running_jobs.append((job_thread, time.monotonic(), job))
+        # How long the job had to wait for us after both it and a thread were ready
+        now = time.monotonic()
+        ready_since = job.queued_at
+        metrics.queue_wait_seconds.labels(getattr(self.bridge_data, "model", None)).observe(now - ready_since)
+        if self.freed_slots:
+            ready_since = max(ready_since, self.freed_slots.popleft())
+        bridge_stats.worker(self.bridge_data.worker_name).update_dispatch_stats(now - ready_since, len(self.waiting_jobs))
+        logger.debug("New job processing")
+        # There's room in the queue again
+        self.capacity_freed.set()
         return True
 
     def check_running_job_status(self, job_thread, start_time, job):
@@ -190,6 +322,8 @@ class WorkerFramework:
             if job_thread.exception(timeout=1) or job.is_faulted():
                 if job_thread.exception(timeout=1):
                     logger.error(f"❌ Job failed with exception: {job_thread.exception()}")
+                    # It never got as far as the submit pool, which finishes the traces of the others
+                    job.trace.finish("faulted")
                 if job.is_out_of_memory():
                     logger.error(f"❌ Job failed with out of memory error")
                     self.out_of_memory_jobs += 1
@@ -215,22 +349,20 @@ class WorkerFramework:
                 self.consecutive_failed_jobs = 0
                 self.consecutive_executor_restarts = 0
             self.run_count += 1
-            logger.debug(f"Job finished in {runtime:.3f}s (Total: {self.run_count})")
+            logger.debug("Job finished in {:.3f}s (Total: {})", runtime, self.run_count)
             
             # Remove the job from running_jobs to avoid memory leaks
             if (job_thread, start_time, job) in self.running_jobs:
                 self.running_jobs.remove((job_thread, start_time, job))
             
-            # Explicitly clear job content to help garbage collection
-            if hasattr(job, 'text'):
-                job.text = None
-            if hasattr(job, 'current_payload'):
-                job.current_payload = None
+            # Jobs which raised never got as far as encoding their submission
+            job.release_inputs()
             return
 
         # check if any job has run for more than 180 seconds
         if job_thread.running() and job.is_stale():
             logger.warning(f"⏱️ Job is stale after {runtime:.3f}s - restarting all jobs")
+            metrics.job_faults.labels(getattr(self.bridge_data, "model", None), "stale").inc()
             for (
                 inner_job_thread,
                 inner_start_time,
@@ -238,13 +370,9 @@ class WorkerFramework:
             ) in list(self.running_jobs):  # Use a copy of the list to avoid modification during iteration
                 if (inner_job_thread, inner_start_time, inner_job) in self.running_jobs:
                     self.running_jobs.remove((inner_job_thread, inner_start_time, inner_job))
-                job_thread.cancel()
-                
-                # Explicitly clear job content to help garbage collection
-                if hasattr(inner_job, 'text'):
-                    inner_job.text = None
-                if hasattr(inner_job, 'current_payload'):
-                    inner_job.current_payload = None
+                inner_job_thread.cancel()
+                # A thread which already started can't be cancelled, so its buffers stay until it's done with them
+                inner_job_thread.add_done_callback(lambda _future, job=inner_job: job.release_inputs())
             self.should_restart = True
             return
 
@@ -254,8 +382,47 @@ class WorkerFramework:
         if not self.is_daemon:
             self.bridge_data.reload_data()
 
-    def reload_bridge_data(self):
-        self.reload_data()
-        if hasattr(self.executor, '_max_workers'):
-            self.executor._max_workers = self.bridge_data.max_threads
-        self.last_config_reload = time.time()
+    def start_refresher(self):
+        """Keeps the configuration and backend health fresh from a background thread"""
+        if self.refresher is not None:
+            return
+        self.refresher = threading.Thread(
+            target=self._refresh_loop,
+            name=f"refresher-{threading.current_thread().name}",
+            daemon=True,
+        )
+        self.refresher.start()
+
+    def _refresh_loop(self):
+        while not self.should_stop:
+            interval = self.refresh_interval if self.bridge_snapshot.available else self.unavailable_refresh_interval
+            time.sleep(max(self.bridge_snapshot.refreshed + interval - time.time(), 0.1))
+            if self.should_stop:
+                return
+            try:
+                self.refresh_bridge_data()
+                if time.time() - self.last_outbox_replay > 60:
+                    self.replay_outbox()
+            except Exception as err:
+                logger.error("Error while refreshing the configuration: {}", err)
+
+    def refresh_bridge_data(self):
+        """Reloads the configuration and checks the backend, then publishes the result for the job loop"""
+        try:
+            self.reload_data()
+        finally:
+            available = self.is_backend_available()
+            if not available:
+                logger.debug(
+                    "Backend not available, checking again in {}s",
+                    self.unavailable_refresh_interval,
+                )
+            # Replacing the tuple is atomic, so the job loop never sees half a refresh
+            self.bridge_snapshot = BridgeSnapshot(
+                available=available,
+                max_threads=self.bridge_data.max_threads,
+                queue_size=self.bridge_data.queue_size,
+                refreshed=time.time(),
+            )
+            if hasattr(self.executor, '_max_workers'):
+                self.executor._max_workers = self.bridge_data.max_threads
@@ -1,10 +1,8 @@
 """This is the scribe worker, it's the main workhorse that deals with getting requests, and spawning data processing"""
-import time
-
+from worker.health import health_monitor
 from worker.jobs.poppers import ScribePopper
 from worker.jobs.scribe import ScribeHordeJob
 from worker.workers.framework import WorkerFramework
-from loguru import logger
 
 
 class ScribeWorker(WorkerFramework):
@@ -13,23 +11,24 @@ class ScribeWorker(WorkerFramework):
         self.PopperClass = ScribePopper
         self.JobClass = ScribeHordeJob
 
+    def start_popper(self):
+        # Pause popping as soon as any worker on our backend sees it fail, and resume the moment it recovers
+        health_monitor.register(
+            self.bridge_data.backend_url,
+            probe=self.bridge_data.probe_backend,
+            listener=self.capacity_freed.set,
+        )
+        super().start_popper()
+
     def can_process_jobs(self):
+        return super().can_process_jobs() and health_monitor.is_healthy(self.bridge_data.backend_url)
+
+    def is_backend_available(self):
         # Check availability based on API type
         if self.bridge_data.api_type == "openai":
-            openai_avail = self.bridge_data.openai_available
-            if not openai_avail:
-                # Try to reload the config every 5 seconds until the OpenAI connection is established
-                self.last_config_reload = time.time() - 55
-                logger.debug("OpenAI API not available, will retry configuration reload shortly")
-            return openai_avail
-        else:
-            # Default to KoboldAI
-            kai_avail = self.bridge_data.kai_available
-            if not kai_avail:
-                # We do this to allow the worker to try and reload the config every 5 seconds until the KAI server is up
-                self.last_config_reload = time.time() - 55
-                logger.debug("KoboldAI not available, will retry configuration reload shortly")
-            return kai_avail
+            return self.bridge_data.openai_available
+        # Default to KoboldAI
+        return self.bridge_data.kai_available
 
     # We want this to be extendable as well
     def add_job_to_queue(self):
@@ -46,7 +45,7 @@ class ScribeWorker(WorkerFramework):
                 running_job_models.append(job.current_model)
         
         queued_jobs_models = []
-        for job in self.waiting_jobs:
+        for job in list(self.waiting_jobs):
             if hasattr(job, 'current_model') and job.current_model:
                 queued_jobs_models.append(job.current_model)
         